@@ -63,7 +63,7 @@ class Config:
     # Import data
     IMPORT_FOLDER = 'imports'
     IMPORT_UPLOAD_FOLDER = path.join(PACKAGE, IMPORT_FOLDER)
-    IMPORT_SUPPORTED_VERSIONS = [1]
+    IMPORT_SUPPORTED_VERSIONS = [1, 2]
 
     # Log data
     LOG_FOLDER = 'log'
@@ -89,6 +89,11 @@ class Config:
     LOG_BACKUP_FILE_COUNT = 10
     LOG_BACKUP_FILE_SIZE = 5000000 # 5M bytes
 
+    # Log lines are queued and written by one writer thread per log file.
+    # Queued lines are written once they are this many seconds old or reach this many bytes.
+    LOG_FLUSH_INTERVAL = 0.5
+    LOG_FLUSH_SIZE = 65536
+
     # Login
     # Number of seconds a session can be idle before expiring.
     SESSION_IDLE_TIME = 1800
@@ -103,4 +108,62 @@ class Config:
     LOGPAGE_SIZE = 50
 
     # Database Control
-    READ_ONLY = False
\ No newline at end of file
+    READ_ONLY = False
+
+    # Database connection pool.
+    # Connections opened on first use, the most that may be open at once, seconds to wait for
+    # a free connection, and seconds a connection can sit idle before it is pinged on checkout.
+    DB_POOL_MIN_CONNECTIONS = 2
+    DB_POOL_MAX_CONNECTIONS = 20
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_HEALTHCHECK_TIME = 60
+
+    # Seconds to wait for the table locks to add or remove an event's vote and voter partitions
+    # before giving up (see events.py), rather than holding up voting in other events.
+    DB_PARTITION_LOCK_TIMEOUT = 5
+
+    # Bulk loads (event data import).
+    # Stream rows with COPY; when False (or if the server refuses COPY), use multi-row INSERTs
+    # of the given number of rows each.
+    DB_BULK_LOAD_COPY = True
+    DB_BULK_LOAD_PAGE_SIZE = 1000
+
+    # Send runs of statements in a db.sql() call to the server as one batch.
+    DB_BATCH_STATEMENTS = True
+
+    # Query statistics.
+    # Statements taking at least this many seconds go to the slow query log, and the fraction
+    # of statements (0.0 - 1.0) whose shape and time are logged at debug level.
+    DB_SLOW_QUERY_TIME = 0.25
+    DB_QUERY_SAMPLE_RATE = 0.0
+    QUERYSTATS_PAGE_SIZE = 100
+
+    # Ballot submission API: the most ballots accepted in one request.
+    VOTE_BATCH_MAX_BALLOTS = 500
+
+    # Paper ballot entry: ballots recorded per transaction.
+    BALLOT_ENTRY_BATCH_SIZE = 100
+
+    # Live results (Server-Sent Events).
+    # Seconds between re-reads of an event's tallies while it is watched (ballots recorded in this
+    # process are picked up at once), seconds between keepalives, and changes kept for late viewers.
+    RESULTS_STREAM_POLL_TIME = 5
+    RESULTS_STREAM_KEEPALIVE = 15
+    RESULTS_STREAM_HISTORY = 100
+
+    # Each open results stream holds a web server thread.  The most streams open at once (more are
+    # refused, and those results pages reload themselves every RESULTS_STREAM_FALLBACK_RELOAD seconds
+    # instead), and seconds a stream stays open before it is closed and the browser reconnects.
+    RESULTS_STREAM_MAX = 8
+    RESULTS_STREAM_FALLBACK_RELOAD = 60
+    RESULTS_STREAM_LIFETIME = 600
+
+    # Web server threads for everything other than results streams (serve.py adds RESULTS_STREAM_MAX).
+    SERVE_THREADS = 8
+
+    # Write-in candidates: the trigram similarity (0.0 - 1.0) at which a write-in name is offered for
+    # merging into another candidate.  Values below pg_trgm.similarity_threshold (0.3) have no effect.
+    WRITEIN_MATCH_SIMILARITY = 0.5
+
+    # Bulk voter generation: the most voters generated at once.
+    VOTER_GENERATE_MAX = 50000
\ No newline at end of file
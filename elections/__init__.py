@@ -143,6 +143,17 @@ if flaskenv != 'development' or is_running_from_reloader():
             log_id = AppLog.get_id(e['clubid'], e['eventid'])
             loggers[log_id] = AppLog(e['clubid'], e['eventid'], logfile, logpath)
 
+        # Make sure each event's vote tallies agree with its votes.
+        import elections.tallies as tallies
+        for e in eventdata:
+            tallies.verify_and_repair('system', e['clubid'], e['eventid'])
+
+        # Load the ballots of events still open for voting, so their first voters don't wait on them.
+        from elections.ballotitems import get_ballot
+        for e in eventdata:
+            if e['locked'] is False:
+                get_ballot('system', e['clubid'], e['eventid'])
+
         # Tell all logs the system restarted.
         for l in loggers:
             loggers[l].critical(f"### Restarting @ {datetime.utcnow()} ###", propagate=False)
@@ -164,6 +175,10 @@ def shutdown_app():
     if flaskenv != 'development' or is_running_from_reloader():
         print("Shutting down")
 
+        # Close all pooled database connections.
+        from elections import db
+        db.close_database()
+
 
 """Run"""
 with app.app_context():
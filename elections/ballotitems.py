@@ -6,6 +6,7 @@
 #   used, distributed, or modified without my express consent.
 
 import traceback
+import threading
 from enum import Enum
 
 from flask import redirect, render_template, url_for, request, session
@@ -23,6 +24,138 @@ ITEM_TYPES_DICT = {
     ITEM_TYPES.QUESTION.value: 'Question'
 }
 
+# How a contest is counted.  Ranked contests are counted by instant runoff with one position and by
+# single transferable vote with more (see counting.py).
+class COUNT_METHODS(Enum):
+    PLURALITY = 1
+    RANKED = 2
+
+COUNT_METHODS_DICT = {
+    COUNT_METHODS.PLURALITY.value: 'Plurality',
+    COUNT_METHODS.RANKED.value: 'Ranked Choice'
+}
+
+
+# Whether a ballot item is a ranked contest.
+def is_ranked(ballotitem):
+    return ITEM_TYPES.CONTEST.value == ballotitem['type'] and COUNT_METHODS.RANKED.value == ballotitem['method']
+
+
+# The key candidate names are matched on: lower case, with runs of spaces as one and none at the ends.
+# This must match the database's candidate_namekey() function.
+def name_key(name):
+    return ' '.join(name.split()).lower()
+
+
+# Ballot definitions for voting: the ballot items and preconfigured candidates of an event.
+db.register_statement('ballots_items', 'SELECT * FROM ballotitems WHERE clubid=$1 AND eventid=$2 ORDER BY itemid ASC')
+db.register_statement('ballots_candidates', '''SELECT * FROM candidates WHERE clubid=$1 AND eventid=$2 AND writein=False
+                                               ORDER BY itemid ASC, lastname ASC''')
+
+# An event's version (0 until it is first changed), and moving it on (see bump_event_version()).
+db.register_statement('ballots_event_version', '''SELECT COALESCE((SELECT version FROM event_versions WHERE clubid=$1 AND eventid=$2), 0) AS version''')
+db.register_statement('ballots_bump_event_version', '''INSERT INTO event_versions (clubid, eventid, version) VALUES ($1, $2, 1)
+                                                       ON CONFLICT (clubid, eventid) DO UPDATE SET version = event_versions.version + 1''')
+
+# Cached ballot definitions, keyed by (clubid, eventid), each held as (event version, ballot items, candidates).
+# Ballots rarely change once voting starts, so each is built once (with its write-in slots) and
+# reused for every voter while the event's version in the database is the one it was built at.
+# Ballot item and candidate changes, imports and resets move the version on (invalidate_ballot()),
+# in whichever process they happen, so every process rebuilds on its next read.
+ballot_cache = {}
+ballot_cache_mutex = threading.Lock()
+
+
+# Fetch and build an event's ballot definition.
+# Returns the event version it was read at, the ballot items and the candidates keyed by item ID, with
+# N write-in slots (N = the number of positions) after the preconfigured candidates of each contest.
+# The version is read first, so the ballot is never older than the version it is cached at.
+def build_ballot(user, clubid, eventid):
+    # Only fetch the preconfigured candidates for the ballot.
+    # The voter must be free to write in their own candidates without influence.
+    outsql = [db.statement('ballots_event_version', clubid, eventid),
+              db.statement('ballots_items', clubid, eventid),
+              db.statement('ballots_candidates', clubid, eventid)]
+
+    _, data, err = db.sql(outsql, handlekey=user)
+    if err is not None:
+        return None, None, None, err
+
+    version = data[0][0]['version']
+    ballotitems = data[1]
+    candidates = {}
+    for c in data[2]:
+        # Indicate the item is not newly added by a voter as a write-in candidate.
+        c['new'] = False
+        candidates.setdefault(c['itemid'], []).append(c)
+
+    # Append N write-in candidates (N = number of ballot item positions).
+    for b in ballotitems:
+        if ITEM_TYPES.CONTEST.value == b['type']:
+            itemid = b['itemid']
+
+            for r in range(0, b['positions']):
+                writein = {'id': 'writein_%d' % (r + 1),
+                           'itemid': itemid,
+                           'firstname': '',
+                           'lastname': '',
+                           'fullname': '',
+                           'writein': True,
+                           'new': True
+                          }
+                candidates.setdefault(itemid, []).append(writein)
+
+    return version, ballotitems, candidates, None
+
+
+# Get an event's ballot definition, from the cache if it is at the event's current version.
+# The voting pages mark candidates as selected and fill in write-in names, so each caller gets its
+# own copy of the candidates; the ballot items are shared and must not be changed.
+def get_ballot(user, clubid, eventid):
+    key = (clubid, eventid)
+
+    _, data, err = db.sql(db.statement('ballots_event_version', clubid, eventid), handlekey=user)
+    if err is not None:
+        return None, None, err
+
+    with ballot_cache_mutex:
+        cached = ballot_cache.get(key)
+
+    if cached is None or cached[0] != data[0][0]['version']:
+        version, ballotitems, candidates, err = build_ballot(user, clubid, eventid)
+        if err is not None:
+            return None, None, err
+
+        cached = (version, ballotitems, candidates)
+
+        # A build that read an older version than one already cached (the event changed while it
+        # was running) doesn't replace it.
+        with ballot_cache_mutex:
+            current = ballot_cache.get(key)
+            if current is None or current[0] <= version:
+                ballot_cache[key] = cached
+
+    _, ballotitems, candidates = cached
+    return ballotitems, {itemid: [dict(c) for c in candidates[itemid]] for itemid in candidates}, None
+
+
+# Move an event's version on after an admin change to its ballot items, candidates or votes.  The version
+# is kept in the database so every process sees the change (see results.py).  Recorded ballots leave it
+# alone, so voting doesn't queue on its row.
+def bump_event_version(clubid, eventid):
+    _, _, err = db.sql(db.statement('ballots_bump_event_version', clubid, eventid), handlekey='system')
+    if err is not None:
+        current_user.logger.error("Failed to update the event version: %s" % err)
+
+
+# Forget an event's ballot definition after its ballot items or candidates change, moving the event's
+# version on so other processes (and the results, which show the ballot) see the change too.
+def invalidate_ballot(clubid, eventid):
+    with ballot_cache_mutex:
+        ballot_cache.pop((clubid, eventid), None)
+
+    bump_event_version(clubid, eventid)
+
 # Show all ballot items for an event.
 def showItems(user):
     try:
@@ -128,6 +261,7 @@ def showItem(user):
 
         itemdata = itemdata[0]
         itemdata['typestr'] = ITEM_TYPES_DICT[itemdata['type']]
+        itemdata['methodstr'] = COUNT_METHODS_DICT[itemdata['method']]
 
         # Fetch any candidates for this contest.
         candidates = {}
@@ -193,6 +327,7 @@ def addItem(user):
                        'description': {"text": "Description", "value": None},
                        'type': {"text": "Type", "value": None},
                        'positions': {"text": "Positions", "value": None},
+                       'method': {"text": "Counting Method", "value": None},
                        'writeins': {"text": "Write-Ins Allowed", "value": False},
                       }
 
@@ -215,8 +350,8 @@ def addItem(user):
                 return render_template('ballots/additem.html', user=user, admins=ADMINS[current_user.event.clubid],
                     name=entryfields['name']['value'], description=entryfields['description']['value'],
                     type=entryfields['type']['value'], positions=entryfields['positions']['value'],
-                    writeins=entryfields['writeins']['value'],
-                    itemtypes=ITEM_TYPES_DICT,
+                    method=entryfields['method']['value'], writeins=entryfields['writeins']['value'],
+                    itemtypes=ITEM_TYPES_DICT, methods=COUNT_METHODS_DICT,
                     configdata=current_user.get_render_data())
 
             for field in entryfields:
@@ -241,6 +376,10 @@ def addItem(user):
                 current_user.logger.debug("Adding a ballot item: Defaulting position count to 1", indent=1)
                 entryfields['positions']['value'] = '1'
 
+            # Contests are counted by plurality unless chosen otherwise.
+            if len(entryfields['method']['value']) == 0:
+                entryfields['method']['value'] = str(COUNT_METHODS.PLURALITY.value)
+
             if saving is True:
                 failed = False
 
@@ -274,6 +413,16 @@ def addItem(user):
                         current_user.logger.flashlog("Add ballot item failure", "Positions must be a number.")
                         failed = True
 
+                if failed is False:
+                    try:
+                        if int(entryfields['method']['value']) not in COUNT_METHODS_DICT.keys():
+                            current_user.logger.flashlog("Add ballot item failure", "Counting method must be a valid method.")
+                            failed = True
+
+                    except:
+                        current_user.logger.flashlog("Add ballot item failure", "Counting method must be a number.")
+                        failed = True
+
                 if failed is False:
                     # The description must also be unique.
                     current_user.logger.debug("Adding a class: Checking class description", indent=1)
@@ -296,16 +445,18 @@ def addItem(user):
                     except:
                         itemid = 1
 
-                    outsql = '''INSERT INTO ballotitems(clubid, eventid, itemid, type, name, description, positions, writeins)
-                                VALUES('%d', '%d', '%d', '%s', '%s', '%s', '%s', '%s');
+                    outsql = '''INSERT INTO ballotitems(clubid, eventid, itemid, type, name, description, positions, method, writeins)
+                                VALUES('%d', '%d', '%d', '%s', '%s', '%s', '%s', '%s', '%s');
                              ''' % (current_user.event.clubid, current_user.event.eventid,
                                    itemid,
                                    entryfields['type']['value'],
                                    entryfields['name']['value'],
                                    entryfields['description']['value'],
                                    entryfields['positions']['value'],
+                                   entryfields['method']['value'],
                                    entryfields['writeins']['value'])
                     _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
+                    invalidate_ballot(current_user.event.clubid, current_user.event.eventid)
 
                     # On error to update the database, return and print out the error (like "System is in read only mode").
                     if err is not None:
@@ -321,6 +472,7 @@ def addItem(user):
 
                     if itemtype == ITEM_TYPES.CONTEST.value:
                         current_user.logger.flashlog(None, "Positions: %s" % entryfields['positions']['value'], 'info', highlight=False, indent=True)
+                        current_user.logger.flashlog(None, "Counting Method: %s" % COUNT_METHODS_DICT[int(entryfields['method']['value'])], 'info', highlight=False, indent=True)
                         current_user.logger.flashlog(None, "Write-ins Allowed: %s" % ("Yes" if entryfields['writeins']['value'] is True else "No"), 'info', highlight=False, indent=True)
 
                     current_user.logger.info("Add ballot item: Operation completed")
@@ -329,8 +481,8 @@ def addItem(user):
         return render_template('ballots/additem.html', user=user, admins=ADMINS[current_user.event.clubid],
                                 name=entryfields['name']['value'], description=entryfields['description']['value'],
                                 type=entryfields['type']['value'], positions=entryfields['positions']['value'],
-                                writeins=entryfields['writeins']['value'],
-                                itemtypes=ITEM_TYPES_DICT,
+                                method=entryfields['method']['value'], writeins=entryfields['writeins']['value'],
+                                itemtypes=ITEM_TYPES_DICT, methods=COUNT_METHODS_DICT,
                                 configdata=current_user.get_render_data())
 
     except Exception as e:
@@ -419,6 +571,7 @@ def editItem(user):
                         'description': {"text": "Description", "value": None},
                         'type': {"text": "Type", "value": None},
                         'positions': {"text": "Positions", "value": None},
+                        'method': {"text": "Counting Method", "value": None},
                         'writeins': {"text": "Write-Ins Allowed", "value": False},
                         }
 
@@ -439,6 +592,10 @@ def editItem(user):
                     # Escape apostrophes.
                     entryfields[field]['value'] = value.replace("'", "''").strip()
 
+        # Contests are counted by plurality unless chosen otherwise.
+        if len(entryfields['method']['value']) == 0:
+            entryfields['method']['value'] = str(COUNT_METHODS.PLURALITY.value)
+
         # Default return renderer.
         # This takes advantage of a couple of things previously retrieved.
         def return_default(msg, entryfields):
@@ -449,8 +606,8 @@ def editItem(user):
                 itemid=itemid,
                 name=entryfields['name']['value'], description=entryfields['description']['value'],
                 type=entryfields['type']['value'], positions=entryfields['positions']['value'],
-                writeins=entryfields['writeins']['value'],
-                itemtypes=ITEM_TYPES_DICT,
+                method=entryfields['method']['value'], writeins=entryfields['writeins']['value'],
+                itemtypes=ITEM_TYPES_DICT, methods=COUNT_METHODS_DICT,
                 configdata=current_user.get_render_data())
 
         saving = False
@@ -501,6 +658,16 @@ def editItem(user):
                         current_user.logger.flashlog("Edit ballot item failure", "Positions must be a number.")
                         failed = True
 
+                if failed is False:
+                    try:
+                        if int(entryfields['method']['value']) not in COUNT_METHODS_DICT.keys():
+                            current_user.logger.flashlog("Edit ballot item failure", "Counting method must be a valid method.")
+                            failed = True
+
+                    except:
+                        current_user.logger.flashlog("Edit ballot item failure", "Counting method must be a number.")
+                        failed = True
+
                 if failed is False:
                     # The description must also be unique.
                     current_user.logger.debug("Editing a ballot item: Checking class description", indent=1)
@@ -525,15 +692,18 @@ def editItem(user):
                                 name='%s',
                                 description='%s',
                                 positions='%s',
+                                method='%s',
                                 writeins='%s'
                             WHERE clubid='%d' AND eventid='%d' AND itemid='%d';
                             ''' % (entryfields['type']['value'],
                                 entryfields['name']['value'],
                                 entryfields['description']['value'],
                                 entryfields['positions']['value'],
+                                entryfields['method']['value'],
                                 entryfields['writeins']['value'],
                                 current_user.event.clubid, current_user.event.eventid, itemid)
                 _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
+                invalidate_ballot(current_user.event.clubid, current_user.event.eventid)
 
                 # On error to update the database, return and print out the error (like "System is in read only mode").
                 if err is not None:
@@ -549,6 +719,7 @@ def editItem(user):
 
                 if itemtype == ITEM_TYPES.CONTEST.value:
                     current_user.logger.flashlog(None, "Positions: %s" % entryfields['positions']['value'], 'info', highlight=False, indent=True)
+                    current_user.logger.flashlog(None, "Counting Method: %s" % COUNT_METHODS_DICT[int(entryfields['method']['value'])], 'info', highlight=False, indent=True)
                     current_user.logger.flashlog(None, "Write-ins Allowed: %s" % ("Yes" if entryfields['writeins']['value'] is True else "No"), 'info', highlight=False, indent=True)
 
                 current_user.logger.info("Edit ballot item: Operation completed")
@@ -559,8 +730,8 @@ def editItem(user):
                                 itemid=itemid,
                                 name=itemdata['name'], description=itemdata['description'],
                                 type=itemdata['type'], positions=itemdata['positions'],
-                                writeins=itemdata['writeins'],
-                                itemtypes=ITEM_TYPES_DICT,
+                                method=itemdata['method'], writeins=itemdata['writeins'],
+                                itemtypes=ITEM_TYPES_DICT, methods=COUNT_METHODS_DICT,
                                 configdata=current_user.get_render_data())
 
     except Exception as e:
@@ -684,6 +855,7 @@ def removeItem(user):
                              WHERE clubid='%d' AND eventid='%d' AND itemid='%d';
                           ''' % (current_user.event.clubid, current_user.event.eventid, itemid))
             _, _, err = db.sql(outsql, handlekey=user)
+            invalidate_ballot(current_user.event.clubid, current_user.event.eventid)
 
             if err is not None:
                 current_user.logger.flashlog("Remove ballot item failure", "Failed to remove ballot item data:", highlight=True)
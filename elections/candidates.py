@@ -13,7 +13,57 @@ from flask_login import current_user
 from elections import db, app
 from elections import ADMINS
 
-from elections.ballotitems import ITEM_TYPES, ITEM_TYPES_DICT
+from elections.ballotitems import ITEM_TYPES, ITEM_TYPES_DICT, invalidate_ballot
+from elections.events import EventConfig
+import elections.tallies as tallies
+import elections.results as results
+
+# Write-in candidates whose names are close to another candidate's in the same contest, by trigram
+# similarity of the name keys, each with the candidate it would be merged into: a preconfigured
+# candidate, or else the write-in with more votes (the lower ID if even).  The best match is kept.
+# The % operator finds the pairs through the trigram index; pairs below pg_trgm's own similarity
+# threshold (0.3 by default) are never found.
+db.register_statement('candidates_similar', '''SELECT DISTINCT ON (a.id) a.itemid, ballotitems.name AS contest, a.id, a.fullname,
+                                                      COALESCE(at.votecount, 0) AS votecount,
+                                                      b.id AS targetid, b.fullname AS targetname, b.writein AS targetwritein,
+                                                      COALESCE(bt.votecount, 0) AS targetvotecount,
+                                                      similarity(a.namekey, b.namekey) AS similarity
+                                               FROM candidates AS a
+                                               JOIN candidates AS b ON b.clubid=a.clubid AND b.eventid=a.eventid AND b.itemid=a.itemid
+                                                                       AND b.id!=a.id AND b.namekey % a.namekey
+                                               JOIN ballotitems ON ballotitems.clubid=a.clubid AND ballotitems.eventid=a.eventid
+                                                                   AND ballotitems.itemid=a.itemid
+                                               LEFT JOIN vote_tallies AS at ON at.clubid=a.clubid AND at.eventid=a.eventid
+                                                                               AND at.itemid=a.itemid AND at.answer=a.id
+                                               LEFT JOIN vote_tallies AS bt ON bt.clubid=b.clubid AND bt.eventid=b.eventid
+                                                                               AND bt.itemid=b.itemid AND bt.answer=b.id
+                                               WHERE a.clubid=$1 AND a.eventid=$2 AND a.writein=True
+                                                     AND similarity(a.namekey, b.namekey) >= $3
+                                                     AND (b.writein=False OR COALESCE(bt.votecount, 0) > COALESCE(at.votecount, 0)
+                                                          OR (COALESCE(bt.votecount, 0) = COALESCE(at.votecount, 0) AND b.id < a.id))
+                                               ORDER BY a.id ASC, b.writein ASC, similarity DESC, targetvotecount DESC, b.id ASC''')
+
+
+# Statements that merge candidates into another in the same contest: their votes become votes for
+# the target and the candidates are removed.  A ballot that chose the target as well keeps only
+# its best ranked choice of them.  The tallies must be rebuilt afterwards.
+def merge_sql(clubid, eventid, itemid, targetid, sourceids):
+    sources = ', '.join(['%d' % s for s in sourceids])
+
+    return ['''UPDATE votes SET answer='%d'
+               WHERE clubid='%d' AND eventid='%d' AND itemid='%d' AND answer IN (%s);
+            ''' % (targetid, clubid, eventid, itemid, sources),
+            '''DELETE FROM votes AS v
+               USING votes AS w
+               WHERE v.clubid='%d' AND v.eventid='%d' AND v.itemid='%d' AND v.answer='%d'
+                     AND w.clubid=v.clubid AND w.eventid=v.eventid AND w.itemid=v.itemid
+                     AND w.ballotid=v.ballotid AND w.answer=v.answer
+                     AND (w.rank < v.rank OR (w.rank = v.rank AND w.id < v.id));
+            ''' % (clubid, eventid, itemid, targetid),
+            '''DELETE FROM candidates
+               WHERE clubid='%d' AND eventid='%d' AND itemid='%d' AND id IN (%s);
+            ''' % (clubid, eventid, itemid, sources)]
+
 
 # Show candidates for ballot contests.
 def showCandidates(user):
@@ -169,7 +219,7 @@ def addCandidate(user, details=None):
                         outsql = '''SELECT *
                                     FROM candidates
                                     WHERE clubid='%d' AND eventid='%d' AND
-                                        itemid='%d' AND fullname='%s';
+                                        itemid='%d' AND namekey=candidate_namekey('%s');
                                     ''' % (current_user.event.clubid, current_user.event.eventid, itemid, fullname)
                         _, data, _ = db.sql(outsql, handlekey=user)
 
@@ -184,6 +234,7 @@ def addCandidate(user, details=None):
                                  ''' % (current_user.event.clubid, current_user.event.eventid, itemid,
                                         entryfields['firstname']['value'], entryfields['lastname']['value'], fullname)
                         _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
+                        invalidate_ballot(current_user.event.clubid, current_user.event.eventid)
 
                         # On error to update the database, return and print out the error (like "System is in read only mode").
                         if err is not None:
@@ -381,7 +432,7 @@ def editCandidate(user):
                         outsql = '''SELECT *
                                     FROM candidates
                                     WHERE clubid='%d' AND eventid='%d' AND
-                                          itemid='%d' AND fullname='%s' AND id!='%d';
+                                          itemid='%d' AND namekey=candidate_namekey('%s') AND id!='%d';
                                     ''' % (current_user.event.clubid, current_user.event.eventid, candidate['itemid'], fullname, candidate['id'])
                         _, data, _ = db.sql(outsql, handlekey=user)
 
@@ -400,6 +451,7 @@ def editCandidate(user):
                                     ''' % (entryfields['firstname']['value'], entryfields['lastname']['value'], fullname,
                                            current_user.event.clubid, current_user.event.eventid, candidate['id'])
                             _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
+                            invalidate_ballot(current_user.event.clubid, current_user.event.eventid)
 
                             # On error to update the database, return and print out the error (like "System is in read only mode").
                             if err is not None:
@@ -601,6 +653,7 @@ def removeCandidate(user):
                                 WHERE clubid='%d' AND eventid='%d' AND itemid='%s' AND id='%s';
                               ''' % (current_user.event.clubid, current_user.event.eventid, itemid, candidate['id'])
                 _, _, err = db.sql(outsql, handlekey=user)
+                invalidate_ballot(current_user.event.clubid, current_user.event.eventid)
 
                 if err is not None:
                     current_user.logger.flashlog("Remove candidate failure", "Failed to remove candidate data:", highlight=True)
@@ -624,3 +677,119 @@ def removeCandidate(user):
 
         # Redirect to the main page to display the exception and prevent recursive loops.
         return redirect(url_for('main_bp.index'))
+
+
+# Merge write-in candidates into candidates with similar names.
+# Voters spell write-in names many ways, so each write-in whose name is close to another candidate's
+# in its contest (see WRITEIN_MATCH_SIMILARITY) is listed with the candidate it would merge into, and
+# the checked ones are merged in one transaction with the tallies recounted.  A write-in merging into
+# another write-in that is itself merged goes on to that one's target.
+def mergeWriteins(user):
+    try:
+        # Since these buttons are in the form area on this page, we have to handle in code.
+        option = request.values.get('redirect')
+        if option is not None:
+            return redirect(url_for('main_bp.%s' % option))
+
+        if request.values.get('cancelbutton'):
+            current_user.logger.flashlog(None, "Merge write-in candidates operation canceled.", 'info')
+            return redirect(url_for('main_bp.mergewriteins'))
+
+        current_user.logger.info("Displaying: Merge write-in candidates")
+
+        clubid = current_user.event.clubid
+        eventid = current_user.event.eventid
+
+        # Find the write-ins with similar names.
+        current_user.logger.debug("Merging write-in candidates: Finding similar names", indent=1)
+        _, data, err = db.sql(db.statement('candidates_similar', clubid, eventid, app.config.get('WRITEIN_MATCH_SIMILARITY')), handlekey=user)
+
+        if err is not None:
+            current_user.logger.flashlog("Merge write-ins failure", err)
+            matches = []
+        else:
+            matches = sorted(data[0], key=lambda m: (m['itemid'], m['fullname'].lower()))
+
+        # Check if the event is locked.
+        if current_user.event.locked is True:
+            current_user.logger.flashlog("Merge write-ins failure", "This Event is locked and cannot merge candidates.")
+
+        elif request.values.get('savebutton'):
+            current_user.logger.debug("Merging write-in candidates: Saving changes requested", indent=1)
+
+            # Each checkbox holds the target it was shown with; if the best match has changed since
+            # (from votes or another merge), the write-in is left for the admin to look at again.
+            selected = {}
+            for m in matches:
+                value = request.values.get('merge_%d' % m['id'], None)
+                if value is None:
+                    continue
+
+                if value != str(m['targetid']):
+                    current_user.logger.flashlog("Merge write-ins failure", "The match for '%s' has changed and it was not merged." % m['fullname'])
+                    continue
+
+                selected[m['id']] = m
+
+            if len(selected) == 0:
+                current_user.logger.flashlog("Merge write-ins failure", "No write-in candidates were merged.")
+                return redirect(url_for('main_bp.mergewriteins'))
+
+            # Group the write-ins by their final target.
+            merges = {}
+            for m in selected.values():
+                target = m
+                while target['targetid'] in selected:
+                    target = selected[target['targetid']]
+
+                merges.setdefault((m['itemid'], m['contest'], target['targetid'], target['targetname']), []).append(m)
+
+            # The event's exclusive lock holds off ballots being recorded (add_ballot() takes it shared)
+            # until the merge is done; a ballot read before the merge that votes for a merged-away
+            # candidate is then refused.
+            outsql = [EventConfig._lock_sql(clubid, eventid, exclusive=True)]
+            for (itemid, _, targetid, _), sources in merges.items():
+                outsql.extend(merge_sql(clubid, eventid, itemid, targetid, [s['id'] for s in sources]))
+
+            outsql.extend(tallies.rebuild_sql(clubid, eventid))
+
+            current_user.logger.debug("Merging write-in candidates: Merging %d candidates" % len(selected), indent=1)
+            _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
+            invalidate_ballot(clubid, eventid)
+
+            # On error to update the database, return and print out the error (like "System is in read only mode").
+            if err is not None:
+                current_user.logger.flashlog("Merge write-ins failure", err)
+            else:
+                results.results_changed(clubid, eventid)
+
+                for (_, contest, _, targetname), sources in merges.items():
+                    current_user.logger.flashlog(None, "Merged into '%s' for ballot contest '%s':" % (targetname, contest), 'info', propagate=True)
+                    for s in sources:
+                        current_user.logger.flashlog(None, "%s (%d votes)" % (s['fullname'], s['votecount']), 'info', highlight=False, indent=True, propagate=True)
+
+                current_user.logger.info("Merge write-in candidates: Operation completed")
+
+            return redirect(url_for('main_bp.mergewriteins'))
+
+        # Group the matches by contest for display.
+        contests = []
+        for m in matches:
+            m['percent'] = int(round(m['similarity'] * 100))
+
+            if len(contests) == 0 or contests[-1]['itemid'] != m['itemid']:
+                contests.append({'itemid': m['itemid'], 'name': m['contest'], 'matches': []})
+
+            contests[-1]['matches'].append(m)
+
+        return render_template('candidates/mergewriteins.html', user=user, admins=ADMINS[current_user.event.clubid],
+                                contests=contests,
+                                configdata=current_user.get_render_data())
+
+    except Exception as e:
+        current_user.logger.flashlog("Merge write-ins failure", "Exception: %s" % str(e), propagate=True)
+        current_user.logger.error("Unexpected exception:")
+        current_user.logger.error(traceback.format_exc())
+
+        # Redirect to the main page to display the exception and prevent recursive loops.
+        return redirect(url_for('main_bp.index'))
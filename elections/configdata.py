@@ -12,6 +12,7 @@ import collections
 import json
 import re
 import shutil
+import csv
 
 from elections import app, db
 from elections import ADMINS
@@ -19,8 +20,10 @@ from elections import ADMINS
 # Fetch event config.
 import elections.events as events
 from elections.events import EventConfig
-from elections.ballotitems import ITEM_TYPES
+from elections.ballotitems import ITEM_TYPES, COUNT_METHODS, COUNT_METHODS_DICT, invalidate_ballot, name_key
 from elections.clubs import isValidEmail
+import elections.tallies as tallies
+import elections.results as results
 
 from flask import redirect, render_template, url_for, request, session
 from flask_login import current_user
@@ -34,29 +37,49 @@ VALID_TRUE_FALSE_VALUE_STR = "true/false, y/n or 1/0"
 VALID_TRUE_VALUES = ['true', 'y', '1', True]
 
 ALLOWED_EXTENSIONS = set(['xlsx'])
-def allowed_file(filename):
-	return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def allowed_file(filename, extensions=ALLOWED_EXTENSIONS):
+	return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
+
+# Paper ballot files (see readBallotData()) and member lists (see readMemberData()) may also be CSV.
+BALLOT_EXTENSIONS = set(['xlsx', 'csv'])
 
 
 # Export data versions.
 # 1 - original
-EXPORT_VERSION = 1
+# 2 - ballot item counting method and vote ranks
+EXPORT_VERSION = 2
 
 # All sheets to import/export.  This and SHEET_KEYS must be kept in sync to ensure data are processed correctly.
 # This will have one entry per version.  Index 0 is empty.
 ALL_SHEETS = [ [],
+               ['events', 'ballotitems', 'candidates', 'voters', 'votes', 'vote_ballotid'],
                ['events', 'ballotitems', 'candidates', 'voters', 'votes', 'vote_ballotid']
              ]
 
 # Keys per sheet that we expect if the sheet is present.
 SHEET_KEYS = {"events":               ['property', 'value'],
-              "ballotitems":          ['itemid', 'type', 'name', 'description', 'positions', 'writeins'],
+              "ballotitems":          [[],
+                                       ['itemid', 'type', 'name', 'description', 'positions', 'writeins'],
+                                       ['itemid', 'type', 'name', 'description', 'positions', 'method', 'writeins']
+                                      ],
               "candidates":           ['id', 'itemid', 'firstname', 'lastname', 'fullname', 'writein'],
               "voters":               ['firstname', 'lastname', 'fullname', 'email', 'voteid', 'voted'],
-              "votes":                ['itemid', 'ballotid', 'answer', 'commentary'],
+              "votes":                [[],
+                                       ['itemid', 'ballotid', 'answer', 'commentary'],
+                                       ['itemid', 'ballotid', 'answer', 'rank', 'commentary']
+                                      ],
               "vote_ballotid":        ['ballotid'],
              }
 
+# Keys we expect in a paper ballot sheet; every other column is a ballot item.
+BALLOT_SHEET_KEYS = ['voterid']
+
+# Keys we expect in a member list for generating voters; an 'email' column is optional.
+MEMBER_SHEET_KEYS = ['firstname', 'lastname']
+
+# Columns of the voter ID sheet given out after generating voters.
+VOTER_ID_SHEET_KEYS = ['firstname', 'lastname', 'fullname', 'email', 'voteid']
+
 # Custom import parsing exceptions.
 class ImportParseError(Exception):
     pass
@@ -229,10 +252,13 @@ def buildExportFile(user, fetchresults=False):
                          ORDER BY id ASC;
                       ''' % (event.clubid, event.eventid))
 
-        outsql.append('''SELECT *
+        # The last ballot ID handed out comes from the event's sequence.
+        outsql.append('''SELECT vote_ballotid.clubid, vote_ballotid.eventid,
+                                GREATEST(vote_ballotid.ballotid, pg_sequences.last_value) AS ballotid
                          FROM vote_ballotid
+                         LEFT JOIN pg_sequences ON pg_sequences.sequencename='%s'
                          WHERE clubid='%d' AND eventid='%d';
-                      ''' % (event.clubid, event.eventid))
+                      ''' % (events.ballotid_sequence(event.eventid), event.clubid, event.eventid))
 
         if fetchresults is True:
             current_user.logger.debug("Exporting event data: Including results", indent=1)
@@ -486,6 +512,12 @@ def reset_app_data(user, clear_config=True, clear_only_votes=False):
 
         err = events.remove_event_data(user, event.clubid, event.eventid, clear_config=clear_config, votes_only=clear_only_votes)
 
+        # Restarting only clears votes; anything more clears the ballot.
+        if clear_only_votes is False:
+            invalidate_ballot(event.clubid, event.eventid)
+
+        results.results_changed(event.clubid, event.eventid)
+
         # On error to update the database, return and print out the error (like "System is in read only mode").
         if err is not None:
             return err
@@ -747,89 +779,9 @@ def readImportData(filepath):
 
     # Read a worksheet into a list of dict entries.
     def read_sheet(ws, sheetname, sheetversion):
-        sheetdata = []
-        header_row = None
-
-        sheet_keys = get_sheet_keys(sheetname, sheetversion)
-
-        # Row iterator to emulate a list per-row.
-        def iter_rows(ws):
-            for row in ws.iter_rows():
-                yield [cell.value for cell in row]
-
-        rows = list(iter_rows(ws))
-
-        # Get the header row.
-        def get_header_row():
-            # We expect the header row to be row 1.
-            # A quick check is to look at the first key and see if
-            # it is in the row.
-            row = rows[0]
-            if sheet_keys[0] in row:
-                header_row = row
-            else:
-                header_row = None
-
-            return header_row
-
-        # Look for all sheet keys.
-        def check_sheet_keys():
-            key_errors = []
-            # We want to know that all the expected keys in the sheet
-            # are in the header.  Any extra keys will be ignored.
-            if not all(k in header_row for k in sheet_keys):
-                missing_keys = list(set(sheet_keys).difference(header_row))
-                key_errors.append("Sheet '%s': Missing columns '%s'" % (sheetname, ','.join(missing_keys)))
-
-            # Also check for duplicate keys.
-            counts = collections.Counter(header_row)
-            for c in counts:
-                if counts[c] != 1:
-                    key_errors.append("Sheet '%s': Duplicate column '%s'" % (sheetname, c))
-
-            # Return any errors, or None for A-OK.
-            if len(key_errors) > 0:
-                return key_errors
-
-            # We are guaranteed that all keys are present and not duplicated.
-            return None
-
-        # Check that there is a header row.
-        header_row = get_header_row()
-        if header_row is None:
-            return None, ["Sheet '%s': Missing header row" % sheet]
-
-        # Check that the keys we need are all present and unique.
-        key_errors = check_sheet_keys()
-        if key_errors is not None:
-            return None, key_errors
-
-        # Get the row data.
-        for row in rows[1:]:
-            # Read the row and assign the content to the dict.
-            # The keys may be out-of-order, so we need the index
-            # of each from the header row.  We force to string
-            # and strip them for tidiness.
-            rowdata = {}
-            for key in sheet_keys:
-                colindex = header_row.index(key)
-
-                if row[colindex] is None:
-                    rowdata[key] = None
-                else:
-                    rowdata[key] = str(row[colindex]).strip()
+        rows = [[cell.value for cell in row] for row in ws.iter_rows()]
 
-            # If the row is blank, skip it.
-            add = False
-            for key in sheet_keys:
-                if rowdata[key] is not None and len(rowdata[key]) != 0:
-                    add = True
-                    break
-
-            if add is True:
-                sheetdata.append(rowdata)
-
-        return sheetdata, None
+        return read_sheet_rows(rows, sheetname, get_sheet_keys(sheetname, sheetversion))
 
 
     # For file load, all we want are the sheets that are available and to read them
@@ -890,6 +842,167 @@ def readImportData(filepath):
     return data, sheetversion
 
 
+# Read a sheet's rows (lists of cell values, header row first) into a list of dict entries.
+# If all_columns is set, every column with a header is read, not just the sheet keys.
+# If row_key is given, each entry also gets its row number in the sheet under that key.
+# Returns the entries and None, or None and a list of errors.
+def read_sheet_rows(rows, sheetname, sheet_keys, all_columns=False, row_key=None):
+    sheetdata = []
+    header_row = None
+
+    # Get the header row.
+    def get_header_row():
+        # We expect the header row to be row 1.
+        # A quick check is to look at the first key and see if
+        # it is in the row.
+        if len(rows) > 0 and sheet_keys[0] in rows[0]:
+            return rows[0]
+
+        return None
+
+    # Look for all sheet keys.
+    def check_sheet_keys():
+        key_errors = []
+        # We want to know that all the expected keys in the sheet
+        # are in the header.  Any extra keys will be ignored.
+        if not all(k in header_row for k in sheet_keys):
+            missing_keys = list(set(sheet_keys).difference(header_row))
+            key_errors.append("Sheet '%s': Missing columns '%s'" % (sheetname, ','.join(missing_keys)))
+
+        # Also check for duplicate keys.
+        counts = collections.Counter(header_row)
+        for c in counts:
+            if c is not None and counts[c] != 1:
+                key_errors.append("Sheet '%s': Duplicate column '%s'" % (sheetname, c))
+
+        # Return any errors, or None for A-OK.
+        if len(key_errors) > 0:
+            return key_errors
+
+        # We are guaranteed that all keys are present and not duplicated.
+        return None
+
+    # Check that there is a header row.
+    header_row = get_header_row()
+    if header_row is None:
+        return None, ["Sheet '%s': Missing header row" % sheetname]
+
+    # Check that the keys we need are all present and unique.
+    key_errors = check_sheet_keys()
+    if key_errors is not None:
+        return None, key_errors
+
+    keys = sheet_keys
+    if all_columns is True:
+        keys = [k for k in header_row if k is not None and len(str(k)) > 0]
+
+    # Get the row data.
+    for rownum, row in enumerate(rows[1:], start=2):
+        # Read the row and assign the content to the dict.
+        # The keys may be out-of-order, so we need the index
+        # of each from the header row.  We force to string
+        # and strip them for tidiness.  Short rows (from CSV files)
+        # are missing their last cells.
+        rowdata = {}
+        for key in keys:
+            colindex = header_row.index(key)
+
+            if colindex >= len(row) or row[colindex] is None:
+                rowdata[key] = None
+            else:
+                rowdata[key] = str(row[colindex]).strip()
+
+        # If the row is blank, skip it.
+        add = False
+        for key in keys:
+            if rowdata[key] is not None and len(rowdata[key]) != 0:
+                add = True
+                break
+
+        if add is True:
+            if row_key is not None:
+                rowdata[row_key] = rownum
+
+            sheetdata.append(rowdata)
+
+    return sheetdata, None
+
+
+# Read the rows of an uploaded CSV (comma or tab separated, as pasted from a spreadsheet) or XLSX file
+# (the named sheet, or else the first sheet) into a list of dict entries, with the header row's keys.
+# Each entry also has its row number under 'row'.
+def read_upload_rows(filepath, sheetname, sheet_keys, logname):
+    # The file must exist.
+    if filepath is None or not os.path.exists(filepath):
+        raise IOError("File not found")
+
+    try:
+        if filepath.lower().endswith('.csv'):
+            with open(filepath, newline='', encoding='utf-8-sig') as f:
+                lines = f.read().splitlines()
+
+            dialect = csv.excel_tab if len(lines) > 0 and '\t' in lines[0] else csv.excel
+            rows = [[v if len(v.strip()) > 0 else None for v in row] for row in csv.reader(lines, dialect)]
+        else:
+            wb = openpyxl.load_workbook(filename=filepath, data_only=True, read_only=True)
+            ws = wb[sheetname] if sheetname in wb.sheetnames else wb.worksheets[0]
+            rows = [list(row) for row in ws.iter_rows(values_only=True)]
+
+    except Exception as e:
+        # The errors are not clear here, so we catch it and raise an IOError for ourselves.
+        raise IOError("Invalid file format")
+
+    # Item IDs read from a spreadsheet are numbers, and headers may be typed in any case.
+    if len(rows) > 0:
+        rows[0] = [None if h is None else str(h).strip().lower() for h in rows[0]]
+
+    sheetdata, errors = read_sheet_rows(rows, sheetname, sheet_keys, all_columns=True, row_key='row')
+    if errors is not None:
+        for error in errors:
+            current_user.logger.error("Reading %s: %s" % (logname, error))
+
+        raise ImportParseError(errors)
+
+    return sheetdata
+
+
+# Read a file of paper ballots into a list of dict entries, one per ballot.
+# The file is CSV or XLSX (the 'ballots' sheet, or else the first sheet).  The header row has 'voterid'
+# and then one column per ballot item, headed by the item ID.
+def readBallotData(filepath):
+    current_user.logger.info("Enter ballots: Reading data", propagate=True)
+
+    return read_upload_rows(filepath, 'ballots', BALLOT_SHEET_KEYS, 'ballot data')
+
+
+# Read a member list into a list of dict entries, one per member.
+# The file is CSV or XLSX (the 'members' sheet, or else the first sheet).  The header row has
+# 'firstname', 'lastname' and optionally 'email'.
+def readMemberData(filepath):
+    current_user.logger.info("Generate voters: Reading member list", propagate=True)
+
+    return read_upload_rows(filepath, 'members', MEMBER_SHEET_KEYS, 'member list')
+
+
+# Write a voter ID sheet for the given voters to the export folder, for download through the
+# export file route.  Returns the file name.
+def writeVoterIdFile(event, voters):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'voters'
+    fill_sheet(ws, voters, VOTER_ID_SHEET_KEYS)
+
+    filepath = os.path.join(os.getcwd(), app.config.get('EXPORT_DOWNLOAD_FOLDER'))
+    if not os.path.exists(filepath):
+        current_user.logger.info("Generate voters: Created export data directory '%s'" % filepath, indent=1, propagate=True)
+        os.makedirs(filepath)
+
+    filename = 'election_%d_%d_voterids.xlsx' % (event.clubid, event.eventid)
+    wb.save(os.path.join(filepath, filename))
+
+    return filename
+
+
 # Validate the import data.
 # If called to validate-only, it affects the output messages on failure.
 # Once called to validate, we're assured the data will be good - but we'll validate again
@@ -1227,7 +1340,7 @@ def validateBallotItems(data, appdata):
 
             # Check type and range where appropriate.
             if value is not None:
-                if key in ['itemid', 'type', 'positions']:
+                if key in ['itemid', 'type', 'positions', 'method']:
                     try:
                         value = int(value)
 
@@ -1241,6 +1354,11 @@ def validateBallotItems(data, appdata):
                             if not value_in_range(value, 1, 2):
                                 errors.append("Ballot Items: Row %d: Value for column '%s' is invalid (%d) (range: 1 - %d)" % (index, key, value, typecount))
 
+                        elif key in ['method']:
+                            methodcount = len(COUNT_METHODS_DICT)
+                            if not value_in_range(value, 1, methodcount):
+                                errors.append("Ballot Items: Row %d: Value for column '%s' is invalid (%d) (range: 1 - %d)" % (index, key, value, methodcount))
+
                     except:
                         errors.append("Ballot Items: Row %d: Value for column '%s' must be an integer" % (index, key))
 
@@ -1281,6 +1399,7 @@ def validateBallotItems(data, appdata):
                     'name': b['name'],
                     'description': b['description'],
                     'positions': b['positions'],
+                    'method': b['method'],
                     'writeins': b['writeins']
                    }
             items[b['itemid']] = item
@@ -1358,9 +1477,10 @@ def validateCandidates(data, appdata):
             if last != c['lastname']:
                 errors.append("Candidates: Row %d: Last name '%s' does not match full name" % (index, c['lastname']))
 
+        # Names are compared ignoring case and spacing, as the database does.
         for c in candidates:
             idlist.append(c['id'])
-            namelist.append(c['fullname'])
+            namelist.append(name_key(c['fullname']))
 
         for index, name in enumerate(namelist, start=2):
             if idlist.count(name) > 1:
@@ -1368,7 +1488,7 @@ def validateCandidates(data, appdata):
 
         for index, name in enumerate(namelist, start=2):
             if namelist.count(name) > 1:
-                errors.append("Candidates: Row %d: Name '%s' is duplicated" % (index, name))
+                errors.append("Candidates: Row %d: Name '%s' is duplicated" % (index, candidates[index - 2]['fullname']))
 
     # If all checks out, save the ballot items as a dict for future validation.
     if len(errors) == 0:
@@ -1482,7 +1602,7 @@ def validateVotes(data, appdata):
 
                 # Check type and range where appropriate.
                 if value is not None:
-                    if key in ['ballotid', 'itemid', 'answer']:
+                    if key in ['ballotid', 'itemid', 'answer', 'rank']:
                         try:
                             value = int(value)
 
@@ -1491,6 +1611,11 @@ def validateVotes(data, appdata):
                                 if value < 0:
                                     errors.append("Votes: Row %d: Value for column '%s' is invalid (%d)" % (index, key, value))
 
+                            # Ranks start at 1.
+                            elif key in ['rank']:
+                                if value < 1:
+                                    errors.append("Votes: Row %d: Value for column '%s' is invalid (%d)" % (index, key, value))
+
                         except:
                             errors.append("Votes: Row %d: Value for column '%s' must be an integer" % (index, key))
 
@@ -1535,6 +1660,10 @@ def validateVotes(data, appdata):
                 itemid = ballotitem['itemid']
                 itemtype = int(ballotitem['type'])
 
+                # Ranked contests may rank every candidate.
+                if itemtype == ITEM_TYPES.CONTEST.value and int(ballotitem['method']) == COUNT_METHODS.RANKED.value:
+                    continue
+
                 if itemtype == ITEM_TYPES.CONTEST.value:
                     positions = int(ballotitem['positions'])
 
@@ -1563,6 +1692,14 @@ def convertImportedData(data, sheetversion):
     while sheetversion < EXPORT_VERSION:
         current_user.logger.info("Converting import data version '%d' to '%d'..." % (sheetversion, (sheetversion + 1)), indent=2)
 
+        # Version 2: contests are counted by plurality and every vote is a first choice.
+        if sheetversion + 1 == 2:
+            for b in data.get('ballotitems', []):
+                b['method'] = str(COUNT_METHODS.PLURALITY.value)
+
+            for v in data.get('votes', []):
+                v['rank'] = '1'
+
         sheetversion += 1
 
     current_user.logger.info("Data conversion completed.", indent=1)
@@ -1619,8 +1756,10 @@ def importValidatedData(data, validationdata, user):
 
     # ====================================
     # Build all the INSERTs.
+    # Table rows are bulk loaded; values are passed through as-is, so no apostrophe escaping.
     # ====================================
     outsql = []
+    loads = []
 
     def log_import_item(item, itemdata):
         current_user.logger.info("-> %-20s: %s" % (item, itemdata), indent=2)
@@ -1655,62 +1794,68 @@ def importValidatedData(data, validationdata, user):
                     (imported_event.clubid, imported_event.eventid, imported_event.title, imported_event.icon, imported_event.homeimage, imported_event.eventdatetime))
 
     current_user.logger.debug("Importing ballot items...", indent=1)
+    rows = []
     for b in ballotitems:
-        # Escape apostrophes.
-        name = b['name'].replace("'", "''").strip()
-        description = b['description'].replace("'", "''").strip()
+        name = b['name'].strip()
+        description = b['description'].strip()
 
         # Add each ballot item.
-        outsql.append('''INSERT INTO ballotitems (clubid, eventid, itemid, type, name, description, positions, writeins)
-                         VALUES('%d', '%d', '%s', '%s', '%s', '%s', '%s', '%s')
-                      ''' % (imported_event.clubid, imported_event.eventid,
-                             b['itemid'], b['type'], name, description, b['positions'], b['writeins']))
+        rows.append((imported_event.clubid, imported_event.eventid,
+                     b['itemid'], b['type'], name, description, b['positions'], b['method'], b['writeins']))
+
+        log_import_item("ballotitems", "%s" % ', '.join([b['itemid'], b['type'], name, description, b['positions'], b['method'], b['writeins']]))
 
-        log_import_item("ballotitems", "%s" % ', '.join([b['itemid'], b['type'], name, description, b['positions'], b['writeins']]))
+    loads.append(db.BulkLoad('ballotitems', ['clubid', 'eventid', 'itemid', 'type', 'name', 'description', 'positions', 'method', 'writeins'], rows))
 
     current_user.logger.debug("Importing candidate...", indent=1)
+    rows = []
     for c in candidates:
-        # Escape apostrophes.
-        firstname = c['firstname'].replace("'", "''").strip()
-        lastname = c['lastname'].replace("'", "''").strip()
-        fullname = c['fullname'].replace("'", "''").strip()
+        firstname = c['firstname'].strip()
+        lastname = c['lastname'].strip()
+        fullname = c['fullname'].strip()
 
         # Add each candidate.
-        outsql.append('''INSERT INTO candidates (clubid, eventid, id, itemid, firstname, lastname, fullname, writein)
-                         VALUES('%d', '%d', '%s', '%s', '%s', '%s', '%s', '%s')
-                      ''' % (imported_event.clubid, imported_event.eventid,
-                             c['id'], c['itemid'], firstname, lastname, fullname, c['writein']))
+        rows.append((imported_event.clubid, imported_event.eventid,
+                     c['id'], c['itemid'], firstname, lastname, fullname, c['writein']))
 
         log_import_item("candidates", "%s" % ', '.join([c['id'], c['itemid'], firstname, lastname, fullname, c['writein']]))
 
+    loads.append(db.BulkLoad('candidates', ['clubid', 'eventid', 'id', 'itemid', 'firstname', 'lastname', 'fullname', 'writein'], rows))
+
     if voters is not None:
         current_user.logger.debug("Importing voters...", indent=1)
+        rows = []
         for v in voters:
-            # Escape apostrophes.
-            firstname = v['firstname'].replace("'", "''").strip()
-            lastname = v['lastname'].replace("'", "''").strip()
-            fullname = v['fullname'].replace("'", "''").strip()
+            firstname = v['firstname'].strip()
+            lastname = v['lastname'].strip()
+            fullname = v['fullname'].strip()
 
             # Add each voter.
-            outsql.append('''INSERT INTO voters (clubid, eventid, firstname, lastname, fullname, email, voteid, voted)
-                            VALUES('%d', '%d', '%s', '%s', '%s', '%s', '%s', '%s')
-                        ''' % (imported_event.clubid, imported_event.eventid,
-                                firstname, lastname, fullname, v['email'], v['voteid'], v['voted']))
+            rows.append((imported_event.clubid, imported_event.eventid,
+                         firstname, lastname, fullname, v['email'], v['voteid'], v['voted']))
 
             log_import_item("voters", "%s" % ', '.join([firstname, lastname, fullname, v['email'], v['voteid'], v['voted']]))
 
+        loads.append(db.BulkLoad('voters', ['clubid', 'eventid', 'firstname', 'lastname', 'fullname', 'email', 'voteid', 'voted'], rows))
+
     if votes is not None:
         current_user.logger.debug("Importing votes...", indent=1)
+        rows = []
         for v in votes:
             commentary = '' if (v['commentary'] in [None, 'None'] or len(v['commentary']) == 0) else '%s' % v['commentary']
 
             # Add each vote.
-            outsql.append('''INSERT INTO votes (clubid, eventid, itemid, ballotid, answer, commentary)
-                            VALUES('%d', '%d', '%s', '%s', '%s', '%s')
-                        ''' % (imported_event.clubid, imported_event.eventid,
-                                v['itemid'], v['ballotid'], v['answer'], v['commentary']))
+            rows.append((imported_event.clubid, imported_event.eventid,
+                         v['itemid'], v['ballotid'], v['answer'], v['rank'], commentary))
 
-            log_import_item("votes", "%s" % ', '.join([v['itemid'], v['ballotid'], v['answer'], commentary]))
+            log_import_item("votes", "%s" % ', '.join([v['itemid'], v['ballotid'], v['answer'], v['rank'], commentary]))
+
+        loads.append(db.BulkLoad('votes', ['clubid', 'eventid', 'itemid', 'ballotid', 'answer', 'rank', 'commentary'], rows))
+
+    outsql.extend(loads)
+
+    # Count the imported votes.
+    outsql.extend(tallies.rebuild_sql(imported_event.clubid, imported_event.eventid))
 
     # ====================================
     # Ballot things.
@@ -1723,6 +1868,7 @@ def importValidatedData(data, validationdata, user):
                     SET ballotid='%s'
                     WHERE clubid='%d' AND eventid='%d';
                 ''' % (imported_event.ballotid, imported_event.clubid, imported_event.eventid))
+    outsql.extend(events.set_ballotid_sql(imported_event.eventid, imported_event.ballotid))
 
     log_import_item("vote_ballotid", "%s" % imported_event.ballotid)
 
@@ -1745,12 +1891,19 @@ def importValidatedData(data, validationdata, user):
     try:
         current_user.logger.info("Importing event data...", indent=1, propagate=True)
         _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
+        invalidate_ballot(imported_event.clubid, imported_event.eventid)
+        results.results_changed(imported_event.clubid, imported_event.eventid)
         if err is not None:
             current_user.logger.flashlog("Data Import failure", "Failed to import event data:", propagate=True)
             current_user.logger.flashlog("Data Import failure", err, propagate=True)
 
             return redirect(url_for('main_bp.importdata'))
 
+        # Report the load rate for each table.
+        for load in loads:
+            current_user.logger.info("-> %-20s: %d rows in %.3f sec (%d rows/sec, %s)" %
+                                     (load.table, load.count, load.elapsed, load.rate(), load.method), indent=2, propagate=True)
+
     except Exception as e:
         current_user.logger.flashlog("Data Import failure", "Failed to import event data:", propagate=True)
         current_user.logger.flashlog("Data Import failure", str(e).capitalize(), propagate=True)
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+#   Copyright 2021-2022 Steve Strublic
+#
+#   This work is the personal property of Steve Strublic, and as such may not be
+#   used, distributed, or modified without my express consent.
+
+import numpy as np
+
+# Vote counting engine for ranked contests: instant runoff (IRV) and single transferable vote (STV).
+# Plurality contests are placed straight from the tallies (see results.place_answers()).
+# A contest's ballots are held as one array, ballots x ranks, of candidate indexes in order of
+# preference, padded with -1.  Each ballot's current choice (its highest ranked continuing candidate)
+# is kept in an array too, so a round is a bincount, and moving the ballots of an elected or eliminated
+# candidate to their next choices only rescans those ballots.
+# This module only needs NumPy, so tools can load it without starting the application.
+
+
+# Build the ballot array for a contest.
+# ballotids, ranks and answers are parallel sequences, one entry per vote (in any order); candidateids
+# lists the contest's candidate IDs, whose positions are the candidate indexes.  Votes for IDs not in
+# the list are dropped.
+def build_ballots(ballotids, ranks, answers, candidateids):
+    ballotids = np.asarray(ballotids, dtype=np.int64)
+    ranks = np.asarray(ranks, dtype=np.int64)
+    answers = np.asarray(answers, dtype=np.int64)
+    candidateids = np.asarray(candidateids, dtype=np.int64)
+
+    if len(ballotids) == 0 or len(candidateids) == 0:
+        return np.full((0, 1), -1, dtype=np.int32)
+
+    # Map answers to candidate indexes.
+    sorter = np.argsort(candidateids)
+    found = np.searchsorted(candidateids, answers, sorter=sorter).clip(0, len(candidateids) - 1)
+    indexes = sorter[found]
+    known = candidateids[indexes] == answers
+
+    ballotids = ballotids[known]
+    ranks = ranks[known]
+    indexes = indexes[known]
+
+    # Sort by ballot, then rank, and place each vote in its ballot's row.
+    order = np.lexsort((ranks, ballotids))
+    ballotids = ballotids[order]
+    indexes = indexes[order]
+
+    _, rows, counts = np.unique(ballotids, return_inverse=True, return_counts=True)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    columns = np.arange(len(ballotids)) - starts[rows]
+
+    ballots = np.full((len(counts), max(1, counts.max() if len(counts) > 0 else 1)), -1, dtype=np.int32)
+    ballots[rows, columns] = indexes
+
+    return ballots
+
+
+# The highest ranked continuing candidate on each ballot (-1 if the ballot is exhausted).
+# continuing is a boolean array per candidate.
+def current_choices(ballots, continuing):
+    # Look up the padding (-1) as the extra last entry, which is never continuing.
+    marks = np.append(continuing, False)[ballots]
+    columns = marks.argmax(axis=1)
+
+    choices = ballots[np.arange(len(ballots)), columns]
+    return np.where(marks.any(axis=1), choices, -1)
+
+
+# One counting round, as passed to the results page.
+def make_round(number, counts, elected, eliminated, exhausted):
+    return {'round': number,
+            'counts': [float(c) for c in counts],
+            'elected': [int(c) for c in elected],
+            'eliminated': [int(c) for c in eliminated],
+            'exhausted': float(exhausted)
+           }
+
+
+# Order candidates for ties: most votes this round, then most first preferences, then lowest index.
+def rank_candidates(candidates, counts, first):
+    return sorted(candidates, key=lambda c: (-counts[c], -first[c], c))
+
+
+# Instant runoff for one seat: the last candidate is eliminated each round and their ballots move to
+# their next choices, until a candidate has a majority of the continuing ballots.
+def irv(ballots, ncandidates):
+    continuing = np.ones(ncandidates, dtype=bool)
+    choices = current_choices(ballots, continuing)
+    first = np.bincount(choices[choices >= 0], minlength=ncandidates)
+
+    rounds = []
+    while True:
+        active = choices >= 0
+        counts = np.bincount(choices[active], minlength=ncandidates)
+        total = counts.sum()
+        exhausted = len(choices) - active.sum()
+
+        remaining = rank_candidates(np.flatnonzero(continuing).tolist(), counts, first)
+        if total == 0 or len(remaining) == 0:
+            rounds.append(make_round(len(rounds) + 1, counts, [], [], exhausted))
+            break
+
+        leader = remaining[0]
+        if counts[leader] * 2 > total or len(remaining) == 1:
+            rounds.append(make_round(len(rounds) + 1, counts, [leader], [], exhausted))
+            break
+
+        # Candidates with no votes go together; otherwise the last candidate goes.
+        eliminated = [c for c in remaining[1:] if counts[c] == 0] or [remaining[-1]]
+        rounds.append(make_round(len(rounds) + 1, counts, [], eliminated, exhausted))
+
+        continuing[eliminated] = False
+        moved = np.isin(choices, eliminated)
+        choices[moved] = current_choices(ballots[moved], continuing)
+
+    return rounds
+
+
+# Single transferable vote for several seats, with the Droop quota and fractional (Gregory) transfers.
+# Candidates reaching the quota are elected and the surplus of their ballots moves on at a reduced
+# weight; when nobody reaches it the last candidate is eliminated.  Once the continuing candidates
+# only fill the remaining seats, they are all elected.  As with IRV, nobody is elected without votes.
+def stv(ballots, ncandidates, seats):
+    continuing = np.ones(ncandidates, dtype=bool)
+    weights = np.ones(len(ballots))
+    choices = current_choices(ballots, continuing)
+    first = np.bincount(choices[choices >= 0], minlength=ncandidates)
+
+    quota = (choices >= 0).sum() // (seats + 1) + 1
+    elected = []
+
+    rounds = []
+    while len(elected) < seats:
+        active = choices >= 0
+        counts = np.bincount(choices[active], weights=weights[active], minlength=ncandidates)
+        exhausted = weights[~active].sum()
+
+        remaining = rank_candidates(np.flatnonzero(continuing).tolist(), counts, first)
+        if counts.sum() == 0 or len(remaining) == 0:
+            rounds.append(make_round(len(rounds) + 1, counts, [], [], exhausted))
+            break
+
+        if len(remaining) <= seats - len(elected):
+            elected.extend(remaining)
+            rounds.append(make_round(len(rounds) + 1, counts, remaining, [], exhausted))
+            break
+
+        winners = [c for c in remaining if counts[c] >= quota][0:seats - len(elected)]
+        if len(winners) > 0:
+            elected.extend(winners)
+            rounds.append(make_round(len(rounds) + 1, counts, winners, [], exhausted))
+
+            # Pass on each winner's surplus.
+            for c in winners:
+                weights[choices == c] *= (counts[c] - quota) / counts[c]
+
+            moving = winners
+        else:
+            eliminated = [c for c in remaining[1:] if counts[c] == 0] or [remaining[-1]]
+            rounds.append(make_round(len(rounds) + 1, counts, [], eliminated, exhausted))
+
+            moving = eliminated
+
+        continuing[moving] = False
+        moved = np.isin(choices, moving)
+        choices[moved] = current_choices(ballots[moved], continuing)
+
+    return rounds
+
+
+# Count a ranked contest: IRV for one seat, STV for more.
+def ranked(ballots, ncandidates, seats=1):
+    if seats == 1:
+        return irv(ballots, ncandidates)
+
+    return stv(ballots, ncandidates, seats)
+
+
+# The candidates elected over all rounds, in order.
+def elected(rounds):
+    return [c for r in rounds for c in r['elected']]
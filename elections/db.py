@@ -7,20 +7,21 @@
 
 import traceback
 import logging
+import re
+import io
+import os
+import bisect, random
+import threading, time
+import logging.handlers
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
 
-from elections import loggers
+from elections import app, loggers
 from elections import DB_DEBUG, DB_DEBUG_OUTPUT, READ_ONLY
 from elections.log import AppLog
 
-# Handle name: connection, error
-dbh = {'global' : {'conn': None,
-                   'cursor': None,
-                   'error': False }
-      }
-
 # Unique value exception handler.
 class UniqueValueException(Exception):
     def __init__ (self, msg):
@@ -31,6 +32,26 @@ class UniqueValueException(Exception):
 
     pass
 
+# No pooled connection became available in time.
+class PoolExhaustedException(Exception):
+    def __init__ (self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+    pass
+
+# Committing a handle that has no open transaction.
+class NoTransactionException(Exception):
+    def __init__ (self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+    pass
+
 # Convert to None if NULL.
 def convert(a):
     if a == 'NULL':
@@ -39,6 +60,260 @@ def convert(a):
         return a
 
 
+# Statement shapes: literals (quoted strings and numbers) become '?', lists of them collapse to a
+# single '(?)', and whitespace is squeezed, so every call of the same query lands in one bucket.
+# Shapes are also all that the slow and sampled query logs record, which keeps voter IDs and
+# vote choices out of them.
+SHAPE_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SHAPE_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+def statement_shape(query):
+    shape = SHAPE_LITERALS.sub('?', query)
+    shape = SHAPE_LISTS.sub('(?)', shape)
+    return ' '.join(shape.split())
+
+
+# In-process statement latency statistics, keyed by statement shape.
+# Each shape keeps a count, total and maximum time and a histogram of latencies.
+class QueryStats:
+    # Histogram bucket upper bounds in milliseconds; the final bucket catches anything slower.
+    BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shapes = {}
+        self.started = time.time()
+
+    def record(self, shape, elapsed):
+        ms = elapsed * 1000.0
+        bucket = bisect.bisect_left(self.BUCKETS, ms)
+
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                stats = {'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1)}
+                self.shapes[shape] = stats
+
+            stats['count'] += 1
+            stats['total'] += ms
+            stats['max'] = max(stats['max'], ms)
+            stats['buckets'][bucket] += 1
+
+    # Latency (bucket upper bound) at or below which the given fraction of calls completed.
+    def _percentile(self, stats, fraction):
+        wanted = stats['count'] * fraction
+        seen = 0
+        for index, count in enumerate(stats['buckets']):
+            seen += count
+            if seen >= wanted:
+                break
+
+        if index < len(self.BUCKETS):
+            return self.BUCKETS[index]
+
+        return stats['max']
+
+    # Copy of the current statistics, busiest (by total time) first.
+    def snapshot(self):
+        with self.lock:
+            shapes = [(shape, dict(stats, buckets=list(stats['buckets']))) for shape, stats in self.shapes.items()]
+
+        results = []
+        for shape, stats in shapes:
+            results.append({'shape': shape,
+                            'count': stats['count'],
+                            'total': stats['total'],
+                            'mean': stats['total'] / stats['count'],
+                            'max': stats['max'],
+                            'p50': self._percentile(stats, 0.50),
+                            'p95': self._percentile(stats, 0.95),
+                            'p99': self._percentile(stats, 0.99),
+                            'buckets': stats['buckets']
+                           })
+
+        results.sort(key=lambda x: x['total'], reverse=True)
+        return results
+
+    def reset(self):
+        with self.lock:
+            self.shapes = {}
+            self.started = time.time()
+
+
+querystats = QueryStats()
+
+
+# Slow query log: a plain rotating file next to the application logs.
+slowlog = None
+
+def get_slow_query_log():
+    global slowlog
+
+    if slowlog is None:
+        logger = logging.getLogger('%s_slowquery' % app.config.get('LOG_BASENAME'))
+        if len(logger.handlers) == 0:
+            logpath = app.config.get('LOG_DOWNLOAD_FOLDER')
+            if not os.path.exists(logpath):
+                os.makedirs(logpath)
+
+            handler = logging.handlers.RotatingFileHandler(os.path.join(logpath, '%s.slowquery.log' % app.config.get('LOG_BASENAME')),
+                                                           backupCount=app.config.get('LOG_BACKUP_FILE_COUNT'),
+                                                           maxBytes=app.config.get('LOG_BACKUP_FILE_SIZE'))
+            handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d; %(message)s', datefmt='%m-%d-%Y %H:%M:%S'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+        slowlog = logger
+
+    return slowlog
+
+
+# Record a statement's time: add it to the statistics, write it to the slow query log if over
+# the threshold, and log a sample of statements (a cheap alternative to DB_DEBUG).
+def record_statement(shape, elapsed, handlekey):
+    querystats.record(shape, elapsed)
+
+    if elapsed >= app.config.get('DB_SLOW_QUERY_TIME'):
+        get_slow_query_log().info("%.1f ms; %s; %s" % ((elapsed * 1000.0), handlekey, shape))
+
+    samplerate = app.config.get('DB_QUERY_SAMPLE_RATE')
+    if samplerate > 0 and random.random() < samplerate:
+        loggers[AppLog.get_id()].debug("Query (%.1f ms, %s): %s" % ((elapsed * 1000.0), handlekey, shape))
+
+
+# Statements that change data (or tables and sequences) and are refused in read-only mode.
+WRITE_VERBS = ['INSERT', 'UPDATE', 'DELETE', 'TRUNCATE', 'CREATE TABLE', 'ALTER TABLE', 'DROP TABLE',
+               'CREATE SEQUENCE', 'DROP SEQUENCE', 'NEXTVAL', 'SETVAL']
+
+
+# Named statement registry: statement name -> statement details.
+# Hot queries are registered once at import with $1..$n placeholders.  Each pooled connection
+# prepares a statement the first time it runs it; from then on every call is a bound EXECUTE,
+# so Postgres skips re-planning and values never need quoting or escaping.
+# Whether a statement writes (blocked in read-only mode) or returns rows is worked out here,
+# once, rather than on every call.
+STATEMENTS = {}
+
+# fetch may be given as False for SELECTs whose result is not wanted (like taking a lock), so
+# they can share a transaction without adding a result set to dbres.
+# write may be given as True for statements that write without saying so (like calling a function
+# that does), so they are still blocked in read-only mode.
+def register_statement(name, query, fetch=None, write=None):
+    query = query.strip().rstrip(';')
+    verb = query.split(None, 1)[0].upper()
+    params = len(set(re.findall(r'\$(\d+)', query)))
+
+    if params > 0:
+        execute = 'EXECUTE %s (%s);' % (name, ', '.join(['%s'] * params))
+    else:
+        execute = 'EXECUTE %s;' % name
+
+    STATEMENTS[name] = {'query': query,
+                        'prepare': 'PREPARE %s AS %s;' % (name, query),
+                        'execute': execute,
+                        'params': params,
+                        'write': any(v in query.upper() for v in WRITE_VERBS) if write is None else write,
+                        'fetch': (verb == 'SELECT' or 'RETURNING' in query.upper()) if fetch is None else fetch,
+                        'shape': statement_shape(query)
+                       }
+    return name
+
+
+# Build a call to a registered statement, for use in place of a query string in sql().
+def statement(name, *params):
+    if len(params) != STATEMENTS[name]['params']:
+        raise ValueError("Statement '%s' takes %d parameters (%d given)" % (name, STATEMENTS[name]['params'], len(params)))
+
+    return (name, params)
+
+
+# Rows to bulk load into a table as one step of a sql() transaction.
+# The rows are streamed with COPY FROM STDIN; if the server refuses COPY the load falls back to
+# batched multi-row INSERTs.  Once loaded, the row count, method and elapsed time are filled in
+# so the caller can report throughput.
+class BulkLoad:
+    def __init__(self, table, columns, rows):
+        self.table = table
+        self.columns = columns
+        self.rows = rows
+
+        self.count = 0
+        self.method = None
+        self.elapsed = 0.0
+
+    def describe(self):
+        return 'COPY %s (%s) FROM STDIN' % (self.table, ', '.join(self.columns))
+
+    def rate(self):
+        if self.elapsed > 0:
+            return self.count / self.elapsed
+
+        return float(self.count)
+
+
+# Escape a value for the COPY text format (tab-separated, \N for NULL).
+def copy_value(value):
+    if value is None:
+        return '\\N'
+
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+# Load a BulkLoad's rows using the given cursor, inside the caller's transaction.
+def bulk_load(cursor, load):
+    start = time.monotonic()
+
+    copied = False
+    if app.config.get('DB_BULK_LOAD_COPY') is True:
+        data = io.StringIO()
+        for row in load.rows:
+            data.write('\t'.join(copy_value(v) for v in row))
+            data.write('\n')
+        data.seek(0)
+
+        # A savepoint lets a refused COPY be undone without losing the rest of the transaction.
+        cursor.execute('SAVEPOINT bulk_load;')
+        try:
+            cursor.copy_expert(load.describe(), data)
+            cursor.execute('RELEASE SAVEPOINT bulk_load;')
+            copied = True
+
+        except (psycopg2.NotSupportedError, psycopg2.errors.InsufficientPrivilege) as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT bulk_load;')
+            loggers[AppLog.get_id()].warning("COPY into '%s' refused (%s); using batched inserts" % (load.table, str(e).strip()))
+
+    if copied is True:
+        load.method = 'copy'
+    else:
+        outsql = 'INSERT INTO %s (%s) VALUES %%s' % (load.table, ', '.join(load.columns))
+        psycopg2.extras.execute_values(cursor, outsql, load.rows, page_size=app.config.get('DB_BULK_LOAD_PAGE_SIZE'))
+        load.method = 'insert'
+
+    load.count = len(load.rows)
+    load.elapsed = time.monotonic() - start
+
+
+# Join queued (already bound) statements into one batch.
+def build_batch(pending):
+    batch = b'\n'.join(s if s.rstrip().endswith(b';') else s + b';' for s in pending)
+    pending.clear()
+
+    return batch
+
+
+# Send a batch to the server in one round trip.
+# Only the last statement in a batch can return rows.
+def send_batch(cursor, batch, fetch, dbres):
+    cursor.execute(batch)
+
+    if fetch is True:
+        resdata = cursor.fetchall()
+        if resdata is not None:
+            dbres.append(resdata)
+
+
 # Connect to database.
 def connect_to_database(handlekey, reconnected=False):
     try:
@@ -61,20 +336,15 @@ def connect_to_database(handlekey, reconnected=False):
         raise
 
 
-# Close database connection.
-def close_database(handlekey='global'):
-    global dbh
-
+# Close database connection(s).
+# With a handle key, any transaction left open for that handle is rolled back and its
+# connection returned to the pool; with no handle key, the whole pool is closed.
+def close_database(handlekey=None):
     try:
-        conn = dbh[handlekey].get('conn', None)
-        cursor = dbh[handlekey].get('cursor', None)
-
-        if cursor is not None:
-            cursor.close()
-
-        if conn is not None:
-            conn.close()
-            dbh.pop(handlekey)
+        if handlekey is None:
+            pool.close_all()
+        else:
+            pool.release(handlekey)
 
     except:
         loggers[AppLog.get_id()].error("Failed to close database connection!")
@@ -127,14 +397,218 @@ def rollback_with_error(query, data, conn):
         conn.rollback()
 
 
+# Bounded, thread-safe pool of database connections.
+# Each transaction checks a connection out, runs on its own cursor, and checks it back in, so
+# concurrent requests never share a cursor and the number of backend connections stays capped
+# no matter how many users are logged in.  A handle that leaves a transaction open
+# (autocommit=False) keeps its connection pinned until commit() or close_database().
+class ConnectionPool:
+    def __init__(self, minconn, maxconn, timeout, healthcheck):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck = healthcheck
+
+        # Idle pool entries, ready for checkout.
+        self.idle = []
+
+        # Entries holding an open transaction, by handle key.
+        self.pinned = {}
+
+        # Number of connections open (idle, checked out and pinned).
+        self.opened = 0
+
+        self.lock = threading.Condition()
+
+
+    # Open a new pool entry.
+    def _open(self, handlekey, reconnected=False):
+        conn = connect_to_database(handlekey, reconnected)
+        return {'conn': conn,
+                'cursor': get_cursor(conn),
+                'checked': time.monotonic(),
+                'prepared': set()
+               }
+
+
+    # Close a pool entry, ignoring failures (the connection may already be gone).
+    def _close(self, entry):
+        try:
+            entry['cursor'].close()
+            entry['conn'].close()
+        except:
+            pass
+
+
+    # Verify an idle entry is usable before handing it out.
+    # Connections that have been idle longer than the health check time get a round trip to prove
+    # the backend is still there; anything else only gets the (free) local status checks.
+    def _healthy(self, entry):
+        conn = entry['conn']
+        if conn.closed != 0:
+            return False
+
+        try:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                return False
+
+            # Anything left behind by a failed transaction is discarded.
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+            if (time.monotonic() - entry['checked']) > self.healthcheck:
+                entry['cursor'].execute('SELECT 1;')
+                entry['cursor'].fetchall()
+                conn.rollback()
+
+        except psycopg2.Error:
+            return False
+
+        return True
+
+
+    # Check out a connection for the given handle.
+    def checkout(self, handlekey):
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            entry = None
+            reserved = False
+
+            with self.lock:
+                # A handle with an open transaction continues on the same connection.
+                entry = self.pinned.pop(handlekey, None)
+                if entry is not None:
+                    return entry
+
+                # Open the minimum set of connections on first use.
+                if self.opened == 0 and self.minconn > 1:
+                    prewarm = min(self.minconn, self.maxconn) - 1
+                    self.opened += prewarm
+                else:
+                    prewarm = 0
+
+                while len(self.idle) == 0 and self.opened >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhaustedException("No database connection available for '%s' after %s seconds." % (handlekey, self.timeout))
+
+                    self.lock.wait(remaining)
+
+                if len(self.idle) > 0:
+                    entry = self.idle.pop()
+                else:
+                    self.opened += 1
+                    reserved = True
+
+            if prewarm > 0:
+                self._prewarm(handlekey, prewarm)
+
+            # Open a new connection outside the lock.
+            if reserved is True:
+                try:
+                    return self._open(handlekey)
+                except:
+                    with self.lock:
+                        self.opened -= 1
+                        self.lock.notify()
+                    raise
+
+            if self._healthy(entry) is True:
+                return entry
+
+            # Drop the dead connection and try again.
+            loggers[AppLog.get_id()].warning("Discarding unhealthy database connection (checkout for '%s')" % handlekey)
+            self._close(entry)
+            with self.lock:
+                self.opened -= 1
+                self.lock.notify()
+
+
+    # Open the connections reserved for the minimum pool size.
+    def _prewarm(self, handlekey, count):
+        for _ in range(count):
+            try:
+                entry = self._open(handlekey)
+            except:
+                with self.lock:
+                    self.opened -= 1
+                    self.lock.notify()
+                continue
+
+            self.checkin(entry)
+
+
+    # Return a connection to the pool.  Broken connections are closed instead.
+    def checkin(self, entry, discard=False):
+        if discard is True or entry['conn'].closed != 0:
+            self._close(entry)
+            with self.lock:
+                self.opened -= 1
+                self.lock.notify()
+            return
+
+        entry['checked'] = time.monotonic()
+        with self.lock:
+            self.idle.append(entry)
+            self.lock.notify()
+
+
+    # Hold a connection with an open transaction for the given handle.
+    def pin(self, handlekey, entry):
+        with self.lock:
+            self.pinned[handlekey] = entry
+
+
+    # Take the connection pinned for a handle (None if it has no open transaction).
+    def unpin(self, handlekey):
+        with self.lock:
+            return self.pinned.pop(handlekey, None)
+
+
+    # Release the connection pinned for a handle, rolling back anything uncommitted.
+    def release(self, handlekey):
+        with self.lock:
+            entry = self.pinned.pop(handlekey, None)
+
+        if entry is not None:
+            try:
+                entry['conn'].rollback()
+                self.checkin(entry)
+            except psycopg2.Error:
+                self.checkin(entry, discard=True)
+
+
+    # Close every connection in the pool.
+    def close_all(self):
+        with self.lock:
+            entries = self.idle + list(self.pinned.values())
+            self.idle = []
+            self.pinned = {}
+            self.opened -= len(entries)
+
+        for entry in entries:
+            self._close(entry)
+
+
+pool = ConnectionPool(app.config.get('DB_POOL_MIN_CONNECTIONS'),
+                      app.config.get('DB_POOL_MAX_CONNECTIONS'),
+                      app.config.get('DB_POOL_TIMEOUT'),
+                      app.config.get('DB_POOL_HEALTHCHECK_TIME'))
+
+
 # Execute a query/series of queries as one transaction.
-def sql(queries, data=[], handlekey='global', autocommit=True):
+def sql(queries, data=[], handlekey='global', autocommit=True, retrying=False):
     '''Run an SQL query and return the outcome'''
 
-    global dbh
     dbres = []
     rows = []
     err = None
+    query = None
+    querydata = data
+    entry = None
+    discard = False
 
     # If the handle key is passed in as None, ensure a default.
     if handlekey is None:
@@ -147,56 +621,124 @@ def sql(queries, data=[], handlekey='global', autocommit=True):
     try:
         # loggers[AppLog.get_id()].debug("Transaction started")
 
-        # Connect to the DB if we're not already.
-        if dbh.get(handlekey) is None:
-            conn = connect_to_database(handlekey)
-            cursor = get_cursor(conn)
+        # Check out a connection (or continue the handle's open transaction).
+        entry = pool.checkout(handlekey)
+        conn = entry['conn']
+        cursor = entry['cursor']
 
-            dbh[handlekey] = {'conn': conn,
-                              'cursor': cursor,
-                              'error': False
-                             }
-        else:
-            conn = dbh[handlekey].get('conn')
+        # Statements are queued and sent to the server together, up to and including the next one
+        # that returns rows, so a run of INSERTs/UPDATEs/DELETEs costs one round trip.
+        # Each fetching statement still gets its own result set in dbres.
+        batching = app.config.get('DB_BATCH_STATEMENTS') is True
+        pending = []
+        shapes = []
+
+        # Send the queued statements.  They share the batch's time evenly in the statistics.
+        def flush(fetch):
+            nonlocal query, querydata
+
+            batch = build_batch(pending)
+            query, querydata = batch.decode('utf-8', 'replace'), []
+
+            start = time.monotonic()
+            send_batch(cursor, batch, fetch, dbres)
+            elapsed = (time.monotonic() - start) / len(shapes)
 
-            # If the connection is closed, reopen it.
-            if conn.closed > 0:
-                conn.close()
+            for shape in shapes:
+                record_statement(shape, elapsed, handlekey)
+            shapes.clear()
 
-                conn = connect_to_database(handlekey, reconnected=True)
-                cursor = get_cursor(conn)
+        for item in queries:
+            # Bulk loads are written straight to the table.
+            if isinstance(item, BulkLoad):
+                if len(pending) > 0:
+                    flush(False)
 
-                dbh[handlekey] = {'conn': conn,
-                                  'cursor': cursor,
-                                  'error': False
-                                 }
+                query = item.describe()
+                querydata = []
 
-            cursor = dbh[handlekey].get('cursor')
+                if DB_DEBUG is True:
+                    dump_query(query, querydata)
+
+                if READ_ONLY is True:
+                    err = "System is in read-only mode."
+                else:
+                    bulk_load(cursor, item)
+                    record_statement(query, item.elapsed, handlekey)
+
+                continue
+
+            # Named statements carry their own parameters and precomputed classification;
+            # plain query strings are classified by inspection.
+            if type(item) is tuple:
+                name, querydata = item
+                stmt = STATEMENTS[name]
+
+                query = stmt['query']
+                write = stmt['write']
+                fetch = stmt['fetch']
+                shape = stmt['shape']
+            else:
+                query = item
+                querydata = data
+                write = any(q in query for q in WRITE_VERBS)
+                fetch = query.startswith('SELECT') or 'RETURNING' in query
+                shape = statement_shape(query)
 
-        for query in queries:
             # Debug output
             if DB_DEBUG is True:
-                dump_query(query, data)
+                dump_query(query, querydata)
 
             # If in read-only mode and the query alters data, disallow it.
-            if any(q in query for q in ['INSERT', 'UPDATE', 'DELETE']) and READ_ONLY is True:
+            if write is True and READ_ONLY is True:
                 err = "System is in read-only mode."
+                continue
+
+            if type(item) is tuple:
+                # Prepare the statement on this connection on first use.
+                if name not in entry['prepared']:
+                    cursor.execute(stmt['prepare'])
+                    entry['prepared'].add(name)
+
+                statement_sql, statement_data = stmt['execute'], querydata
             else:
+                statement_sql, statement_data = query, data
+
+            if batching is True:
+                # Bind parameters client side so the statement can join the batch.
+                if len(statement_data) > 0:
+                    pending.append(cursor.mogrify(statement_sql, statement_data))
+                else:
+                    pending.append(cursor.mogrify(statement_sql))
+                shapes.append(shape)
+
+                if fetch is True:
+                    flush(True)
+
+            else:
+                start = time.monotonic()
+
                 # execute the query
-                if len(data) > 0:
-                    rowdata = (cursor.execute(query, data))
+                if len(statement_data) > 0:
+                    rowdata = (cursor.execute(statement_sql, statement_data))
                 else:
-                    rowdata = (cursor.execute(query))
+                    rowdata = (cursor.execute(statement_sql))
 
                 if rowdata is not None:
                     rows.append(rowdata)
 
                 # fetch the data
-                if query.startswith('SELECT') or 'RETURNING' in query:
+                if fetch is True:
                     resdata = cursor.fetchall()
                     if resdata is not None:
                         dbres.append(resdata)
 
+                record_statement(shape, time.monotonic() - start, handlekey)
+
+        # Send whatever is left.
+        if len(pending) > 0:
+            flush(False)
+
         # Debug output
         #dump_results(rows)
         if DB_DEBUG_OUTPUT is True:
@@ -204,7 +746,7 @@ def sql(queries, data=[], handlekey='global', autocommit=True):
 
         # Close and commit or rollback if failed.
         if err is not None:
-            rollback_with_error(query, data, conn)
+            rollback_with_error(query, querydata, conn)
 
         # If not autocommitting, we're running a multi-step transaction with a lock.
         # We need to complete the commit here to commit the data and close the lock.
@@ -217,7 +759,7 @@ def sql(queries, data=[], handlekey='global', autocommit=True):
         return rows, dbres, err
 
     except psycopg2.errors.UniqueViolation as ue:
-        rollback_with_error(query, data, conn)
+        rollback_with_error(query, querydata, conn)
 
         try:
             msg = ue.diag.message_detail
@@ -227,32 +769,59 @@ def sql(queries, data=[], handlekey='global', autocommit=True):
         raise UniqueValueException(msg)
 
     # On operational error (connection closed), try again.
-    # This will fetch a new handle and retry the transaction.
+    # This will fetch a new connection and retry the transaction.
     # If it fails again, the error will get thrown.
     except psycopg2.OperationalError as oe:
         msg = str(oe)
         loggers[AppLog.get_id()].critical("Database operational error: %s" % msg)
 
-        if dbh[handlekey]['error'] is False:
+        # The connection is suspect; don't give it back to the pool.
+        discard = True
+
+        if retrying is False:
             loggers[AppLog.get_id()].critical("Retrying transaction...")
-            dbh[handlekey]['error'] = True
 
-            dump_query(query, data)
+            dump_query(query, querydata)
 
-            return sql(queries, data, handlekey, autocommit)
+            if entry is not None:
+                pool.checkin(entry, discard=True)
+                entry = None
+
+            return sql(queries, data, handlekey, autocommit, retrying=True)
 
         else:
             loggers[AppLog.get_id()].critical("Aborting transaction")
+            raise
 
     # All other errors (including a failed transaction after attempting to reconnect).
     except Exception as e:
-        rollback_with_error(query, data, conn)
+        if entry is not None:
+            rollback_with_error(query, querydata, entry['conn'])
 
         # The caller will handle the error.
         raise
 
+    finally:
+        # Hand the connection back, or keep it for the handle if its transaction is still open.
+        if entry is not None:
+            if autocommit is False and discard is False:
+                pool.pin(handlekey, entry)
+            else:
+                pool.checkin(entry, discard=discard)
+
 
 def commit(handlekey):
-    conn = dbh[handlekey].get('conn')
     loggers[AppLog.get_id()].debug("Committing previously opened transaction for user '%s'" % handlekey)
-    conn.commit()
\ No newline at end of file
+
+    # Only the handle's own open transaction can be committed; any other connection would be someone else's.
+    entry = pool.unpin(handlekey)
+    if entry is None:
+        raise NoTransactionException("No open transaction to commit for '%s'." % handlekey)
+
+    try:
+        entry['conn'].commit()
+        pool.checkin(entry)
+
+    except psycopg2.Error:
+        pool.checkin(entry, discard=True)
+        raise
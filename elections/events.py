@@ -18,9 +18,63 @@ from elections import loggers
 from elections import ALLUSERS, ADMINS
 
 from elections.log import AppLog
+import elections.tallies as tallies
+from elections.ballotitems import invalidate_ballot
+
+# Prepared statements for event lookups on the voting path.
+db.register_statement('events_config', 'SELECT * FROM events WHERE clubid=$1 AND eventid=$2')
+# Transaction-scoped database locks on an event, the cross-process half of the event locks.
+db.register_statement('events_lock_shared', 'SELECT pg_advisory_xact_lock_shared($1, $2)', fetch=False)
+db.register_statement('events_lock_exclusive', 'SELECT pg_advisory_xact_lock($1, $2)', fetch=False)
+
+
+# Reader/writer locks keyed by (clubid, eventid), serializing changes to an event's config in the
+# database and the user caches without holding up other events.
+# Readers share a key; a writer has it to itself, and waiting writers keep new readers out so a
+# steady stream of reads cannot starve them.  Club-wide cache updates use the (clubid, 0) key, which
+# anyone taking an event's lock holds shared first, so a club-wide update has every event in the club to
+# itself (and the club key is always taken before the event key, so they can't deadlock).
+# These only cover this process; database work done under a lock also takes the matching
+# pg_advisory_xact_lock (see EventConfig._lock_sql) so other processes are held off too.
+class EventLocks:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.locks = {}
+
+    def acquire(self, key, exclusive=False):
+        with self.condition:
+            state = self.locks.setdefault(key, {'readers': 0, 'writer': False, 'waiting': 0})
+
+            if exclusive is True:
+                state['waiting'] += 1
+                while state['writer'] is True or state['readers'] > 0:
+                    self.condition.wait()
+
+                state['waiting'] -= 1
+                state['writer'] = True
+            else:
+                while state['writer'] is True or state['waiting'] > 0:
+                    self.condition.wait()
+
+                state['readers'] += 1
+
+    def release(self, key, exclusive=False):
+        with self.condition:
+            state = self.locks[key]
+
+            if exclusive is True:
+                state['writer'] = False
+            else:
+                state['readers'] -= 1
+
+            # Forget idle keys so the table doesn't grow with every event ever touched.
+            if state['writer'] is False and state['readers'] == 0 and state['waiting'] == 0:
+                del self.locks[key]
 
-# Mutex to serialize access to changes to event configs in database and caches.
-events_mutex = threading.Lock()
+            self.condition.notify_all()
+
+
+events_locks = EventLocks()
 
 # Class to manage event config information.
 class EventConfig:
@@ -65,26 +119,32 @@ class EventConfig:
         self.logid = AppLog.get_id(self.clubid, self.eventid)
 
 
-    # Get the event config mutex to serialize readers/writers.
-    def _get_events_lock(user):
-        #loggers[AppLog.get_id()].debug("Acquiring events mutex: %s" % ('system' if user is None else user))
+    # Get an event's lock: shared for readers, exclusive for writers.
+    # An event's lock comes with a shared hold on its club's lock (eventid 0).
+    def _get_events_lock(user, clubid, eventid, exclusive=False):
+        #loggers[AppLog.get_id()].debug("Acquiring events lock %d/%d: %s" % (clubid, eventid, ('system' if user is None else user)))
+
+        if eventid != 0:
+            events_locks.acquire((clubid, 0))
 
-        events_mutex.acquire()
+        events_locks.acquire((clubid, eventid), exclusive)
 
-        # Temporary for testing locks
-        #import time
-        #time.sleep(5)
+        #loggers[AppLog.get_id()].debug("Acquired events lock %d/%d: %s" % (clubid, eventid, ('system' if user is None else user)))
 
-        #loggers[AppLog.get_id()].debug("Acquired events mutex: %s" % ('system' if user is None else user))
 
+    # Let go of an event's lock.
+    def _release_events_lock(user, clubid, eventid, exclusive=False):
+        #loggers[AppLog.get_id()].debug("Releasing events lock %d/%d: %s" % (clubid, eventid, ('system' if user is None else user)))
 
-    # Let go of the event config mutex.
-    def _release_events_lock(user):
-        #loggers[AppLog.get_id()].debug("Releasing events mutex: %s" % ('system' if user is None else user))
+        events_locks.release((clubid, eventid), exclusive)
 
-        events_mutex.release()
+        if eventid != 0:
+            events_locks.release((clubid, 0))
 
-        #loggers[AppLog.get_id()].debug("Released events mutex: %s" % ('system' if user is None else user))
+
+    # The statement taking the database side of an event's lock, to lead a db.sql() transaction.
+    def _lock_sql(clubid, eventid, exclusive=False):
+        return db.statement('events_lock_exclusive' if exclusive is True else 'events_lock_shared', clubid, eventid)
 
 
     # Fetch events from the database.  Used during init.  Therefore, we don't bother with a mutex check here.
@@ -92,7 +152,7 @@ class EventConfig:
         logger = loggers[AppLog.get_id()]
         logger.debug("Fetching events: %s" % dbuser)
 
-        outsql = ['''SELECT clubid, eventid
+        outsql = ['''SELECT clubid, eventid, locked
                      FROM events;
                   ''']
         _, results, err = db.sql(outsql, handlekey=dbuser)
@@ -113,72 +173,62 @@ class EventConfig:
         logger = loggers[AppLog.get_id(clubid, eventid)]
         logger.debug("Fetching event config: %s" % dbuser)
 
-        try:
-            EventConfig._get_events_lock(dbuser)
+        EventConfig._get_events_lock(dbuser, clubid, eventid)
 
-            outsql = ['''SELECT *
-                        FROM events
-                        WHERE clubid='%d' AND eventid='%d';
-                    ''' % (clubid, eventid)]
+        try:
+            outsql = [EventConfig._lock_sql(clubid, eventid), db.statement('events_config', clubid, eventid)]
             _, results, err = db.sql(outsql, handlekey=dbuser)
 
-            EventConfig._release_events_lock(dbuser)
-
-            # Log errors to the club or event's log.
-            if err is not None:
-                logger.critical("Failed to fetch event config: %s" % err)
-                return None
+        finally:
+            EventConfig._release_events_lock(dbuser, clubid, eventid)
 
-            # The events data is the first 'dbresults' in the list.
-            appdata = results[0]
+        # Log errors to the club or event's log.
+        if err is not None:
+            logger.critical("Failed to fetch event config: %s" % err)
+            return None
 
-            r = []
-            if len(appdata) > 0:
-                r = appdata[0]
+        # The events data is the first 'dbresults' in the list.
+        appdata = results[0]
 
-            logger.debug("Fetched event config")
+        r = []
+        if len(appdata) > 0:
+            r = appdata[0]
 
-            # Return the data set.
-            return r
+        logger.debug("Fetched event config")
 
-        except:
-            # On exception, release the mutex and re-raise it.
-            EventConfig._release_events_lock(dbuser)
-            raise
+        # Return the data set.
+        return r
 
 
     # Set the config based on the current object's contents.
     # Creating the object populates the initial data; this way, the complete
     # data set gets included.
     def save_config(self, user):
-        try:
-            loggers[self.logid].info("Saving event config: %s" % user)
+        loggers[self.logid].info("Saving event config: %s" % user)
 
-            EventConfig._get_events_lock(user)
+        EventConfig._get_events_lock(user, self.clubid, self.eventid, exclusive=True)
 
-            outsql = '''UPDATE events
-                        SET locked=%s, title='%s', icon='%s', homeimage='%s', eventdatetime='%s'
-                        WHERE clubid='%d' AND eventid='%d';
-                    ''' % (self.locked, self.title, self.icon, self.homeimage, self.eventdatetime,
-                           self.clubid, self.eventid)
+        try:
+            outsql = [EventConfig._lock_sql(self.clubid, self.eventid, exclusive=True)]
+            outsql.append('''UPDATE events
+                             SET locked=%s, title='%s', icon='%s', homeimage='%s', eventdatetime='%s'
+                             WHERE clubid='%d' AND eventid='%d';
+                          ''' % (self.locked, self.title, self.icon, self.homeimage, self.eventdatetime,
+                                 self.clubid, self.eventid))
 
             _, _, err = db.sql(outsql, handlekey=user)
 
-            EventConfig._release_events_lock(user)
+        finally:
+            EventConfig._release_events_lock(user, self.clubid, self.eventid, exclusive=True)
 
-            # Log errors to the event's log.
-            if err is not None:
-                loggers[self.logid].error("Failed to save event config: %s" % err)
-                return err
-
-            loggers[self.logid].info("Saved event config: %s" % user)
+        # Log errors to the event's log.
+        if err is not None:
+            loggers[self.logid].error("Failed to save event config: %s" % err)
+            return err
 
-            return None
+        loggers[self.logid].info("Saved event config: %s" % user)
 
-        except:
-            # On exception, release the mutex and re-raise it.
-            EventConfig._release_events_lock(user)
-            raise
+        return None
 
     # Reset the config for the club and event to defaults.
     def reset_config(self, user):
@@ -191,15 +241,16 @@ class EventConfig:
         # Note: We deliberately do not reset the club and event ID here
         # since those are to be preserved across resets.
 
-        try:
-            loggers[self.logid].info("Resetting event config: %s" % user)
+        loggers[self.logid].info("Resetting event config: %s" % user)
 
-            EventConfig._get_events_lock(user)
+        EventConfig._get_events_lock(user, self.clubid, self.eventid, exclusive=True)
 
+        try:
             # Reset and insert defaults.
-            outsql = ['''DELETE FROM events
-                        WHERE clubid='%d' AND eventid='%d';
-                    ''' % (self.clubid, self.eventid)]
+            outsql = [EventConfig._lock_sql(self.clubid, self.eventid, exclusive=True)]
+            outsql.append('''DELETE FROM events
+                             WHERE clubid='%d' AND eventid='%d';
+                          ''' % (self.clubid, self.eventid))
 
             outsql.append('''DELETE FROM vote_ballotid
                             WHERE clubid='%d' AND eventid='%d';
@@ -213,40 +264,37 @@ class EventConfig:
             outsql.append('''INSERT INTO vote_ballotid
                             VALUES('%d', '%d', 0);
                         ''' % (self.clubid, self.eventid))
+            outsql.extend(set_ballotid_sql(self.eventid, 0))
 
             _, _, err = db.sql(outsql, handlekey=user)
 
             # Update all other user caches.
             EventConfig.update_event_caches(user, self, lock=False)
 
-            EventConfig._release_events_lock(user)
-
-            # Log errors to the event's log.
-            if err is not None:
-                loggers[self.logid].error("Failure to reset event config: %s" % err)
-                return err
+        finally:
+            EventConfig._release_events_lock(user, self.clubid, self.eventid, exclusive=True)
 
-            loggers[self.logid].info("Reset event config: %s" % user)
+        # Log errors to the event's log.
+        if err is not None:
+            loggers[self.logid].error("Failure to reset event config: %s" % err)
+            return err
 
-            return None
+        loggers[self.logid].info("Reset event config: %s" % user)
 
-        except:
-            # On exception, release the mutex and re-raise it.
-            EventConfig._release_events_lock(user)
-            raise
+        return None
 
 
     # Walk all of the user caches and update them with the contents of the given club config.
     def update_club_caches(user, clubdata):
-        try:
-            clubid = clubdata['clubid']
-            clubname = clubdata['clubname']
+        clubid = clubdata['clubid']
+        clubname = clubdata['clubname']
 
-            logger = loggers[AppLog.get_id(clubid=clubid)]
-            logger.info("Updating club caches for users of Club %d (%s)" % (clubid, clubname), indent=1, propagate=True)
+        logger = loggers[AppLog.get_id(clubid=clubid)]
+        logger.info("Updating club caches for users of Club %d (%s)" % (clubid, clubname), indent=1, propagate=True)
 
-            EventConfig._get_events_lock(user)
+        EventConfig._get_events_lock(user, clubid, 0, exclusive=True)
 
+        try:
             # Walk the all-users cache, finding all events with the club and event ID, and
             # copy this info into them.
             for u in ALLUSERS:
@@ -276,25 +324,21 @@ class EventConfig:
                             for attr in ['clubname']:
                                 setattr(cacheduser, attr, clubdata[attr])
 
-            EventConfig._release_events_lock(user)
-
-            logger.info("Updated club caches for users of Club %d (%s)" % (clubid, clubname), indent=1, propagate=True)
+        finally:
+            EventConfig._release_events_lock(user, clubid, 0, exclusive=True)
 
-        except:
-            # On exception, release the mutex and re-raise it.
-            EventConfig._release_events_lock(user)
-            raise
+        logger.info("Updated club caches for users of Club %d (%s)" % (clubid, clubname), indent=1, propagate=True)
 
 
     # Walk all of the user caches and update them with the contents of the given event config.
     def update_event_caches(user, newconfig, lock=True):
-        try:
-            logger = loggers[AppLog.get_id(clubid=newconfig.clubid, eventid=newconfig.eventid)]
-            logger.info("Updating event caches for users of Event %d (%s)" % (newconfig.eventid, newconfig.title), indent=1, propagate=True)
+        logger = loggers[AppLog.get_id(clubid=newconfig.clubid, eventid=newconfig.eventid)]
+        logger.info("Updating event caches for users of Event %d (%s)" % (newconfig.eventid, newconfig.title), indent=1, propagate=True)
 
-            if lock is True:
-                EventConfig._get_events_lock(user)
+        if lock is True:
+            EventConfig._get_events_lock(user, newconfig.clubid, newconfig.eventid, exclusive=True)
 
+        try:
             # Walk the all-users cache, finding all events with the club and event ID, and
             # copy this info into them.
             for u in ALLUSERS:
@@ -323,53 +367,11 @@ class EventConfig:
                                 except:
                                     setattr(cacheduser.event, attr, getattr(newconfig, attr))
 
+        finally:
             if lock is True:
-                EventConfig._release_events_lock(user)
+                EventConfig._release_events_lock(user, newconfig.clubid, newconfig.eventid, exclusive=True)
 
-            logger.info("Updated event caches for users of Event %d (%s)" % (newconfig.eventid, newconfig.title), indent=1, propagate=True)
-
-        except:
-            # On exception, release the mutex and re-raise it.
-            if lock is True:
-                EventConfig._release_events_lock(user)
-            raise
-
-
-    # Get the new ballot ID to use and update the database with the next one.
-    # Sets both in the object and the database together.
-    def get_vote_ballotid(self, user):
-        try:
-            loggers[self.logid].info("Fetching new ballot ID: %s" % user)
-
-            EventConfig._get_events_lock(user)
-
-            # Get the next ballotid by selecting the current largest value and adding 1, and return it.
-            # This updates the databse and then provides teh value that was updated, making it atomic
-            # across users.
-            outsql = '''UPDATE vote_ballotid
-                        SET ballotid=(SELECT COALESCE(MAX(ballotid), 0) AS max FROM vote_ballotid WHERE clubid='%d' AND eventid='%d') + 1
-                        WHERE clubid='%d' AND eventid='%d'
-                        RETURNING ballotid;
-                    ''' % (self.clubid, self.eventid, self.clubid, self.eventid)
-            _, data, err = db.sql(outsql, handlekey=user)
-
-            # Log errors to the event's log.
-            if err is not None:
-                loggers[self.logid].error(err)
-                EventConfig._release_events_lock(user)
-                return 0, err
-
-            ballotid = int(data[0][0]['ballotid'])
-
-            loggers[self.logid].info("Fetched new ballot ID %d" % ballotid)
-
-            EventConfig._release_events_lock(user)
-            return ballotid, None
-
-        except:
-            # On exception, release the mutex and re-raise it.
-            EventConfig._release_events_lock(user)
-            raise
+        logger.info("Updated event caches for users of Event %d (%s)" % (newconfig.eventid, newconfig.title), indent=1, propagate=True)
 
 
     # Fetch configuration/display data as a common item for rendering.
@@ -407,15 +409,75 @@ class EventConfig:
                 ]
 
 
+# Partitioned tables.
+# votes and voters are list-partitioned by event ID (which is unique across clubs), one partition per
+# event, so clearing an event's votes or voters is a TRUNCATE and removing an event detaches and drops
+# its partitions instead of deleting rows from tables shared by every club.
+# Rows for an event without partitions land in the table's default partition.
+# Attaching and detaching partitions locks the partitioned tables, which every event's voting uses:
+# - A partition is built as a table of its own and then attached, which only keeps the partitioned
+#   table from being altered meanwhile, though the default partition is locked while it is checked for
+#   the event's rows (there are none for a new event).
+# - Detaching needs the partitioned table to itself.  It can't be done concurrently (PostgreSQL 14+)
+#   while there is a default partition, so events are best removed while no event is being voted in.
+# Either way, the locks are waited for for at most DB_PARTITION_LOCK_TIMEOUT seconds, so that voting
+# isn't held up behind a lock that can't be had; the change fails instead and can be tried again.
+PARTITIONED_TABLES = ['votes', 'voters']
+
+def partition_name(table, eventid):
+    return '%s_%d' % (table, eventid)
+
+
+# How long to wait for the locks to attach or detach partitions.
+def partition_lock_timeout_sql():
+    return '''SET LOCAL lock_timeout = '%ds';''' % app.config.get('DB_PARTITION_LOCK_TIMEOUT')
+
+
+# Statements that create an event's partitions in the given tables.
+# The check constraint shows the new table only holds the event's rows, so attaching it needn't scan it.
+def create_partitions_sql(eventid, tables=PARTITIONED_TABLES):
+    outsql = [partition_lock_timeout_sql()]
+    for table in tables:
+        partition = partition_name(table, eventid)
+        outsql.extend(['''CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS, CONSTRAINT %s_event CHECK (eventid = %d));''' % (partition, table, partition, eventid),
+                       '''ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%d);''' % (table, partition, eventid),
+                       '''ALTER TABLE %s DROP CONSTRAINT %s_event;''' % (partition, partition)])
+
+    return outsql
+
+
+# The partitioned tables that have a partition for the given event.
+def existing_partitions(user, eventid):
+    outsql = '''SELECT %s;''' % ', '.join(["to_regclass('%s') AS %s" % (partition_name(table, eventid), table) for table in PARTITIONED_TABLES])
+    _, data, _ = db.sql(outsql, handlekey=user)
+
+    return [table for table in PARTITIONED_TABLES if data[0][0][table] is not None]
+
+
+# Ballot ID sequences.
+# Each event hands out ballot IDs from its own sequence.  vote_ballotid keeps the value the sequence was
+# last set to (on creation, reset and import); setting it positions the sequence so the next ballot ID
+# is one more than the given value.
+def ballotid_sequence(eventid):
+    return 'vote_ballotid_%d' % eventid
+
+
+# Statements that (create and) set an event's ballot ID sequence.
+def set_ballotid_sql(eventid, ballotid):
+    return ['''CREATE SEQUENCE IF NOT EXISTS %s MINVALUE 0;''' % ballotid_sequence(eventid),
+            '''SELECT SETVAL('%s', %d);''' % (ballotid_sequence(eventid), int(ballotid))]
+
+
 # Handlers for event management.
 
 # Remove event data.
-def remove_event_data(user, clubid, eventid, clear_config=True, votes_only=False):
-    try:
-        EventConfig._get_events_lock(user)
+# When removing the event itself, its partitions are detached and dropped as well.
+def remove_event_data(user, clubid, eventid, clear_config=True, votes_only=False, remove_partitions=False):
+    EventConfig._get_events_lock(user, clubid, eventid, exclusive=True)
 
+    try:
         # Wipe out the tables for this club/event.
-        outsql = []
+        outsql = [EventConfig._lock_sql(clubid, eventid, exclusive=True)]
 
         import elections.configdata as configdata
 
@@ -449,11 +511,36 @@ def remove_event_data(user, clubid, eventid, clear_config=True, votes_only=False
                             ''' % (clubid, eventid))
 
         # Remove all data from the tables to be cleared.
+        # Tables with a partition for this event are emptied by truncating (or dropping) the partition.
+        partitions = existing_partitions(user, eventid)
         for table in sheets:
+            if table in partitions:
+                continue
+
             outsql.append('''DELETE FROM %s
                             WHERE clubid='%d' AND eventid='%d';
                         ''' % (table, clubid, eventid))
 
+        if remove_partitions is True and len(partitions) > 0:
+            outsql.append(partition_lock_timeout_sql())
+
+        for table in partitions:
+            if remove_partitions is True:
+                current_user.logger.debug("Detaching partition '%s'" % partition_name(table, eventid), indent=2)
+                outsql.append('''ALTER TABLE %s DETACH PARTITION %s;''' % (table, partition_name(table, eventid)))
+                outsql.append('''DROP TABLE %s;''' % partition_name(table, eventid))
+
+            elif table in sheets:
+                outsql.append('''TRUNCATE TABLE %s;''' % partition_name(table, eventid))
+
+        # An event being removed takes its ballot ID sequence with it.
+        if remove_partitions is True:
+            outsql.append('''DROP SEQUENCE IF EXISTS %s;''' % ballotid_sequence(eventid))
+
+        # The vote tallies go with the votes.
+        if 'votes' in sheets:
+            outsql.append(tallies.clear_sql(clubid, eventid))
+
         # If not clearing the config, we are resetting the event (not removing it) and as such need an initial vote ballot id.
         if clear_config is False:
             # Add the initial vote ballot ID of 0.
@@ -461,21 +548,18 @@ def remove_event_data(user, clubid, eventid, clear_config=True, votes_only=False
             outsql.append('''INSERT INTO vote_ballotid
                             VALUES(%d, %d, 0);
                         ''' % (clubid, eventid))
+            outsql.extend(set_ballotid_sql(eventid, 0))
 
         _, _, err = db.sql(outsql, handlekey=user)
 
-        # On error to update the database, return and print out the error (like "System is in read only mode").
-        if err is not None:
-            EventConfig._release_events_lock(user)
-            return err
+    finally:
+        EventConfig._release_events_lock(user, clubid, eventid, exclusive=True)
 
-        EventConfig._release_events_lock(user)
-        return None
+    # On error to update the database, return and print out the error (like "System is in read only mode").
+    if err is not None:
+        return err
 
-    except:
-        # On exception, release the mutex and re-raise it.
-        EventConfig._release_events_lock(user)
-        raise
+    return None
 
 
 # Nicely format a datetime-local format string.
@@ -842,6 +926,11 @@ def addEvent(user):
             outsql.append('''INSERT INTO vote_ballotid
                             VALUES(%d, %d, 1);
                         ''' % (clubid, eventid))
+            outsql.extend(set_ballotid_sql(eventid, 1))
+
+            # Give the event its own vote and voter partitions (unless left over from an event with its ID).
+            partitions = existing_partitions(current_user.get_userid(), eventid)
+            outsql.extend(create_partitions_sql(eventid, [t for t in PARTITIONED_TABLES if t not in partitions]))
             _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
 
             # On error to update the database, return and print out the error (like "System is in read only mode").
@@ -1313,7 +1402,8 @@ def removeEvent(user):
                 confirm_request = False
 
                 # Do the needful.
-                err = remove_event_data(current_user.get_userid(), current_user.clubid, eventid)
+                err = remove_event_data(current_user.get_userid(), current_user.clubid, eventid, remove_partitions=True)
+                invalidate_ballot(current_user.clubid, eventid)
                 if err is not None:
                     current_user.logger.flashlog("Remove Event failure", "Failed to remove event data:", highlight=True, propagate=True)
                     current_user.logger.flashlog("Remove Event failure", err, propagate=True)
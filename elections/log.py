@@ -5,103 +5,519 @@
 #   This work is the personal property of Steve Strublic, and as such may not be
 #   used, distributed, or modified without my express consent.
 
-import os, sys, zipfile, traceback
+import os, zipfile, traceback
 import logging, logging.handlers
+import queue, threading, time
+import mmap, struct
+import sqlite3
+from urllib.request import pathname2url
+
+import numpy as np
 
 from flask import flash, request
 
 from elections import app, getRemoteAddr
+from elections import loghelpers
 
 LOGFORMAT = "%(asctime)s.%(msecs)03d;%(levelname)-8s;%(clubid)s/%(eventid)s/%(user)s;%(ipaddr)s;%(message)s"
 
+# Requests passed to a log file's writer thread through its queue.
+LOG_RECORD = 0
+LOG_FLUSH = 1
+LOG_ROLLOVER = 2
+LOG_STOP = 3
+
+# Seconds a caller waits for the writer thread to act on a flush, rollover or stop request.
+LOG_WRITER_WAIT = 5
+
+# Bytes per entry in the log offsets file.
+OFFSET_SIZE = 8
+
+
+# The log file line offsets: the file offset of the start of each line in the log file, stored as
+# a little-endian unsigned 64-bit integer per line.  The line count is the file size / 8, and a
+# line's offset is read from a memory map of the file, which is mapped again as the file grows.
+class LogOffsets():
+    def __init__(self, offsetsfile):
+        self.offsetsfile = offsetsfile
+        self.lock = threading.Lock()
+        self.map = None
+
+
+    # The number of lines in the log.
+    def __len__(self):
+        try:
+            return os.path.getsize(self.offsetsfile) // OFFSET_SIZE
+        except OSError:
+            return 0
+
+
+    # The offset of the start of a line (0 is the first line).
+    def __getitem__(self, line):
+        with self.lock:
+            if line < 0:
+                line += len(self)
+
+            offsets = self._map(line + 1)
+            if line < 0 or offsets is None or len(offsets) < ((line + 1) * OFFSET_SIZE):
+                raise IndexError("Log line %d is not in the offsets file" % line)
+
+            return struct.unpack_from('<Q', offsets, line * OFFSET_SIZE)[0]
+
+
+    # The offsets of a range of lines, as a NumPy array.
+    def array(self, start=0, stop=None):
+        with self.lock:
+            if stop is None:
+                stop = len(self)
+
+            offsets = self._map(stop)
+            if offsets is None:
+                return np.zeros(0, dtype='<u8')
+
+            stop = min(stop, len(offsets) // OFFSET_SIZE)
+            start = max(0, min(start, stop))
+
+            # Slicing the map copies the data, so no view holds the map open.
+            return np.frombuffer(offsets[start * OFFSET_SIZE:stop * OFFSET_SIZE], dtype='<u8')
+
+
+    # Map the offsets file, mapping it again if the lines wanted are past the end of the current map.
+    def _map(self, lines):
+        if self.map is None or len(self.map) < (lines * OFFSET_SIZE):
+            self._unmap()
+
+            try:
+                with open(self.offsetsfile, 'rb') as of:
+                    self.map = mmap.mmap(of.fileno(), 0, access=mmap.ACCESS_READ)
+
+            except (OSError, ValueError):
+                # There's no offsets file, or it is empty (which can't be mapped).
+                self.map = None
+
+        return self.map
+
+
+    def _unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+    # Release the map (before the offsets file is removed or rebuilt).
+    def close(self):
+        with self.lock:
+            self._unmap()
+
+# The log search index tables.  Each log line is a row keyed by its line number (0 is the first line),
+# and its message words are in a contentless full-text table (the text itself is in the log file).
+LOG_INDEX_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS lines (line INTEGER PRIMARY KEY, level TEXT, clubid TEXT, eventid TEXT,
+                                      user TEXT COLLATE NOCASE, ipaddr TEXT);
+    CREATE INDEX IF NOT EXISTS lines_level ON lines (level, line);
+    CREATE INDEX IF NOT EXISTS lines_event ON lines (clubid, eventid, line);
+    CREATE INDEX IF NOT EXISTS lines_user ON lines (user, line);
+    CREATE INDEX IF NOT EXISTS lines_ipaddr ON lines (ipaddr, line);
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(message, content='');
+'''
+
+# The fields of the log index that can be searched on, besides the level and message words.
+LOG_INDEX_FIELDS = ['clubid', 'eventid', 'user', 'ipaddr']
+
+# Number of log lines added to the index at a time when rebuilding it.
+LOG_INDEX_BATCH = 10000
+
+
+# Split a log line (see LOGFORMAT) into its level, club ID, event ID, user, IP address and message.
+# Lines not in the log format (such as traceback lines) take their fields from the log line they follow.
+def parse_logline(line, previous=('', '', '', '', '')):
+    fields = line.split(';', 4)
+    if len(fields) == 5:
+        level = fields[1].strip()
+        ids = fields[2].split('/', 2)
+        if level in loghelpers.loglevels and len(ids) == 3:
+            return (level, ids[0], ids[1], ids[2], fields[3], fields[4])
+
+    return tuple(previous[0:5]) + (line,)
+
+
+# The log search index: a SQLite database next to the log file that holds each line's level, club, event,
+# user and IP address, and the words of its message.  The log writer adds lines as it writes them.
+class LogIndex():
+    def __init__(self, indexfile):
+        self.indexfile = indexfile
+        self.db = None
+
+
+    # Open (creating if needed) the index for adding lines.
+    def _open(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.indexfile, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(LOG_INDEX_SCHEMA)
+
+        return self.db
+
+
+    # Add lines, as (line number, level, club ID, event ID, user, IP address, message).
+    def add(self, entries):
+        db = self._open()
+        with db:
+            db.executemany("INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?)", [e[0:6] for e in entries])
+            db.executemany("INSERT INTO messages (rowid, message) VALUES (?, ?)", [(e[0], e[6]) for e in entries])
+
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+    # Remove the index (on rollover, or to rebuild it).
+    def remove(self):
+        self.close()
+
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.indexfile + suffix):
+                os.remove(self.indexfile + suffix)
+
+
+    # Check the index holds the lines 0 to linecount - 1.
+    def check(self, linecount):
+        if not os.path.exists(self.indexfile):
+            return False
+
+        try:
+            count, last = self._open().execute("SELECT count(*), max(line) FROM lines").fetchone()
+            return count == linecount and (count == 0 or last == (linecount - 1))
+
+        except sqlite3.Error:
+            return False
+
+
+    # Rebuild the index from the log file.
+    def rebuild(self, logfile):
+        self.remove()
+
+        count = 0
+        if os.path.exists(logfile):
+            with open(logfile, 'rb') as lf:
+                entries = []
+                fields = parse_logline('')
+
+                for line in lf:
+                    # A line still being written isn't in the offsets yet either.
+                    if not line.endswith(b'\n'):
+                        break
+
+                    fields = parse_logline(line.decode('utf-8', 'replace').rstrip('\r\n'), fields)
+                    entries.append((count,) + fields)
+                    count += 1
+
+                    if len(entries) == LOG_INDEX_BATCH:
+                        self.add(entries)
+                        entries = []
+
+                if len(entries) > 0:
+                    self.add(entries)
+
+        # Create the (empty) index for an empty log.
+        self._open()
+
+        return count
+
+
+    # Find the lines from first to last (not including last) that match the search, in order
+    # (or in reverse order if not going forward), up to the limit.
+    # The search holds any of the index fields and the message 'words'; levels is the list of levels to find.
+    def search(self, search, levels, first, last, forward, limit):
+        if not os.path.exists(self.indexfile):
+            return []
+
+        query = "SELECT lines.line FROM lines"
+        where = ["lines.line >= ?", "lines.line < ?"]
+        data = [first, last]
+
+        # Each word is matched as given (quoted so the FTS query syntax isn't used), with a trailing '*' for a prefix.
+        words = search.get('words', '').split()
+        if len(words) > 0:
+            query = "SELECT messages.rowid FROM messages JOIN lines ON lines.line = messages.rowid"
+            where = ["messages MATCH ?", "messages.rowid >= ?", "messages.rowid < ?"]
+            terms = ['"%s"%s' % (w.rstrip('*').replace('"', '""'), '*' if w.endswith('*') else '') for w in words if len(w.rstrip('*')) > 0]
+            data = [' '.join(terms), first, last]
+
+        if len(levels) > 0:
+            where.append("lines.level IN (%s)" % ', '.join(['?'] * len(levels)))
+            data += levels
+
+        for field in LOG_INDEX_FIELDS:
+            if len(search.get(field, '')) > 0:
+                where.append("lines.%s = ?" % field)
+                data.append(search[field])
+
+        query += " WHERE %s ORDER BY 1 %s LIMIT ?" % (' AND '.join(where), 'ASC' if forward is True else 'DESC')
+        data.append(limit)
+
+        # Searches open the index read-only on their own connection, so they don't wait on the writer.
+        db = sqlite3.connect('file:%s?mode=ro' % pathname2url(self.indexfile), uri=True)
+        try:
+            return [row[0] for row in db.execute(query, data).fetchall()]
+        finally:
+            db.close()
+
+
 # Create a compressing rotating file handler.
 # Slavishly borrowed from the RotatingFileHandler.
+#
+# Log calls only format the record and queue it; a single writer thread per log file
+# takes the queued lines and writes them in batches.  The writer keeps the end of the log file
+# in memory, so no file is opened or seeked per line, and it writes the log lines and their
+# offsets together when the oldest queued line is LOG_FLUSH_INTERVAL seconds old or
+# LOG_FLUSH_SIZE bytes are waiting.
 class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
-    def __init__(self, logfile, offsetsfile, *args, **kwargs):
+    def __init__(self, logfile, offsetsfile, indexfile, *args, flushinterval=0.5, flushsize=65536, **kwargs):
         self.logfile = logfile
         self.offsetsfile = offsetsfile
 
-        # Cache the log file line offsets by reading from file, so we don't have to read them
-        # every time we read the log.  The cache and file will be kept in sync on each log write.
-        self.offsets = self._load_offsets_file()
+        self.flushinterval = flushinterval
+        self.flushsize = flushsize
+
+        # The queue of lines for the writer thread, which is started on the first log.
+        # The write lock is held by the writer while it writes, rolls over, or while the offsets
+        # file is being checked and rebuilt.
+        self.queue = queue.Queue()
+        self.writer = None
+        self.startlock = threading.Lock()
+        self.writelock = threading.RLock()
 
-        # Pass the rest to our superclass.
+        # The open offsets file, and the end of the log file and number of lines in it, set up by the writer.
+        self.offsetstream = None
+        self.end = None
+        self.lines = None
+
+        # The log file line offsets, read from the offsets file as the log is read.
+        self.offsets = LogOffsets(offsetsfile)
+
+        # The log search index, which the writer adds each line to.
+        self.index = LogIndex(indexfile)
+
+        # Pass the rest to our superclass.  The log file is opened by the writer when it first writes.
+        kwargs['delay'] = True
         super(CompressedRotatingFileHandler, self).__init__(*args, **kwargs)
 
 
-    # Read the log file line offsets from file.
-    def _load_offsets_file(self):
-        offsets = []
-        try:
-            with open(self.offsetsfile, 'r') as of:
-                line = of.readline()
-                while line:
-                    offsets.append(int(line))
-                    line = of.readline()
+    # The log file is written in binary so that the offsets are exact byte positions.
+    def _open(self):
+        return open(self.baseFilename, 'ab')
+
 
-        except:
-            # When there's no log offsets file, there's nothing to load.
-            pass
+    # Start the writer thread if it is not running (on the first log, or in a newly forked process).
+    def _start_writer(self):
+        if self.writer is None or not self.writer.is_alive():
+            with self.startlock:
+                if self.writer is None or not self.writer.is_alive():
+                    self.writer = threading.Thread(target=self._run_writer, daemon=True,
+                                                   name='logwriter-%s' % os.path.basename(self.logfile))
+                    self.writer.start()
 
-        return offsets
+
+    # Pass a request to the writer thread and wait for it to be done.
+    def _request(self, kind):
+        if self.writer is None or not self.writer.is_alive() or self.writer is threading.current_thread():
+            return False
+
+        done = threading.Event()
+        self.queue.put((kind, done))
+        return done.wait(LOG_WRITER_WAIT)
 
 
     # Override this method with our own...
+    # The record is formatted here so that it holds what was logged at the time of the call.
     def emit(self, record):
-        # This is the default that is written if there is no log file / offsets file.
-        offset = 0
-
-        # Open the log file and read the end-of-file.  The end of file is the start offset
-        # for the new line to be added.
-        with open(self.logfile, 'r') as lf:
-            # Seek the end of the log file and append that to the offsets file.
-            lf.seek(0, os.SEEK_END)
-            offset = lf.tell()
-
-        # Open and write the new offset to the offsets file.
-        with open(self.offsetsfile, 'a') as of:
-            # Write the offset of the end of the file as the offset of the new line.
-            self.offsets.append(offset)
-            of.write("%d\n" % offset)
-
-            lines = record.msg.split('\n')
-            if len(lines) > 1:
-                # Process all the lines (split by newline) in the record, except the last.
-                # The end-of-file position will serve as the offset for the next record.
-                for index, line in enumerate(lines[:-1]):
-                    # The first line of the bundle needs the log line's formatting to calculate the correct offset for the following lines.
-                    # The following lines do not need the formatting as it only applies to the first line in the bundle.
-                    if index == 0:
-                        logline = 'xx-xx-xxxx xx:xx:xx.xxx;xxxxxxxx;%d/%d/%s;%s;' % \
-                                (record.clubid, record.eventid, record.user, record.ipaddr) + line
-                    else:
-                        logline = line
-
-                    # Add the length of the line to the current offset, adjusting for platform.
-                    if sys.platform == "win32":
-                        linelen = len(logline) + 2
-                    else:
-                        linelen = len(logline) + 1
-
-                    # Add the line length to the offset and write to the offsets file.
-                    offset += linelen
-                    self.offsets.append(offset)
-                    of.write("%d\n" % offset)
-
-        # Pass the rest to our superclass.
-        super(CompressedRotatingFileHandler, self).emit(record)
+        try:
+            line = self.format(record) + self.terminator
+            self._start_writer()
+            self.queue.put((LOG_RECORD, line))
+
+        except RecursionError:
+            raise
+
+        except Exception:
+            self.handleError(record)
+
+
+    # Write out any queued lines, so a reader sees everything logged so far.
+    def flush(self):
+        self._request(LOG_FLUSH)
+
+
+    # Roll the log over now (clearing the log).
+    def reset(self):
+        self._start_writer()
+        self._request(LOG_ROLLOVER)
+
+
+    # Write out any queued lines and stop the writer before closing the log file.
+    def close(self):
+        if self.writer is not None and self.writer.is_alive():
+            if self._request(LOG_STOP) is True:
+                self.writer.join(LOG_WRITER_WAIT)
+
+        super(CompressedRotatingFileHandler, self).close()
+
+
+    # Close the log and offsets files; the writer reopens them when it next writes.
+    def _close_files(self):
+        with self.writelock:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+
+            if self.offsetstream:
+                self.offsetstream.close()
+                self.offsetstream = None
+
+            self.offsets.close()
+            self.index.close()
+            self.end = None
+            self.lines = None
+
+
+    # The writer thread.  Lines are collected until the oldest has waited the flush interval,
+    # enough bytes are waiting, or a request comes in, and are then written together.
+    def _run_writer(self):
+        lines = []
+        size = 0
+        deadline = None
+
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+
+            try:
+                kind, data = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, data = LOG_FLUSH, None
+
+            if kind == LOG_RECORD:
+                lines.append(data)
+                size += len(data)
+
+                if deadline is None:
+                    deadline = time.monotonic() + self.flushinterval
+
+                if size < self.flushsize:
+                    continue
+
+            try:
+                if len(lines) > 0:
+                    self._write_lines(lines)
+
+                if kind == LOG_ROLLOVER:
+                    with self.writelock:
+                        self.doRollover()
+
+                elif kind == LOG_STOP:
+                    self._close_files()
+
+            except Exception as ex:
+                print(" *** Log file '%s': Failed to write log!" % (self.logfile))
+                print(str(ex))
+                print(traceback.format_exc())
+
+            lines = []
+            size = 0
+            deadline = None
+
+            # Let the requester know the request is done.
+            if kind != LOG_RECORD and data is not None:
+                data.set()
+
+            if kind == LOG_STOP:
+                break
+
+
+    # Write a batch of lines and their offsets, rolling the log over where it gets too big.
+    def _write_lines(self, lines):
+        with self.writelock:
+            # The end of the log file and its line count are read once and then tracked as lines are written.
+            if self.end is None:
+                self.end = os.path.getsize(self.logfile) if os.path.exists(self.logfile) else 0
+                self.lines = len(self.offsets)
+
+            logdata = []
+            offsets = []
+            entries = []
+
+            for line in lines:
+                data = line.encode('utf-8', 'backslashreplace')
+
+                if self.backupCount > 0 and self.maxBytes > 0 and self.end > 0 and (self.end + len(data)) >= self.maxBytes:
+                    self._write_data(logdata, offsets, entries)
+                    logdata = []
+                    offsets = []
+                    entries = []
+                    self.doRollover()
+
+                # Record the offset of each line in the record (messages may hold several lines,
+                # such as tracebacks).  The record always ends with a newline.
+                start = 0
+                while start < len(data):
+                    offsets.append(self.end + start)
+                    start = data.find(b'\n', start) + 1
+
+                # Index each line in the record; the lines after the first take the first line's fields.
+                fields = parse_logline('')
+                for text in line.split('\n')[:-1]:
+                    fields = parse_logline(text, fields)
+                    entries.append((self.lines,) + fields)
+                    self.lines += 1
+
+                logdata.append(data)
+                self.end += len(data)
+
+            self._write_data(logdata, offsets, entries)
+
+
+    # Write log data and its offsets to their files, and add the lines to the search index.
+    def _write_data(self, logdata, offsets, entries):
+        if len(logdata) == 0:
+            return
+
+        if self.stream is None:
+            self.stream = self._open()
+
+        if self.offsetstream is None:
+            self.offsetstream = open(self.offsetsfile, 'ab')
+
+        self.stream.write(b''.join(logdata))
+        self.stream.flush()
+
+        # The lines are in the log file before their offsets are written, so a reader never
+        # finds an offset for a line it cannot read.
+        self.offsetstream.write(np.array(offsets, dtype='<u8').tobytes())
+        self.offsetstream.flush()
+
+        # A failure to index doesn't lose the log lines; the index is rebuilt when it is next checked.
+        try:
+            self.index.add(entries)
+
+        except Exception as ex:
+            print(" *** Log file '%s': Failed to index log lines!" % (self.logfile))
+            print(str(ex))
 
 
     # Handler rollover for our version of the handler.
     # Override this method with our own...
-    def doRollover(self, reset=False):
+    # This is only called by the writer thread, holding the write lock.
+    def doRollover(self):
         """
         Do a rollover, as described in __init__().
         """
-        # Close the stream.
-        if self.stream:
-            self.stream.close()
-            self.stream = None
+        # Close the log and offsets files.
+        self._close_files()
 
         if self.backupCount > 0:
             print(" *** Log file '%s': Rolling log " % (self.logfile))
@@ -132,28 +548,20 @@ class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
                 os.rename(dfn, self.baseFilename + ".1.zip")
 
             try:
-                # Remove the log offsets file.
-                os.remove(self.offsetsfile)
-                self.offsets = []
+                # Remove the log offsets file.  The offsets of the lines written after the
+                # rollover start again from 0 as they are written.
+                if os.path.exists(self.offsetsfile):
+                    os.remove(self.offsetsfile)
+                self.end = 0
+                self.lines = 0
 
-                # On a straight rollover, the rollover triggers before a log in-flight is written and as such
-                # requires the offsets file to have the base offset of 0 for that first log that is written after
-                # the rollover completes.  If resetting the log by forcing a rollover, this is not good because
-                # there is no log in flight.  So don't do it.  The next log written will write the offset as 0.
-                if reset is False:
-                    with open(self.offsetsfile, 'w') as of:
-                        self.offsets.append(0)
-                        of.write('0\n')
+                # Remove the search index, which starts again with the next line written.
+                self.index.remove()
 
             except Exception as ex:
                 print(" *** Log file '%s': Failed to remove log offsets file!" % (self.logfile))
 
 
-        # Reopen the stream.
-        if not self.delay:
-            self.stream = self._open()
-
-
 # The AppLog is an instance of a logger for the application.
 # The intent is to assign an instance to each user, to simplify
 # logging within the application.  As users log in to / select clubs and events,
@@ -185,8 +593,13 @@ class AppLog():
 
         # Stash our log file and offsets file.
         # These get passed to our log handler for generating file offsets for log file parsing.
+        # Offsets used to be kept as text, one per line; that file is converted when found.
         self.logfile = os.path.join(logpath, '%s.log' % self.logname)
-        self.offsetsfile = os.path.join(logpath, '%s.offsets.log' % self.logname)
+        self.offsetsfile = os.path.join(logpath, '%s.offsets' % self.logname)
+        self.textoffsetsfile = os.path.join(logpath, '%s.offsets.log' % self.logname)
+
+        # The log search index.
+        self.indexfile = os.path.join(logpath, '%s.index.db' % self.logname)
 
         # Root logger gets special treatment to create the root and console handler.
         if clubid == 0 and eventid == 0:
@@ -196,10 +609,12 @@ class AppLog():
             # We only want one instance of this to exist, so don't create it if a handler already is present.
             # That lets us create logger objects that point to the same log instance.
             if len(self.logger.handlers) == 0:
-                handler = CompressedRotatingFileHandler(self.logfile, self.offsetsfile,
+                handler = CompressedRotatingFileHandler(self.logfile, self.offsetsfile, self.indexfile,
                                                         os.path.join(logpath, '%s.log' % self.logname),
                                                         backupCount=app.config.get('LOG_BACKUP_FILE_COUNT'),
-                                                        maxBytes=app.config.get("LOG_BACKUP_FILE_SIZE"))
+                                                        maxBytes=app.config.get("LOG_BACKUP_FILE_SIZE"),
+                                                        flushinterval=app.config.get('LOG_FLUSH_INTERVAL'),
+                                                        flushsize=app.config.get('LOG_FLUSH_SIZE'))
 
                 handler.setFormatter(logging.Formatter(LOGFORMAT, datefmt='%m-%d-%Y %H:%M:%S'))
                 self.logger.addHandler(handler)
@@ -220,21 +635,42 @@ class AppLog():
             # We only want one instance of this to exist, so don't create it if a handler already is present.
             # That lets us create logger objects that point to the same log instance.
             if len(self.logger.handlers) == 0:
-                handler = CompressedRotatingFileHandler(self.logfile, self.offsetsfile,
+                handler = CompressedRotatingFileHandler(self.logfile, self.offsetsfile, self.indexfile,
                                                         os.path.join(logpath, '%s.log' % self.logname),
                                                         backupCount=app.config.get('LOG_BACKUP_FILE_COUNT'),
-                                                        maxBytes=app.config.get("LOG_BACKUP_FILE_SIZE"))
+                                                        maxBytes=app.config.get("LOG_BACKUP_FILE_SIZE"),
+                                                        flushinterval=app.config.get('LOG_FLUSH_INTERVAL'),
+                                                        flushsize=app.config.get('LOG_FLUSH_SIZE'))
                 handler.setFormatter(logging.Formatter(LOGFORMAT, datefmt='%m-%d-%Y %H:%M:%S'))
                 self.logger.addHandler(handler)
                 self.logger.setLevel(logging.DEBUG)
 
         # Build / verify / rebuild the log offsets file.
-        built_offset_list = self.__build_offset_list()
-        if built_offset_list is True:
-            # Reload the offsets from the newly created offsets file.
-            handler = self.logger.handlers[0]
-            handler.offsets = handler._load_offsets_file()
+        # Queued lines are written out first, and the writer is held off (with its files closed,
+        # so it reopens a rebuilt offsets file) while the files are checked.
+        handler = self.logger.handlers[0]
+        handler.flush()
+
+        with handler.writelock:
+            handler._close_files()
 
+            self.__convert_text_offsets_file()
+            built_offset_list = self.__build_offset_list()
+
+            # Check the search index has every line, and rebuild it if not.
+            if handler.index.check(len(handler.offsets)) is False:
+                try:
+                    count = handler.index.rebuild(self.logfile)
+                    if count > 0:
+                        print(" *** Log file '%s': Rebuilt log search index (%d lines)" % (self.logfile, count))
+
+                except Exception as ex:
+                    print(" *** Log file '%s': Failed to rebuild log search index!" % (self.logfile))
+                    print(str(ex))
+
+                handler.index.close()
+
+        if built_offset_list is True:
             self.logger.critical("Rebuilt file offsets list", extra={'clubid': self.clubid, 'eventid': self.eventid, 'user': self.user, 'ipaddr': ''})
             self.logger.propagate = True
 
@@ -247,13 +683,25 @@ class AppLog():
         return pad
 
 
-    # Get the log line offsets cache for our single log handler instance.
+    # Get the log line offsets for our single log handler instance.
+    # Queued lines are written out first so the offsets cover everything logged so far.
     def get_offsets(self):
-        return self.logger.handlers[0].offsets
+        handler = self.logger.handlers[0]
+        handler.flush()
+        return handler.offsets
+
+
+    # Get the log search index for our single log handler instance.
+    def get_index(self):
+        return self.logger.handlers[0].index
 
 
     # Count the lines in the log file.
+    # The offsets file has one fixed size entry per line, so its line count is taken from its size.
     def count_logfile_lines(self, offsetfile=False):
+        if offsetfile is True:
+            return len(self.logger.handlers[0].offsets)
+
         # Reader for counting the number of lines in the file.
         def _count_generator(reader, chunksize):
             b = reader(chunksize)
@@ -264,11 +712,7 @@ class AppLog():
         # Quickly count the lines in the log file.
         count = 0
 
-        logfile = self.logfile
-        if offsetfile is True:
-            logfile = self.offsetsfile
-
-        with open(logfile, 'rb') as fp:
+        with open(self.logfile, 'rb') as fp:
             chunksize = app.config.get('LOGFILE_OFFSETS_CHUNKSIZE')
             c_generator = _count_generator(fp.raw.read, chunksize)
             count = sum(buffer.count(b'\n') for buffer in c_generator)
@@ -276,6 +720,32 @@ class AppLog():
         return count
 
 
+    # Convert an offsets file kept as text (one offset per line) to the binary offsets file.
+    # If it can't be converted it is removed, and the offsets file gets rebuilt from the log.
+    def __convert_text_offsets_file(self):
+        if not os.path.exists(self.textoffsetsfile):
+            return
+
+        try:
+            if not os.path.exists(self.offsetsfile):
+                with open(self.textoffsetsfile, 'rb') as tf:
+                    offsets = np.array(tf.read().split(), dtype='<u8')
+
+                with open(self.offsetsfile, 'wb') as of:
+                    of.write(offsets.tobytes())
+
+                print(" *** Log file '%s': Converted text log offsets file (%d lines)" % (self.logfile, len(offsets)))
+
+        except Exception as ex:
+            print(" *** Log file '%s': Failed to convert text log offsets file!" % self.logfile)
+            print(str(ex))
+
+            if os.path.exists(self.offsetsfile):
+                os.remove(self.offsetsfile)
+
+        os.remove(self.textoffsetsfile)
+
+
     # Build a list of file offsets for individual log lines from the log file.
     def __build_offset_list(self):
         try:
@@ -296,7 +766,7 @@ class AppLog():
                         print(" *** Log file '%s': Line count mismatch (file: %d, offsets: %d)" % (self.logfile, logfile_lines, offset_lines))
                         build_offsets_file = True
 
-            # Walk the log file one line at a time, recording the file offsets for each.
+            # Walk the log file a buffer at a time, recording the file offsets of each line.
             if build_offsets_file is True:
                 # Remove the prior offsets file.
                 if os.path.exists(self.offsetsfile):
@@ -310,52 +780,22 @@ class AppLog():
                         b = reader(bufsize)
 
                 with open(self.logfile, 'rb') as lf:
-                    with open(self.offsetsfile, 'w') as of:
-                        offset = 0
-                        last_offset = 0
+                    with open(self.offsetsfile, 'wb') as of:
                         bufsize = app.config.get('LOGFILE_OFFSETS_CHUNKSIZE')
                         generator = _buffer_generator(lf.raw.read, bufsize)
 
-                        # Initialize with 0 if the file is not empty (end != 0) as the offset for the first line.
-                        lf.seek(0, os.SEEK_END)
-                        pos = lf.tell()
-                        if pos != 0:
-                            of.write("0\n")
+                        # The file offset of the start of the buffer, and of the line being read.
+                        position = 0
+                        linestart = 0
 
-                        # Seek back to the beginning of the file.
-                        lf.seek(0)
-
-                        # Run through the file in RAW mode and find all the newlines in each file buffer.
                         for buffer in generator:
-                            offsets = []
-                            bufoffset = 0
-
-                            while True:
-                                # Find the next newline.
-                                bufoffset = buffer.find(b'\n', bufoffset)
-
-                                # No more newlines?
-                                if bufoffset == -1:
-                                    # Write out the offsets we accumulated.
-                                    for o in offsets[:-1]:
-                                        of.write('%d\n' % o)
-
-                                    # Add the bytes that didn't get processed so we start on a boundary next time.
-                                    if (offset % bufsize) != 0:
-                                        offset += bufsize - (offset % bufsize)
-                                    break
-
-                                else:
-                                    # Advance past the newline character.
-                                    bufoffset += 1
-
-                                    # Add our last recorded offset and the buffer offset in this buffer,
-                                    # and store in the offsets list.
-                                    offset = last_offset + bufoffset
-                                    offsets.append(offset)
+                            # Each newline ends the line started at the last line start, and starts the next.
+                            newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord('\n')) + (position + 1)
+                            if len(newlines) > 0:
+                                of.write(np.concatenate(([linestart], newlines[:-1])).astype('<u8').tobytes())
+                                linestart = newlines[-1]
 
-                            # Remember the last offset generated for the next buffer to process.
-                            last_offset = offset
+                            position += len(buffer)
 
                 print("     Rebuilt offsets file '%s'" % self.offsetsfile)
 
@@ -376,7 +816,7 @@ class AppLog():
     def reset(self):
         if len(self.logger.handlers) > 0:
             handler = self.logger.handlers[0]
-            handler.doRollover(reset=True)
+            handler.reset()
             self.critical("### Cleared log for club '%d', event '%d' ###" % (self.clubid, self.eventid))
         else:
             self.critical("### Attempted to clear missing log for club '%d', event '%d' ###" % (self.clubid, self.eventid))
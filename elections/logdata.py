@@ -6,6 +6,7 @@
 #   used, distributed, or modified without my express consent.
 
 import os, traceback
+import datetime
 
 from flask import redirect, render_template, url_for, request, session
 from flask_login import current_user
@@ -13,6 +14,7 @@ from flask_login import current_user
 from elections import app, loggers
 from elections import ADMINS
 from elections import loghelpers
+from elections import db
 
 # Show and download the system log.
 def showLog(user):
@@ -30,8 +32,9 @@ def showLog(user):
         filepath = url_for('main_bp.logfile', filename=filename)
         logfile = current_user.logger.logfile
 
-        # Fetch the log file offsets from the logger.
+        # Fetch the log file offsets and search index from the logger.
         fileoffsets = current_user.logger.get_offsets()
+        logindex = current_user.logger.get_index()
 
         # If we don't have a stashed offset, set it up as 'first'.
         browse = request.values.get('browse', 'first')
@@ -86,6 +89,17 @@ def showLog(user):
         loglevel = int(loglevel)
         logstr = request.values.get('logstr', '')
 
+        # Fetch any club, event, user, IP address or message word search, which is answered by the log search index.
+        search = {}
+        searchfields = {'clubid': 'logclub', 'eventid': 'logevent', 'user': 'loguser', 'ipaddr': 'logip', 'words': 'logwords'}
+        for field in searchfields:
+            value = request.values.get(searchfields[field], '').strip()
+            if len(value) > 0:
+                search[field] = value
+
+        # Fetch whether to search the log archives as well.
+        searcharchives = request.values.get('logarchives', '') == 'on'
+
         # Fetch the previously remembered offset for the session.
         offset = session['logfile_offset']
 
@@ -113,12 +127,42 @@ def showLog(user):
                 # Last line.
                 offset = linecount - 1
 
-        # Fetch the lines.
-        # If we got none, it's almost certainly because we tried to view beyond the last page,
-        # try again.  The fetcher will set the offset appropriately in that case.
-        loglines, offset = loghelpers.fetch_loglines(logfile, browse, pagesize, linecount, fileoffsets, offset, loglevel, logstr)
-        if len(loglines) == 0:
-            loglines, offset = loghelpers.fetch_loglines(logfile, browse, pagesize, linecount, fileoffsets, offset, loglevel, logstr)
+        # Searching the archives pages through the lines of the log and all its archives that pass the
+        # level, text and search filters, in time order.  The session holds the first and last lines shown as cursors.
+        if searcharchives is True:
+            cursor = None
+            forward = True
+            if browse == 'next':
+                cursor = session.get('logarchive_last', None)
+            elif browse == 'prev':
+                cursor = session.get('logarchive_first', None)
+                forward = False
+            elif browse == 'last':
+                forward = False
+
+            backupcount = app.config.get('LOG_BACKUP_FILE_COUNT')
+            archivelines, first, last = loghelpers.search_archives(logfile, backupcount, loglevel, logstr, search, cursor, forward, pagesize)
+
+            # Going past either end shows the last or first page.
+            if len(archivelines) == 0 and cursor is not None:
+                archivelines, first, last = loghelpers.search_archives(logfile, backupcount, loglevel, logstr, search, None, not forward, pagesize)
+
+            session['logarchive_first'] = first
+            session['logarchive_last'] = last
+
+            # Lines from an archive are shown with the archive's name.
+            for name, number, linedata in archivelines:
+                loglines.append((('%s:%d' % (name, number)) if len(name) > 0 else number, linedata))
+
+        else:
+            # Fetch the lines.
+            # If we got none, it's almost certainly because we tried to view beyond the last page,
+            # try again.  The fetcher will set the offset appropriately in that case.
+            loglines, offset = loghelpers.fetch_loglines(logfile, browse, pagesize, linecount, fileoffsets, offset, loglevel, logstr,
+                                                         logindex=logindex, search=search)
+            if len(loglines) == 0:
+                loglines, offset = loghelpers.fetch_loglines(logfile, browse, pagesize, linecount, fileoffsets, offset, loglevel, logstr,
+                                                             logindex=logindex, search=search)
 
         # Parse the lines we found.
         for linedata in loglines:
@@ -135,6 +179,9 @@ def showLog(user):
         return render_template('config/showlog.html', user=user, admins=ADMINS[event.clubid],
                             filepath=filepath, filename=filename, logdata=logdata,
                             loglevel=loglevel, loglevels=loghelpers.loglevels, logstr=logstr,
+                            logclub=search.get('clubid', ''), logevent=search.get('eventid', ''),
+                            loguser=search.get('user', ''), logip=search.get('ipaddr', ''), logwords=search.get('words', ''),
+                            logarchives=searcharchives,
                             configdata=current_user.get_render_data())
 
     except Exception as e:
@@ -146,6 +193,33 @@ def showLog(user):
         return redirect(url_for('main_bp.index'))
 
 
+# Show the database query statistics.
+def showQueryStats(user):
+    try:
+        if request.values.get('savebutton') == 'reset':
+            db.querystats.reset()
+            current_user.logger.flashlog(None, "Query statistics reset.", 'info', propagate=True)
+            return redirect(url_for('main_bp.querystats'))
+
+        current_user.logger.info("Displaying: Query statistics")
+
+        stats = db.querystats.snapshot()
+        started = datetime.datetime.fromtimestamp(db.querystats.started).strftime('%m-%d-%Y %H:%M:%S')
+
+        return render_template('config/querystats.html', user=user, admins=ADMINS[current_user.event.clubid],
+                            stats=stats[0:app.config.get('QUERYSTATS_PAGE_SIZE')], shapes=len(stats), started=started,
+                            slowtime=app.config.get('DB_SLOW_QUERY_TIME'),
+                            configdata=current_user.get_render_data())
+
+    except Exception as e:
+        current_user.logger.flashlog("Query Statistics failure", "Exception: %s" % str(e), propagate=True)
+        current_user.logger.error("Unexpected exception:")
+        current_user.logger.error(traceback.format_exc())
+
+        # Redirect to the main page to display the exception and prevent recursive loops.
+        return redirect(url_for('main_bp.index'))
+
+
 # Clear/reset the log, or all logs if requested.
 def clearLogs(user, alllogs=False):
     try:
@@ -5,16 +5,143 @@
 #   This work is the personal property of Steve Strublic, and as such may not be
 #   used, distributed, or modified without my express consent.
 
-import os
+import os, mmap
+import heapq, itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+# The archive search workers load only logscan (see search_archives()).
+import logscan
+from logscan import LEVEL_START, LEVEL_END
 
 # Available log levels for filtering.
 loglevels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 
+# Number of log lines checked at a time when filtering.
+SCAN_LINES = 4096
+
+
+# Find the lines from first to last (not including last) that pass the filters.
+# The lines are checked together: the level column is compared across all the lines with NumPy,
+# and the filter string is found with bytes-level searches of the whole block of lines.
+# Returns the matching line numbers (0 is the first line) with their start and end offsets in the log file.
+def match_lines(logmap, fileoffsets, first, last, levels, needle):
+    # The start of each line, and the start of the line after (the end of the last line is found
+    # from the log file, as the offsets may not cover the line following it yet).
+    starts = fileoffsets.array(first, last + 1)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64), starts, starts
+    elif len(starts) > (last - first):
+        ends = starts[1:]
+        starts = starts[:-1]
+    else:
+        end = logmap.find(b'\n', int(starts[-1]))
+        ends = np.append(starts[1:], len(logmap) if end == -1 else end + 1)
+
+    starts = starts.astype(np.int64)
+    ends = ends.astype(np.int64)
+    mask = np.ones(len(starts), dtype=bool)
+
+    # Only the lines with unfiltered data need to be read.
+    if len(levels) > 0 or len(needle) > 0:
+        base = int(starts[0])
+        block = logmap[base:int(ends[-1])]
+        linestarts = starts - base
+        lineends = ends - base
+
+        if len(levels) > 0:
+            # Pull the level column out of every line and compare them all at once.
+            # Lines too short to hold a level (such as traceback lines) don't match.
+            data = np.frombuffer(block, dtype=np.uint8)
+            columns = np.minimum(linestarts[:, None] + np.arange(LEVEL_START, LEVEL_END), len(data) - 1)
+            linelevels = data[columns].copy().view('S%d' % (LEVEL_END - LEVEL_START)).ravel()
+            mask &= np.isin(linelevels, levels) & ((lineends - linestarts) > LEVEL_END)
+
+        if len(needle) > 0:
+            # Search the block for the string, moving on to the next line after each line it is found in.
+            found = np.zeros(len(starts), dtype=bool)
+            position = block.find(needle)
+            while position != -1:
+                line = np.searchsorted(linestarts, position, side='right') - 1
+                found[line] = True
+                position = block.find(needle, int(lineends[line]))
+
+            mask &= found
+
+    lines = np.flatnonzero(mask)
+    return lines + first, starts[lines], ends[lines]
+
+
+# Walk blocks of lines from the offset toward the end of the file (or the beginning, if not going forward),
+# giving the matching lines of each block as (line number, start, end) in the order walked.
+def scan_blocks(logmap, fileoffsets, offset, linecount, forward, scanlines, levels, needle):
+    if forward is True:
+        first = offset
+        while first < linecount:
+            last = min(first + scanlines, linecount)
+            lines, starts, ends = match_lines(logmap, fileoffsets, first, last, levels, needle)
+            yield list(zip(lines, starts, ends))
+            first = last
+
+    else:
+        last = offset + 1
+        while last > 0:
+            first = max(0, last - scanlines)
+            lines, starts, ends = match_lines(logmap, fileoffsets, first, last, levels, needle)
+            yield list(reversed(list(zip(lines, starts, ends))))
+            last = first
+
+
+# Walk the lines the log search index finds from the offset toward the end of the file (or the beginning,
+# if not going forward), giving those that also hold the filter string as (line number, start, end) a batch at a time.
+def search_index(logmap, fileoffsets, logindex, search, offset, linecount, forward, levelnames, needle):
+    if forward is True:
+        first, last = offset, linecount
+    else:
+        first, last = 0, offset + 1
+
+    while first < last:
+        lines = logindex.search(search, levelnames, first, last, forward, SCAN_LINES)
+
+        batch = []
+        for line in lines:
+            start = fileoffsets[line]
+            if line + 1 < linecount:
+                end = fileoffsets[line + 1]
+            else:
+                end = logmap.find(b'\n', start)
+                end = len(logmap) if end == -1 else end + 1
+
+            if len(needle) == 0 or needle in logmap[start:end]:
+                batch.append((line, start, end))
+
+        yield batch
+
+        # Carry on from the last line found, unless the search ran out.
+        if len(lines) < SCAN_LINES:
+            break
+        elif forward is True:
+            first = lines[-1] + 1
+        else:
+            last = lines[-1]
+
 
 # Fetch the log lines to create a page from the current offset and direction.
-def fetch_loglines(logfile, browse, pagesize, linecount, fileoffsets, offset, loglevel, logstr):
+# The log file is memory-mapped; matching lines are found a block at a time and sliced from the map.
+# With a search (of the fields in the log search index and message words), the lines are found with the index.
+def fetch_loglines(logfile, browse, pagesize, linecount, fileoffsets, offset, loglevel, logstr, logindex=None, search=None):
     loglines = []
 
+    # Nothing to show in an empty log.
+    if linecount == 0:
+        return loglines, 0
+
+    offset = max(0, min(offset, (linecount - 1)))
+
     if browse == 'prev':
         # If at the beginning of the file, going back is really showing the first page.
         if offset == 0:
@@ -38,56 +165,160 @@ def fetch_loglines(logfile, browse, pagesize, linecount, fileoffsets, offset, lo
         if offset != (linecount - 1):
             offset = max(0, offset - 1)
 
-    # Use the numeric value returned from the form to set the level filter.
-    filters = []
+    # Use the numeric value returned from the form to set the level filter
+    # (the levels are matched as they appear in the log line, padded).
+    levels = []
     if loglevel > 0:
-        filters = loglevels[loglevel:]
-
-    # Get the lines from the logfile at the offset up to the page size.
-    with open(logfile, 'r') as lf:
-        # Pull lines until we get them all or run out.
-        while len(loglines) < linestofetch:
-            # Pull the log file line offset from the offsets list and seek the log file to that point.
-            seekoffset = fileoffsets[offset]
-            lf.seek(seekoffset, os.SEEK_SET)
-            linedata = lf.readline()
-
-            # Add the log line if filtered (or no filters).
-            if len(filters) == 0 or any(x in linedata for x in filters):
-                if len(logstr) == 0 or logstr in linedata:
-                    loglines.append(((offset + 1), linedata))
-
-            # Going forward, add one to the line offset and stop at end of file.
-            if browse in [None, 'first', 'next']:
-                offset += 1
-                if offset >= linecount:
-                    break
+        levels = [('%-*s' % (LEVEL_END - LEVEL_START, l)).encode() for l in loglevels[loglevel:]]
+
+    needle = logstr.encode('utf-8')
+
+    # Without filters every line is shown, so only a page's worth of lines need to be looked at.
+    if len(levels) == 0 and len(needle) == 0:
+        scanlines = linestofetch
+    else:
+        scanlines = SCAN_LINES
 
-            # Going backward (or last page), subtract from the offset and stop at beginning of file.
-            elif browse in ['prev', 'last']:
-                offset -= 1
-                if offset < 0:
+    # The matching lines found, as (line number, start, end).
+    matches = []
+
+    with open(logfile, 'rb') as lf:
+        try:
+            logmap = mmap.mmap(lf.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty log file can't be mapped.
+            return loglines, 0
+
+        with logmap:
+            forward = browse not in ['prev', 'last']
+
+            # Find lines with the search index if searching, otherwise by checking the lines.
+            if search is not None and len(search) > 0 and logindex is not None:
+                levelnames = loglevels[loglevel:] if loglevel > 0 else []
+                batches = search_index(logmap, fileoffsets, logindex, search, offset, linecount, forward, levelnames, needle)
+            else:
+                batches = scan_blocks(logmap, fileoffsets, offset, linecount, forward, scanlines, levels, needle)
+
+            for batch in batches:
+                matches += batch[0:linestofetch - len(matches)]
+                if len(matches) == linestofetch:
                     break
 
-    # Find out how many lines to pull from the loglines list.
-    lastline = min(pagesize, len(loglines))
+            # Going forward, the lines were found from the offset toward the end of the file.
+            if forward is True:
+                # The offset is the line after the last one shown, or the end of the file.
+                if len(matches) == linestofetch:
+                    offset = int(matches[-1][0]) + 1
+                else:
+                    offset = linecount
 
-    # If going backward (or last page), reverse the list since we walked it backwards.
-    if browse in ['prev', 'last']:
-        loglines = list(reversed(loglines))
+            # Going backward (or last page), the lines were found from the offset toward the beginning of the file.
+            else:
+                # We walked the file backwards, so put the lines back in order.
+                matches = list(reversed(matches))
 
-        # If going backwards, we want the offset (line number) of the start of the first page we are keeping.
-        # Otherwise (last page), we backed up one too many and need to advance by one to set the offset for
-        # the next operation.
-        if browse in ['prev']:
-            offset = loglines[lastline - 1][0]
-        else:
-            offset += 1
+                # Find out how many lines to keep.
+                lastline = min(pagesize, len(matches))
+
+                # If going backwards, we want the offset (line number) of the start of the first page we are keeping.
+                # Otherwise (last page), the offset is the first line shown.
+                if browse in ['prev']:
+                    if lastline > 0:
+                        offset = int(matches[lastline - 1][0]) + 1
+                elif len(matches) == linestofetch:
+                    offset = int(matches[0][0])
+                else:
+                    offset = 0
 
-    # Pull the log data from the log lines list, from start to (number of lines to render).
-    loglines = loglines[0:lastline]
+            # Pull the log data for the lines to render straight from the map.
+            for line, start, end in matches[0:pagesize]:
+                loglines.append(((int(line) + 1), logmap[int(start):int(end)].decode('utf-8', 'replace')))
 
     # Bound the offset to the valid range.
     offset = max(0, min(offset, (linecount - 1)))
 
     return loglines, offset
+
+
+# Worker processes for searching the log archives, started on first use and kept for the life of the
+# server.  They are started by a fork server (or spawned, where there isn't one) that loads only logscan,
+# so they neither copy the threaded server nor start the application.
+archive_pool = None
+archive_pool_mutex = threading.Lock()
+
+
+def get_archive_pool(workers):
+    global archive_pool
+
+    with archive_pool_mutex:
+        if archive_pool is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['logscan'])
+            else:
+                context = multiprocessing.get_context('spawn')
+
+            archive_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+        return archive_pool
+
+
+# Forget the archive search workers after one dies, so the next search starts new ones.
+def reset_archive_pool(pool):
+    global archive_pool
+
+    with archive_pool_mutex:
+        if archive_pool is pool:
+            archive_pool = None
+
+    pool.shutdown(wait=False)
+
+
+# Search the log and its archives ('<logfile>.N.zip', the highest N being the oldest) for lines at the
+# given levels holding the filter string and matching the search (see logscan.scan_archive()), a page at a time.  Each file is searched by a worker process,
+# reading it as a stream and returning at most a page of lines, and the pages are merged in time order.
+# Going forward, the page holds the first lines after the cursor (or the first lines, if None);
+# otherwise, the last lines before the cursor (or the last lines, if None).
+# Returns the lines as (name, line number, line data), with the cursors of the first and last line shown.
+def search_archives(logfile, backupcount, loglevel, logstr, search, cursor, forward, pagesize):
+    levels = []
+    if loglevel > 0:
+        levels = [('%-*s' % (LEVEL_END - LEVEL_START, l)).encode() for l in loglevels[loglevel:]]
+
+    needle = logstr.encode('utf-8')
+
+    # The files to search, oldest first, each with its place in that order as its source number.
+    paths = ['%s.%d.zip' % (logfile, n) for n in range(backupcount, 0, -1)] + [logfile]
+    paths = [p for p in paths if os.path.exists(p)]
+    names = ['%s.zip' % p[len(logfile) + 1:-4] if p != logfile else '' for p in paths]
+
+    if cursor is not None:
+        cursor = tuple(cursor)
+
+    # One worker per file, up to one per CPU.  A search that finds the workers gone tries once more
+    # with new ones.
+    workers = max(1, min(backupcount + 1, os.cpu_count() or 1))
+    for attempt in range(2):
+        pool = get_archive_pool(workers)
+        try:
+            searches = [pool.submit(logscan.scan_archive, path, source, levels, needle, search, cursor, forward, pagesize) for source, path in enumerate(paths)]
+            found = [s.result() for s in searches]
+            break
+
+        except BrokenProcessPool:
+            reset_archive_pool(pool)
+            if attempt > 0:
+                raise
+
+    # Each file's lines are in order, so merge them into one ordered list and keep a page's worth.
+    merged = heapq.merge(*found)
+    if forward is True:
+        page = list(itertools.islice(merged, pagesize))
+    else:
+        page = list(merged)[-pagesize:]
+
+    if len(page) == 0:
+        return [], None, None
+
+    loglines = [(names[key[1]], key[2], linedata) for key, linedata in page]
+    return loglines, list(page[0][0]), list(page[-1][0])
@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+
+#   Copyright 2021-2022 Steve Strublic
+#
+#   This work is the personal property of Steve Strublic, and as such may not be
+#   used, distributed, or modified without my express consent.
+
+import json
+import threading, time
+import traceback
+import uuid
+
+from elections import db, app
+from elections import loggers
+from elections.log import AppLog
+from elections.ballotitems import ITEM_TYPES, get_ballot, is_ranked, bump_event_version
+import elections.counting as counting
+
+# Live results.
+# Each event being watched has one ResultsFeed, holding the current results and the recent changes
+# to them.  A feed thread re-reads the event's tallies when a ballot is recorded in this process, or
+# every RESULTS_STREAM_POLL_TIME seconds to pick up ballots recorded elsewhere, and works out which
+# answers changed.  Viewers stream from the feed (as Server-Sent Events): a snapshot of the results
+# and then the changes, so there is one query per event however many are watching.
+# Tallies only hold first choices, so ranked contests are also counted round by round from their
+# votes when the results page is shown (see count_ranked()); the feed streams their first choices.
+
+# Results snapshots.
+# The results page section is rendered once per event results version and served to every viewer
+# until the version changes, with an ETag so a viewer's browser can revalidate it for free.  The
+# version is read from the database once per request, so ballots recorded by any process count: it
+# is (the last ballot ID handed out by the event's sequence, the event version), where the event
+# version goes up on imports and resets (results_changed()) and changes to ballot items or candidates
+# (invalidate_ballot()).  Ballots only move the sequence, so recording them writes no shared row.
+# Snapshots are per process, so ETags carry a token for the process as well.
+# A locked event can't change, so its snapshot is kept whatever the version.
+snapshots = {}
+snapshots_mutex = threading.Lock()
+
+SNAPSHOT_TOKEN = uuid.uuid4().hex[0:8]
+
+# An event's results version (the event has no version row until it is first changed).
+db.register_statement('results_version', '''SELECT COALESCE(pg_sequence_last_value(('vote_ballotid_' || $2::integer)::regclass), 0) AS ballots,
+                                                   COALESCE((SELECT version FROM event_versions WHERE clubid=$1 AND eventid=$2), 0) AS changes''')
+
+# Ranked contests: every vote (in ballot order, so each ballot's ranks are together) and all candidates.
+db.register_statement('results_ranked_votes', '''SELECT itemid, ballotid, rank, answer FROM votes
+                                                 WHERE clubid=$1 AND eventid=$2 AND itemid = ANY($3)
+                                                 ORDER BY itemid, ballotid, rank''')
+db.register_statement('results_ranked_candidates', '''SELECT itemid, id, fullname FROM candidates
+                                                      WHERE clubid=$1 AND eventid=$2 AND itemid = ANY($3)
+                                                      ORDER BY itemid, id''')
+
+
+# Mark which answers of a ballot item are placed (are winning).
+# answers is the item's list of results, most votes first.  A contest places as many answers as it
+# has positions; a question places its leading answer.  A ranked contest places the candidates
+# elected by its count, or None if it hasn't been counted.
+def place_answers(ballotitem, answers, elected=None):
+    for place, a in enumerate(answers):
+        if is_ranked(ballotitem):
+            a['placed'] = a['answer'] in elected if elected is not None else None
+        elif ITEM_TYPES.CONTEST.value == ballotitem['type']:
+            a['placed'] = place < ballotitem['positions']
+        elif ITEM_TYPES.QUESTION.value == ballotitem['type']:
+            a['placed'] = place == 0
+
+    return answers
+
+
+# Group tally results (rows of itemid, answer, fullname and count; most votes first within an item)
+# by ballot item, with their placed flags.  elected holds the elected candidate IDs of counted
+# ranked contests, keyed by item ID.
+def group_results(ballotitems, votedata, elected={}):
+    results = {}
+    for v in votedata:
+        results.setdefault(v['itemid'], []).append(v)
+
+    for itemid in results:
+        if itemid in ballotitems:
+            place_answers(ballotitems[itemid], results[itemid], elected.get(itemid, None))
+
+    return results
+
+
+# Show a count: whole numbers as they are, fractional STV counts to two places.
+def format_count(count):
+    return '%d' % count if count == int(count) else '%.2f' % count
+
+
+# Count an event's ranked contests round by round.
+# Returns, keyed by item ID, the elected candidate IDs and the rounds for the results page: a row per
+# candidate with their count in each round (None once out of the count) and the round they were
+# elected or eliminated in, plus the exhausted ballots per round.
+def count_ranked(handlekey, clubid, eventid, ballotitems):
+    itemids = [b['itemid'] for b in ballotitems.values() if is_ranked(b)]
+    if len(itemids) == 0:
+        return {}, None
+
+    outsql = [db.statement('results_ranked_candidates', clubid, eventid, itemids),
+              db.statement('results_ranked_votes', clubid, eventid, itemids)]
+    _, data, err = db.sql(outsql, handlekey=handlekey)
+    if err is not None:
+        return None, err
+
+    candidates = {}
+    for c in data[0]:
+        candidates.setdefault(c['itemid'], []).append(c)
+
+    votes = {}
+    for v in data[1]:
+        votes.setdefault(v['itemid'], []).append(v)
+
+    counts = {}
+    for itemid in itemids:
+        itemcandidates = candidates.get(itemid, [])
+        itemvotes = votes.get(itemid, [])
+
+        ballots = counting.build_ballots([v['ballotid'] for v in itemvotes], [v['rank'] for v in itemvotes],
+                                         [v['answer'] for v in itemvotes], [c['id'] for c in itemcandidates])
+        rounds = counting.ranked(ballots, len(itemcandidates), ballotitems[itemid]['positions'])
+
+        rows = []
+        for index, c in enumerate(itemcandidates):
+            row = {'answer': c['id'], 'fullname': c['fullname'], 'counts': [], 'elected': None, 'eliminated': None}
+
+            for r in rounds:
+                out = row['elected'] is not None or row['eliminated'] is not None
+                row['counts'].append(None if out else format_count(r['counts'][index]))
+
+                if index in r['elected']:
+                    row['elected'] = r['round']
+                if index in r['eliminated']:
+                    row['eliminated'] = r['round']
+
+            rows.append(row)
+
+        # Elected candidates first (in the order elected), then the rest by how long they lasted.
+        rows.sort(key=lambda row: (row['elected'] is None, row['elected'] or 0, -(row['eliminated'] or len(rounds) + 1)))
+
+        counts[itemid] = {'elected': [itemcandidates[c]['id'] for c in counting.elected(rounds)],
+                          'rounds': len(rounds),
+                          'candidates': rows,
+                          'exhausted': [format_count(r['exhausted']) for r in rounds]
+                         }
+
+    return counts, None
+
+
+class ResultsFeed:
+    def __init__(self, clubid, eventid):
+        self.clubid = clubid
+        self.eventid = eventid
+
+        # Results: item ID -> ballot item, and item ID -> answers (most votes first).
+        self.ballotitems = {}
+        self.results = {}
+
+        # Every refresh that changes anything bumps the version.  Recent changes are kept as
+        # (version, changes) so viewers that fall behind can catch up; a viewer further behind
+        # than that (or a change to the ballot itself) gets a new snapshot instead.
+        self.version = 0
+        self.snapshot_version = 0
+        self.changes = []
+
+        # Message IDs are '<token>-<version>', so a browser reconnecting to a feed that has since been
+        # stopped and started again (its versions start over) isn't taken to be up to date.
+        self.token = uuid.uuid4().hex[0:8]
+
+        # Viewers are counted from watch() until their response is closed (release()).
+        self.viewers = 0
+        self.thread = None
+        self.condition = threading.Condition()
+        self.wakeup = threading.Event()
+
+    # Re-read the event's results and record what changed.  Called by the feed thread only.
+    def refresh(self):
+        ballotitems, _, err = get_ballot('system', self.clubid, self.eventid)
+        if err is None:
+            _, data, err = db.sql(db.statement('tallies_results', self.clubid, self.eventid), handlekey='system')
+
+        if err is not None:
+            loggers[AppLog.get_id(self.clubid, self.eventid)].error("Results feed: Failed to fetch results: %s" % err)
+            return
+
+        ballotitems = {b['itemid']: b for b in ballotitems}
+        results = group_results(ballotitems, data[0])
+
+        with self.condition:
+            # A changed ballot, or answers dropping out (votes were cleared), needs a new snapshot.
+            changed = set(ballotitems) != set(self.ballotitems) or \
+                      any(ballotitems[i]['positions'] != self.ballotitems[i]['positions'] or
+                          ballotitems[i]['method'] != self.ballotitems[i]['method'] for i in ballotitems)
+
+            for itemid in self.results:
+                answers = [a['answer'] for a in results.get(itemid, [])]
+                if any(a['answer'] not in answers for a in self.results[itemid]):
+                    changed = True
+
+            if changed is True:
+                self.ballotitems = ballotitems
+                self.results = results
+                self.version += 1
+                self.snapshot_version = self.version
+                self.changes = []
+                self.condition.notify_all()
+                return
+
+            changes = []
+            for itemid in results:
+                before = {a['answer']: a for a in self.results.get(itemid, [])}
+                for a in results[itemid]:
+                    old = before.get(a['answer'], None)
+                    if old is None or old['count'] != a['count'] or old['placed'] != a['placed']:
+                        changes.append({'itemid': itemid, 'answer': a['answer'], 'fullname': a['fullname'],
+                                        'count': a['count'], 'placed': a['placed']})
+
+            self.results = results
+
+            if len(changes) > 0:
+                self.version += 1
+                self.changes.append((self.version, changes))
+                self.changes = self.changes[-app.config.get('RESULTS_STREAM_HISTORY'):]
+                self.condition.notify_all()
+
+    # The current results, for a viewer's first message.
+    def snapshot(self):
+        items = {}
+        for itemid in self.ballotitems:
+            b = self.ballotitems[itemid]
+            items[itemid] = {'name': b['name'],
+                             'type': b['type'],
+                             'positions': b['positions'],
+                             'method': b['method'],
+                             'answers': [{'answer': a['answer'], 'fullname': a['fullname'],
+                                          'count': a['count'], 'placed': a['placed']} for a in self.results.get(itemid, [])]
+                            }
+
+        return {'version': self.version, 'items': items}
+
+    # The feed thread: refresh on a wakeup or every poll interval, until nobody is watching.
+    def run(self):
+        logger = loggers[AppLog.get_id(self.clubid, self.eventid)]
+        logger.debug("Results feed: Started")
+
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Results feed: Unexpected exception: %s" % str(e))
+                logger.error(traceback.format_exc())
+
+            self.wakeup.wait(app.config.get('RESULTS_STREAM_POLL_TIME'))
+            self.wakeup.clear()
+
+            with feeds_mutex:
+                if self.viewers == 0:
+                    self.thread = None
+                    feeds.pop((self.clubid, self.eventid), None)
+                    break
+
+        logger.debug("Results feed: Stopped")
+
+    # Stream the results as Server-Sent Events: a snapshot, then changes as they happen.
+    # Each change message is a list of {itemid, answer, fullname, count, placed} for the answers whose
+    # count or placed flag changed.  Comments are sent while nothing changes to keep the connection open.
+    # The stream ends after RESULTS_STREAM_LIFETIME seconds, freeing its server thread; the browser reconnects,
+    # sending the ID of the last message it had (lastid), and picks up from there if the changes since are kept.
+    def stream(self, lastid=None):
+        version = None
+        if lastid is not None:
+            token, _, last = lastid.partition('-')
+            with self.condition:
+                if token == self.token and last.isdigit() is True and int(last) <= self.version:
+                    version = int(last)
+
+        ends = time.monotonic() + app.config.get('RESULTS_STREAM_LIFETIME')
+
+        while time.monotonic() < ends:
+            with self.condition:
+                if version is not None:
+                    timeout = min(app.config.get('RESULTS_STREAM_KEEPALIVE'), max(0, ends - time.monotonic()))
+                    self.condition.wait_for(lambda: self.version > version, timeout=timeout)
+
+                if version is None or version < self.snapshot_version or \
+                   (len(self.changes) > 0 and self.changes[0][0] > version + 1):
+                    version = self.version
+                    messages = ['event: snapshot\nid: %s-%d\ndata: %s\n\n' % (self.token, version, json.dumps(self.snapshot()))]
+                else:
+                    messages = ['event: delta\nid: %s-%d\ndata: %s\n\n' % (self.token, v, json.dumps(c))
+                                for v, c in self.changes if v > version]
+                    version = self.version
+
+            if len(messages) == 0:
+                yield ': keepalive\n\n'
+
+            for m in messages:
+                yield m
+
+
+    # A viewer's stream was closed (or never started).
+    def release(self):
+        with feeds_mutex:
+            self.viewers -= 1
+
+
+# Feeds of the events being watched, keyed by (clubid, eventid).
+feeds = {}
+feeds_mutex = threading.Lock()
+
+
+# Start watching an event's results; returns its feed, started if nobody was watching, or None if
+# RESULTS_STREAM_MAX streams (across all events) are already open.  Each stream holds a server thread.
+# The caller releases the feed (release()) when the stream's response is closed.
+def watch(clubid, eventid):
+    with feeds_mutex:
+        if sum([f.viewers for f in feeds.values()]) >= app.config.get('RESULTS_STREAM_MAX'):
+            return None
+
+        feed = feeds.get((clubid, eventid), None)
+        if feed is None:
+            feed = ResultsFeed(clubid, eventid)
+            feeds[(clubid, eventid)] = feed
+
+        feed.viewers += 1
+
+        if feed.thread is None:
+            feed.thread = threading.Thread(target=feed.run, name='results-%d-%d' % (clubid, eventid), daemon=True)
+            feed.thread.start()
+
+    return feed
+
+
+# An event's results version, read from the database.
+def results_version(handlekey, clubid, eventid):
+    _, data, err = db.sql(db.statement('results_version', clubid, eventid), handlekey=handlekey)
+    if err is not None:
+        return None, err
+
+    return (data[0][0]['ballots'], data[0][0]['changes']), None
+
+
+# The event's results changed (ballots were recorded, or votes imported or cleared): move to a new
+# version and tell the event's feed (if anyone is watching).
+# bump is False for recorded ballots, which move the version on through the ballot ID sequence.
+def results_changed(clubid, eventid, bump=True):
+    if bump is True:
+        bump_event_version(clubid, eventid)
+
+    with feeds_mutex:
+        feed = feeds.get((clubid, eventid), None)
+
+    if feed is not None:
+        feed.wakeup.set()
+
+
+# Get the event's results snapshot if it is current.  Returns the snapshot (None if there isn't a
+# current one), the version a new snapshot should be saved as and any error reading the version.
+def get_snapshot(handlekey, clubid, eventid, locked):
+    version, err = results_version(handlekey, clubid, eventid)
+    if err is not None:
+        return None, None, err
+
+    with snapshots_mutex:
+        snapshot = snapshots.get((clubid, eventid), None)
+
+    if snapshot is not None and (snapshot['version'] == version or (locked is True and snapshot['locked'] is True)):
+        return snapshot, version, None
+
+    return None, version, None
+
+
+# Save the event's results snapshot: the rendered results and the number of ballot items in them.
+# The version must be the one read before fetching the results, so a change while they were being
+# fetched leaves the snapshot out of date rather than hiding the change.
+def save_snapshot(clubid, eventid, version, locked, itemcount, body):
+    snapshot = {'version': version,
+                'locked': locked,
+                'itemcount': itemcount,
+                'body': body,
+                'etag': '%s-%d-%d' % (SNAPSHOT_TOKEN, version[0], version[1])
+               }
+
+    with snapshots_mutex:
+        snapshots[(clubid, eventid)] = snapshot
+
+    return snapshot
@@ -295,6 +295,24 @@ def vote():
     return votes.publicVote()
 
 
+# Ballot submission API (JSON) for kiosks and scanners.
+@main_bp.route('/vote/ballots', methods=['POST'])
+@login_required
+def voteballots():
+    user = current_user.get_id()
+
+    # Generic catchall in case the current user has been invalidated.
+    if current_user.is_active is False:
+        return sessionEnded(user)
+
+    clubid = current_user.clubid
+
+    if user not in ADMINS[clubid]:
+        return unauthorized()
+
+    return votes.submitBallots(user)
+
+
 # Clubs login page.
 if app.config.get('MULTI_TENANCY') is True:
     @main_bp.route('/clubs', methods=['GET', 'POST'])
@@ -926,6 +944,25 @@ def showlog():
     return logdata.showLog(user)
 
 
+# Show database query statistics.
+@main_bp.route('/config/querystats', methods=['GET', 'POST'])
+@login_required
+def querystats():
+    user = current_user.get_id()
+
+    # Generic catchall in case the current user has been invalidated.
+    if current_user.is_active is False:
+        return sessionEnded(user)
+
+    clubid = current_user.clubid
+
+    # Statistics cover the whole system, so only system admins may see them.
+    if user not in ADMINS[clubid] or clubid != 0:
+        return unauthorized()
+
+    return logdata.showQueryStats(user)
+
+
 # Clear logs.
 @main_bp.route('/config/clearlogs', methods=['GET', 'POST'])
 @login_required
@@ -1118,6 +1155,24 @@ def showcandidates():
     return candidates.showCandidates(user)
 
 
+# Merge write-in candidates with similar names.
+@main_bp.route('/candidates/mergewriteins', methods=['GET', 'POST'])
+@login_required
+def mergewriteins():
+    user = current_user.get_id()
+
+    # Generic catchall in case the current user has been invalidated.
+    if current_user.is_active is False:
+        return sessionEnded(user)
+
+    clubid = current_user.clubid
+
+    if user not in ADMINS[clubid]:
+        return unauthorized()
+
+    return candidates.mergeWriteins(user)
+
+
 # Add an event voter.
 @main_bp.route('/voters/addvoter', methods=['GET', 'POST'])
 @login_required
@@ -1136,6 +1191,24 @@ def addvoter():
     return voters.addVoter(user)
 
 
+# Generate event voters in bulk.
+@main_bp.route('/voters/generatevoters', methods=['GET', 'POST'])
+@login_required
+def generatevoters():
+    user = current_user.get_id()
+
+    # Generic catchall in case the current user has been invalidated.
+    if current_user.is_active is False:
+        return sessionEnded(user)
+
+    clubid = current_user.clubid
+
+    if user not in ADMINS[clubid]:
+        return unauthorized()
+
+    return voters.generateVoters(user)
+
+
 # Edit an event voter.
 @main_bp.route('/voters/editvoter', methods=['GET', 'POST'])
 @login_required
@@ -1208,6 +1281,42 @@ def addvote():
     return votes.addVote(user)
 
 
+# Stream event vote results as they change (Server-Sent Events).
+@main_bp.route('/results/stream', methods=['GET'])
+@login_required
+def resultsstream():
+    user = current_user.get_id()
+
+    # Generic catchall in case the current user has been invalidated.
+    if current_user.is_active is False:
+        return sessionEnded(user)
+
+    clubid = current_user.clubid
+
+    if user not in ADMINS[clubid]:
+        return unauthorized()
+
+    return votes.streamResults(user)
+
+
+# Enter paper ballots in bulk.
+@main_bp.route('/votes/enterballots', methods=['GET', 'POST'])
+@login_required
+def enterballots():
+    user = current_user.get_id()
+
+    # Generic catchall in case the current user has been invalidated.
+    if current_user.is_active is False:
+        return sessionEnded(user)
+
+    clubid = current_user.clubid
+
+    if user not in ADMINS[clubid]:
+        return unauthorized()
+
+    return votes.enterBallots(user)
+
+
 # Show event vote results.
 @main_bp.route('/votes/showresults', methods=['GET', 'POST'])
 @login_required
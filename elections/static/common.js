@@ -277,6 +277,10 @@ function showBallotItemFields() {
   document.getElementById("positions").hidden = hidden;
   document.getElementById("positionsspacer1").hidden = hidden;
   document.getElementById("positionsspacer2").hidden = hidden;
+  document.getElementById("methodlabel").hidden = hidden;
+  document.getElementById("method").hidden = hidden;
+  document.getElementById("methodspacer1").hidden = hidden;
+  document.getElementById("methodspacer2").hidden = hidden;
   document.getElementById("writeinslabel").hidden = hidden;
   document.getElementById("writeins").hidden = hidden;
   document.getElementById("writeinsspacer1").hidden = hidden;
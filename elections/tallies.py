@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+#   Copyright 2021-2022 Steve Strublic
+#
+#   This work is the personal property of Steve Strublic, and as such may not be
+#   used, distributed, or modified without my express consent.
+
+from elections import db
+from elections import loggers
+from elections.log import AppLog
+
+# The vote_tallies table holds a running count of votes per (club, event, item, answer).
+# Each ballot bumps its answers' counts in the same transaction that records the votes (the add_ballot()
+# database function does this), so results read a row per candidate rather than counting every vote.
+# The counts can always be rebuilt from the votes themselves, which imports do and startup does when
+# verification finds a difference.
+# Only first choices (rank 1) are tallied, which is every vote in a plurality contest; ranked contests
+# are counted round by round from their votes (see counting.py).
+
+# Results: each answer's count, with the candidate name for contests.
+db.register_statement('tallies_results', '''SELECT vote_tallies.itemid, vote_tallies.answer, candidates.fullname, vote_tallies.votecount AS count
+                                            FROM vote_tallies
+                                            LEFT JOIN candidates ON candidates.eventid=vote_tallies.eventid AND candidates.itemid=vote_tallies.itemid
+                                                                    AND candidates.id=vote_tallies.answer
+                                            WHERE vote_tallies.clubid=$1 AND vote_tallies.eventid=$2 AND vote_tallies.votecount > 0
+                                            ORDER BY itemid ASC, count DESC''')
+
+# Answers whose stored count differs from the votes table.
+db.register_statement('tallies_verify', '''SELECT COALESCE(counted.itemid, vote_tallies.itemid) AS itemid,
+                                                  COALESCE(counted.answer, vote_tallies.answer) AS answer,
+                                                  COALESCE(counted.votecount, 0) AS counted,
+                                                  COALESCE(vote_tallies.votecount, 0) AS tallied
+                                           FROM (SELECT itemid, answer, COUNT(*) AS votecount
+                                                 FROM votes
+                                                 WHERE clubid=$1 AND eventid=$2 AND rank=1
+                                                 GROUP BY itemid, answer) AS counted
+                                           FULL OUTER JOIN (SELECT * FROM vote_tallies WHERE clubid=$1 AND eventid=$2) AS vote_tallies
+                                                ON vote_tallies.itemid=counted.itemid AND vote_tallies.answer=counted.answer
+                                           WHERE COALESCE(counted.votecount, 0) != COALESCE(vote_tallies.votecount, 0)''')
+
+
+# Statements that recount an event's tallies from its votes.
+def rebuild_sql(clubid, eventid):
+    return ['''DELETE FROM vote_tallies
+               WHERE clubid='%d' AND eventid='%d';
+            ''' % (clubid, eventid),
+            '''INSERT INTO vote_tallies (clubid, eventid, itemid, answer, votecount)
+               SELECT clubid, eventid, itemid, answer, COUNT(*)
+               FROM votes
+               WHERE clubid='%d' AND eventid='%d' AND rank=1
+               GROUP BY clubid, eventid, itemid, answer;
+            ''' % (clubid, eventid)]
+
+
+# Statement that removes an event's tallies.
+def clear_sql(clubid, eventid):
+    return '''DELETE FROM vote_tallies
+              WHERE clubid='%d' AND eventid='%d';
+           ''' % (clubid, eventid)
+
+
+# Recount an event's tallies from its votes.
+def rebuild(user, clubid, eventid):
+    _, _, err = db.sql(rebuild_sql(clubid, eventid), handlekey=user)
+
+    if err is not None:
+        loggers[AppLog.get_id(clubid, eventid)].error("Failed to rebuild vote tallies: %s" % err)
+
+    return err
+
+
+# Compare an event's tallies with its votes.  Returns the list of mismatched answers (empty if all agree).
+def verify(user, clubid, eventid):
+    _, data, _ = db.sql(db.statement('tallies_verify', clubid, eventid), handlekey=user)
+
+    return data[0]
+
+
+# Verify an event's tallies and rebuild them if they disagree with the votes.
+def verify_and_repair(user, clubid, eventid):
+    logger = loggers[AppLog.get_id(clubid, eventid)]
+
+    mismatches = verify(user, clubid, eventid)
+    if len(mismatches) == 0:
+        return None
+
+    logger.warning("Vote tallies differ from votes for %d answers; rebuilding" % len(mismatches))
+    for m in mismatches[0:10]:
+        logger.warning("Item %d answer %d: %d votes, %d tallied" % (m['itemid'], m['answer'], m['counted'], m['tallied']), indent=1)
+
+    return rebuild(user, clubid, eventid)
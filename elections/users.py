@@ -26,6 +26,10 @@ from elections import EVENTCONFIG, USERTYPES, USERS, ADMINS, ALLUSERS
 from elections.events import EventConfig
 from elections.log import AppLog
 
+# Prepared statements for user lookups done on every login and request.
+db.register_statement('users_by_name', 'SELECT * FROM users WHERE clubid=$1 AND username=$2')
+db.register_statement('users_by_publickey', 'SELECT * FROM users WHERE publickey=$1')
+
 # Users are per-club.
 class User(UserMixin):
     def __init__(self, username, usertype="Public", fullname="", clubid=0, eventid=0,
@@ -143,11 +147,7 @@ class User(UserMixin):
     # Find a user in the database.
     def find_user(username, clubid=0):
         # If the user is in the database, retrieve the user data.
-        outsql = '''SELECT *
-                    FROM users
-                    WHERE clubid='%d' AND username='%s';
-                    ''' % (clubid, username.replace("'", "''"))
-        _, userdata, _ = db.sql(outsql, handlekey='system')
+        _, userdata, _ = db.sql(db.statement('users_by_name', clubid, username), handlekey='system')
         # The return data is the first 'dbresults' in the list.
         userdata = userdata[0]
 
@@ -159,11 +159,7 @@ class User(UserMixin):
 
     # Find a user by public key.  Public keys are unique so assured to find the specific one we want.
     def find_user_by_public_key(key):
-        outsql = '''SELECT *
-                    FROM users
-                    WHERE publickey='%s';
-                    ''' % (key)
-        _, userdata, _ = db.sql(outsql, handlekey='system')
+        _, userdata, _ = db.sql(db.statement('users_by_publickey', key), handlekey='system')
 
         # The return data is the first 'dbresults' in the list.
         userdata = userdata[0]
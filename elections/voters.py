@@ -5,15 +5,57 @@
 #   This work is the personal property of Steve Strublic, and as such may not be
 #   used, distributed, or modified without my express consent.
 
+import os
 import traceback
-import random, string
+import secrets
 
 from flask import redirect, render_template, url_for, request, session
 from flask_login import current_user
+from werkzeug.utils import secure_filename
 
 from elections import db, app
 from elections import ADMINS
 from elections.clubs import isValidEmail
+import elections.configdata as configdata
+
+
+# Prepared statements for voter lookups and changes.
+# Values are bound as parameters, so names no longer need apostrophes escaped.
+db.register_statement('voters_all', 'SELECT * FROM voters WHERE clubid=$1 AND eventid=$2')
+db.register_statement('voters_by_id', 'SELECT * FROM voters WHERE clubid=$1 AND eventid=$2 AND id=$3')
+db.register_statement('voters_by_name', 'SELECT * FROM voters WHERE clubid=$1 AND eventid=$2 AND fullname=$3')
+db.register_statement('voters_by_other_name', 'SELECT * FROM voters WHERE clubid=$1 AND eventid=$2 AND fullname=$3 AND id!=$4')
+db.register_statement('voters_by_voteid', 'SELECT * FROM voters WHERE clubid=$1 AND eventid=$2 AND voteid=$3')
+db.register_statement('voters_add', '''INSERT INTO voters(clubid, eventid, firstname, lastname, fullname, email, voteid, voted)
+                                       VALUES($1, $2, $3, $4, $5, $6, $7, False)''')
+db.register_statement('voters_update', '''UPDATE voters
+                                          SET firstname=$1, lastname=$2, fullname=$3, email=$4
+                                          WHERE clubid=$5 AND eventid=$6 AND id=$7''')
+db.register_statement('voters_remove', 'DELETE FROM voters WHERE clubid=$1 AND eventid=$2 AND id=$3')
+db.register_statement('voters_keys', 'SELECT fullname, voteid FROM voters WHERE clubid=$1 AND eventid=$2')
+
+# Voter IDs are 10 digit numbers.  An ID is all a voter needs to vote, so they come from the
+# secrets module rather than a predictable generator.
+VOTEID_DIGITS = 10
+
+
+# A new random voter ID.
+def new_voteid():
+    return '%0*d' % (VOTEID_DIGITS, secrets.randbelow(10 ** VOTEID_DIGITS))
+
+
+# Generate count voter IDs that are not in used (a set of the IDs the event already has), adding
+# them to it.  Collisions are caught here, so the database's unique constraint is only a safety net.
+def generate_voteids(count, used):
+    voteids = []
+    while len(voteids) < count:
+        voteid = new_voteid()
+        if voteid not in used:
+            used.add(voteid)
+            voteids.append(voteid)
+
+    return voteids
+
 
 # Show voters.
 def showVoters(user):
@@ -25,11 +67,7 @@ def showVoters(user):
 
         current_user.logger.info("Displaying: Show voters")
 
-        outsql = '''SELECT *
-                    FROM voters
-                    WHERE clubid='%d' AND eventid='%d';
-                 ''' % (current_user.event.clubid, current_user.event.eventid)
-        _, data, _ = db.sql(outsql, handlekey=user)
+        _, data, _ = db.sql(db.statement('voters_all', current_user.event.clubid, current_user.event.eventid), handlekey=user)
 
         voterdata = data[0]
 
@@ -112,8 +150,7 @@ def addVoter(user):
                 if value is None:
                     entryfields[field]['value'] = ''
                 else:
-                    # Escape apostrophes.
-                    entryfields[field]['value'] = value.replace("'", "''").strip()
+                    entryfields[field]['value'] = value.strip()
 
             if saving is True:
                 failed = False
@@ -135,10 +172,7 @@ def addVoter(user):
                     fullname = '%s %s' % (entryfields['firstname']['value'], entryfields['lastname']['value'])
 
                     # Verify there are no voters with the same name.
-                    outsql = '''SELECT *
-                                FROM voters
-                                WHERE clubid='%d' AND eventid='%d' AND fullname='%s';
-                                ''' % (current_user.event.clubid, current_user.event.eventid, fullname)
+                    outsql = db.statement('voters_by_name', current_user.event.clubid, current_user.event.eventid, fullname)
                     _, data, _ = db.sql(outsql, handlekey=user)
 
                     duplicates = data[0]
@@ -149,23 +183,18 @@ def addVoter(user):
                     # Generate a random 10 digit ID for this voter.
                     unique = False
                     while unique is False:
-                        voteid = ''.join(random.choices(string.digits, k=10))
+                        voteid = new_voteid()
 
                         # Verify uniqueness.
-                        outsql = '''SELECT *
-                                    FROM voters
-                                    WHERE clubid='%d' AND eventid='%d' AND voteid='%s';
-                                 ''' % (current_user.event.clubid, current_user.event.eventid, voteid)
+                        outsql = db.statement('voters_by_voteid', current_user.event.clubid, current_user.event.eventid, voteid)
                         _, data, _ = db.sql(outsql, handlekey=user)
 
                         if data is None or len(data[0]) == 0:
                             unique = True
 
                     # Add the voter.
-                    outsql = '''INSERT INTO voters(clubid, eventid, firstname, lastname, fullname, email, voteid, voted)
-                                VALUES('%d', '%d', '%s', '%s', '%s', '%s', '%s', False);
-                                ''' % (current_user.event.clubid, current_user.event.eventid,
-                                    entryfields['firstname']['value'], entryfields['lastname']['value'], fullname, entryfields['email']['value'], voteid)
+                    outsql = db.statement('voters_add', current_user.event.clubid, current_user.event.eventid,
+                                          entryfields['firstname']['value'], entryfields['lastname']['value'], fullname, entryfields['email']['value'], voteid)
                     _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
 
                     # On error to update the database, return and print out the error (like "System is in read only mode").
@@ -222,11 +251,7 @@ def editVoter(user):
             current_user.logger.flashlog("Edit voter failure", "Voter ID must be a number." % voterid)
             return redirect(url_for('main_bp.showvoters'))
 
-        outsql = '''SELECT *
-                    FROM voters
-                    WHERE clubid='%d' AND eventid='%d' AND id='%s';
-                    ''' % (current_user.event.clubid, current_user.event.eventid, voterid)
-        _, data, _ = db.sql(outsql, handlekey=user)
+        _, data, _ = db.sql(db.statement('voters_by_id', current_user.event.clubid, current_user.event.eventid, voterid), handlekey=user)
 
         voter = data[0]
         if len(voter) == 0:
@@ -259,8 +284,7 @@ def editVoter(user):
                 if value is None:
                     entryfields[field]['value'] = ''
                 else:
-                    # Escape apostrophes.
-                    entryfields[field]['value'] = value.replace("'", "''").strip()
+                    entryfields[field]['value'] = value.strip()
 
             failed = False
 
@@ -292,10 +316,7 @@ def editVoter(user):
                     fullname = '%s %s' % (entryfields['firstname']['value'], entryfields['lastname']['value'])
 
                     # Verify there are no other voters for this voter with the same name.
-                    outsql = '''SELECT *
-                                FROM voters
-                                WHERE clubid='%d' AND eventid='%d' AND fullname='%s' AND id!='%d';
-                                ''' % (current_user.event.clubid, current_user.event.eventid, fullname, voter['id'])
+                    outsql = db.statement('voters_by_other_name', current_user.event.clubid, current_user.event.eventid, fullname, voter['id'])
                     _, data, _ = db.sql(outsql, handlekey=user)
 
                     duplicates = data[0]
@@ -305,14 +326,8 @@ def editVoter(user):
 
                     if failed is False:
                         # Add the voter.
-                        outsql = '''UPDATE voters
-                                    SET firstname='%s',
-                                        lastname='%s',
-                                        fullname='%s',
-                                        email='%s'
-                                    WHERE clubid='%d' AND eventid='%d' AND id='%d';
-                                ''' % (entryfields['firstname']['value'], entryfields['lastname']['value'], fullname, entryfields['email']['value'],
-                                        current_user.event.clubid, current_user.event.eventid, voter['id'])
+                        outsql = db.statement('voters_update', entryfields['firstname']['value'], entryfields['lastname']['value'], fullname,
+                                              entryfields['email']['value'], current_user.event.clubid, current_user.event.eventid, voter['id'])
                         _, _, err = db.sql(outsql, handlekey=current_user.get_userid())
 
                         # On error to update the database, return and print out the error (like "System is in read only mode").
@@ -386,11 +401,7 @@ def removeVoter(user):
             return redirect(url_for('main_bp.showvoters'))
 
         # Fetch the voter to remove.
-        outsql = '''SELECT *
-                    FROM voters
-                    WHERE clubid='%d' AND eventid='%d' AND id='%d';
-                 ''' % (current_user.event.clubid, current_user.event.eventid, voterid)
-        _, data, _ = db.sql(outsql, handlekey=user)
+        _, data, _ = db.sql(db.statement('voters_by_id', current_user.event.clubid, current_user.event.eventid, voterid), handlekey=user)
 
         voter = data[0]
         if len(voter) == 0:
@@ -442,9 +453,7 @@ def removeVoter(user):
         if saving is True:
             current_user.logger.debug("Remove voters: Removing voter '%d'" % voterid, indent=1)
 
-            outsql = '''DELETE FROM voters
-                         WHERE clubid='%d' AND eventid='%d' AND id='%d';
-                     ''' % (current_user.event.clubid, current_user.event.eventid, voterid)
+            outsql = db.statement('voters_remove', current_user.event.clubid, current_user.event.eventid, voterid)
 
             _, _, err = db.sql(outsql, handlekey=user)
 
@@ -469,3 +478,187 @@ def removeVoter(user):
 
         # Redirect to the main page to display the exception and prevent recursive loops.
         return redirect(url_for('main_bp.index'))
+
+
+# Generate voters in bulk, from a member list (CSV/XLSX file or rows pasted from a spreadsheet) or
+# as a number of unnamed voters ('Voter 1', 'Voter 2', ...).  Names are checked against each other
+# and the event's voters, voter IDs are generated in memory and all the voters are added with one
+# bulk load.  Nothing is added if any member is rejected.  The new voters and their IDs are given
+# out as a voter ID sheet to download.
+def generateVoters(user):
+    try:
+        # Since these buttons are in the form area on this page, we have to handle in code.
+        option = request.values.get('redirect')
+        if option is not None:
+            return redirect(url_for('main_bp.%s' % option))
+
+        if request.values.get('cancelbutton'):
+            current_user.logger.flashlog(None, "Generate voters operation canceled.", 'info')
+            return redirect(url_for('main_bp.generatevoters'))
+
+        event = current_user.event
+        handlekey = current_user.get_userid()
+
+        current_user.logger.info("Displaying: Generate voters")
+
+        filepath = None
+        filename = None
+        count = request.values.get('count', '').strip()
+
+        def render():
+            return render_template('voters/generatevoters.html', user=user, admins=ADMINS[event.clubid],
+                                   filepath=filepath, filename=filename, count=count, maxvoters=app.config.get('VOTER_GENERATE_MAX'),
+                                   configdata=current_user.get_render_data())
+
+        # Check if the event is locked.
+        if event.locked is True:
+            current_user.logger.flashlog("Generate voters failure", "This Event is locked and cannot add voters.")
+            return render()
+
+        if request.values.get('savebutton') is None:
+            return render()
+
+        current_user.logger.debug("Generating voters: Generating requested", indent=1)
+
+        memberfile = request.files.get('file', None)
+        pasted = request.values.get('memberdata', '').strip()
+        members = None
+
+        if (memberfile is not None and memberfile.filename != '') or len(pasted) > 0:
+            basepath = os.path.join(os.getcwd(), app.config.get('IMPORT_UPLOAD_FOLDER'))
+            if not os.path.exists(basepath):
+                os.makedirs(basepath)
+
+            # Uploaded files and pasted rows are saved per user, so admins generating at once don't collide.
+            if memberfile is not None and memberfile.filename != '':
+                if not configdata.allowed_file(memberfile.filename, configdata.BALLOT_EXTENSIONS):
+                    current_user.logger.flashlog("Generate voters failure", "Unsupported file type (Valid types: %s)." % ', '.join(configdata.BALLOT_EXTENSIONS))
+                    return render()
+
+                memberpath = os.path.join(basepath, 'members_%s_%s' % (handlekey, secure_filename(memberfile.filename)))
+                memberfile.save(memberpath)
+            else:
+                memberpath = os.path.join(basepath, 'members_%s.csv' % handlekey)
+                with open(memberpath, 'w', encoding='utf-8') as f:
+                    f.write(pasted)
+
+            try:
+                members = configdata.readMemberData(memberpath)
+
+            except configdata.ImportParseError as e:
+                for error in e.args[0]:
+                    current_user.logger.flashlog("Generate voters failure", error)
+                return render()
+
+            except IOError as e:
+                current_user.logger.flashlog("Generate voters failure", str(e))
+                return render()
+
+            finally:
+                os.remove(memberpath)
+
+            if len(members) == 0:
+                current_user.logger.flashlog("Generate voters failure", "The member list is empty.")
+                return render()
+
+            requested = len(members)
+
+        elif len(count) > 0:
+            try:
+                requested = int(count)
+            except:
+                requested = 0
+
+            if requested <= 0:
+                current_user.logger.flashlog("Generate voters failure", "The number of voters must be a positive number.")
+                return render()
+
+        else:
+            current_user.logger.flashlog("Generate voters failure", "Please choose a file, paste the member rows or enter a number of voters.")
+            return render()
+
+        if requested > app.config.get('VOTER_GENERATE_MAX'):
+            current_user.logger.flashlog("Generate voters failure", "At most %d voters can be generated at once." % app.config.get('VOTER_GENERATE_MAX'))
+            return render()
+
+        # The event's voter names and IDs, to check against in memory.
+        _, data, err = db.sql(db.statement('voters_keys', event.clubid, event.eventid), handlekey=user)
+        if err is not None:
+            current_user.logger.flashlog("Generate voters failure", err)
+            return render()
+
+        names = set(v['fullname'] for v in data[0])
+        used = set(v['voteid'] for v in data[0])
+
+        voters = []
+        if members is not None:
+            errors = []
+            for m in members:
+                # Pasted and CSV cells may carry spaces, and XLSX cells may be numbers.
+                firstname = str(m['firstname']).strip() if m['firstname'] is not None else ''
+                lastname = str(m['lastname']).strip() if m['lastname'] is not None else ''
+                email = str(m['email']).strip() if m.get('email', None) is not None else ''
+                fullname = '%s %s' % (firstname, lastname)
+
+                if len(firstname) == 0 or len(lastname) == 0:
+                    errors.append("Row %d: First and last names cannot be empty." % m['row'])
+                elif not isValidEmail(email):
+                    errors.append("Row %d: Email address '%s' is not in a standard format." % (m['row'], email))
+                elif fullname in names:
+                    errors.append("Row %d: Voter '%s' already exists for this Event." % (m['row'], fullname))
+                else:
+                    names.add(fullname)
+                    voters.append({'firstname': firstname, 'lastname': lastname, 'fullname': fullname, 'email': email})
+
+            if len(errors) > 0:
+                current_user.logger.flashlog("Generate voters failure", "%d members were rejected and no voters were added:" % len(errors), large=True)
+                for error in errors[0:50]:
+                    current_user.logger.flashlog("Generate voters failure", error, indent=True)
+
+                if len(errors) > 50:
+                    current_user.logger.flashlog("Generate voters failure", "(and %d more)" % (len(errors) - 50), indent=True)
+
+                return render()
+        else:
+            # Number the unnamed voters on from any already generated.
+            number = 0
+            while len(voters) < requested:
+                number += 1
+                fullname = 'Voter %d' % number
+                if fullname not in names:
+                    names.add(fullname)
+                    voters.append({'firstname': 'Voter', 'lastname': '%d' % number, 'fullname': fullname, 'email': ''})
+
+        for v, voteid in zip(voters, generate_voteids(len(voters), used)):
+            v['voteid'] = voteid
+
+        rows = [(event.clubid, event.eventid, v['firstname'], v['lastname'], v['fullname'], v['email'], v['voteid'], False) for v in voters]
+        load = db.BulkLoad('voters', ['clubid', 'eventid', 'firstname', 'lastname', 'fullname', 'email', 'voteid', 'voted'], rows)
+
+        current_user.logger.debug("Generating voters: Adding %d voters" % len(rows), indent=1)
+        _, _, err = db.sql([load], handlekey=handlekey)
+
+        # On error to update the database, return and print out the error (like "System is in read only mode").
+        if err is not None:
+            current_user.logger.flashlog("Generate voters failure", "No voters were added:", large=True)
+            current_user.logger.flashlog("Generate voters failure", err, indent=True)
+            return render()
+
+        # Voter IDs are only given out in the sheet, not logged.
+        filename = configdata.writeVoterIdFile(event, voters)
+        filepath = url_for('main_bp.exportfile', filename=filename)
+        count = ''
+
+        current_user.logger.flashlog(None, "Generated %d voters." % load.count, 'info', large=True, highlight=True, propagate=True)
+        current_user.logger.info("Generate voters: Added %d voters by %s in %.3f sec (%.0f rows/sec)" % (load.count, load.method, load.elapsed, load.rate()), indent=1)
+        current_user.logger.info("Generate voters: Operation completed")
+
+        return render()
+
+    except Exception as e:
+        current_user.logger.flashlog("Generate voters failure", "Exception: %s" % str(e), propagate=True)
+        current_user.logger.error("Unexpected exception:")
+        current_user.logger.error(traceback.format_exc())
+
+        # Redirect to the main page to display the exception and prevent recursive loops.
+        return redirect(url_for('main_bp.index'))
@@ -5,10 +5,15 @@
 #   This work is the personal property of Steve Strublic, and as such may not be
 #   used, distributed, or modified without my express consent.
 
+import os
 import traceback
+import hashlib
 
-from flask import redirect, render_template, url_for, request
+import psycopg2
+
+from flask import redirect, render_template, url_for, request, jsonify, session, Response, make_response
 from flask_login import current_user
+from werkzeug.utils import secure_filename
 
 from elections import db, app, EVENTCONFIG
 from elections import loggers
@@ -16,7 +21,105 @@ from elections.log import AppLog
 from elections.events import EventConfig
 
 from elections import ADMINS
-from elections.ballotitems import ITEM_TYPES
+from elections.ballotitems import ITEM_TYPES, get_ballot, is_ranked, name_key
+import elections.tallies as tallies
+import elections.configdata as configdata
+import elections.results as results
+
+
+# Prepared statements for the voting path.
+db.register_statement('votes_voter_by_voteid', 'SELECT * FROM voters WHERE voteid=$1')
+db.register_statement('votes_event', 'SELECT * FROM events WHERE eventid=$1')
+db.register_statement('votes_club', 'SELECT clubname, icon, homeimage FROM clubs WHERE clubid=$1')
+db.register_statement('votes_voter', 'SELECT * FROM voters WHERE clubid=$1 AND eventid=$2 AND voteid=$3')
+db.register_statement('votes_voters', 'SELECT voteid, voted FROM voters WHERE clubid=$1 AND eventid=$2 AND voteid = ANY($3)')
+
+# Record a whole ballot with one call to the add_ballot() database function (see schema/elections.sql),
+# which locks the voter, adds write-ins, takes the ballot ID, inserts the votes, counts them and marks
+# the voter as voted in one transaction.  It returns a NULL ballot ID if the voter has already voted.
+db.register_statement('votes_add_ballot', 'SELECT add_ballot($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11) AS ballotid', write=True)
+
+
+# The add_ballot() call for a ballot.
+# answers is keyed by item ID, each a list of votes; write-in votes carry the candidate's temporary ID,
+# which is looked up in candidates to get the name, and the database gives them their real ID.
+# Write-ins always go by name: the database matches one naming an existing candidate (ignoring case and
+# spacing) to them, so a ballot never carries a candidate ID the cached ballot might have out of date.
+# Votes in ranked contests carry their rank; all others are rank 1.
+def add_ballot_sql(clubid, eventid, voterid, answers, candidates, ballotitems):
+    itemids = []
+    choices = []
+    ranks = []
+    writein_itemids = []
+    writein_firstnames = []
+    writein_lastnames = []
+    writein_fullnames = []
+    writein_ranks = []
+
+    for itemid in answers:
+        for answer in answers[itemid]:
+            if answer.get('writein', False) is True:
+                candidate = list(filter(lambda c: str(c['id']) == answer['answer'], candidates[itemid]))[0]
+
+                writein_itemids.append(itemid)
+                writein_firstnames.append(candidate['firstname'])
+                writein_lastnames.append(candidate['lastname'])
+                writein_fullnames.append(candidate['fullname'])
+                writein_ranks.append(answer.get('rank', 1))
+            else:
+                itemids.append(itemid)
+                choices.append(int(answer['answer']))
+                ranks.append(answer.get('rank', 1))
+
+    return db.statement('votes_add_ballot', clubid, eventid, str(voterid), itemids, choices, ranks,
+                        writein_itemids, writein_firstnames, writein_lastnames, writein_fullnames, writein_ranks)
+
+
+# Read a candidate's selection from the voting page.
+# A plurality contest's checkbox is only sent when checked; a ranked contest sends every candidate's
+# rank, which is empty for those not ranked.  Returns the rank (always 1 in a plurality contest), or
+# None if the candidate was not selected.
+def contest_choice(ballotitem, candidateid):
+    value = request.values.get('contest_%d_%s' % (ballotitem['itemid'], candidateid), None)
+    if value is None or len(value) == 0:
+        return None
+
+    if is_ranked(ballotitem) is False:
+        return 1
+
+    try:
+        return int(value)
+    except:
+        return None
+
+
+# Put a ranked contest's votes in order of rank and number them from 1, so gaps in the ranks
+# the voter gave don't matter.  Returns an error if two candidates were given the same rank.
+def order_ranks(votes):
+    ranks = [v['rank'] for v in votes]
+    if len(set(ranks)) != len(ranks):
+        return "Each candidate must be given a different rank."
+
+    votes.sort(key=lambda v: v['rank'])
+    for rank, v in enumerate(votes, 1):
+        v['rank'] = rank
+
+    return None
+
+
+# Check a contest's votes name each candidate once, comparing names the way the database matches them
+# (ignoring case and spacing).  Returns an error, or None if there are no duplicates.
+def check_duplicates(votes):
+    seen = set()
+    for v in votes:
+        key = name_key(v['candidate'])
+        if key in seen:
+            return "Candidate %s is selected more than once." % v['candidate']
+
+        seen.add(key)
+
+    return None
+
 
 def publicVote():
     logger = loggers[AppLog.get_id()]
@@ -42,11 +145,7 @@ def publicVote():
             return render_template('votes/vote.html', voterid=None, configdata=configdata)
 
         # Verify the voter Id.
-        outsql = '''SELECT *
-                    FROM voters
-                    WHERE voteid='%s';
-                 ''' % voterid
-        _, data, _ = db.sql(outsql, handlekey='system')
+        _, data, _ = db.sql(db.statement('votes_voter_by_voteid', voterid), handlekey='system')
 
         if data is None or len(data[0]) == 0:
             logger.flashlog("Public vote failure", "Voter ID '%s' was not found." % voterid)
@@ -58,11 +157,7 @@ def publicVote():
         eventid = voter['eventid']
 
         event = None
-        outsql = '''SELECT *
-                    FROM events
-                    WHERE eventid='%d';
-                ''' % eventid
-        _, result, _ = db.sql(outsql, handlekey='system')
+        _, result, _ = db.sql(db.statement('votes_event', eventid), handlekey='system')
 
         # The result is the first 'dbresults' in the list.
         result = result[0]
@@ -74,8 +169,7 @@ def publicVote():
             configdata = event.get_event_render_data()
             return render_template('votes/voted.html', user=None, admins=None, success=False, configdata=configdata)
         else:
-            outsql = '''SELECT clubname, icon, homeimage FROM clubs WHERE clubid='%d';''' % clubid
-            _, data, _ = db.sql(outsql, handlekey='system')
+            _, data, _ = db.sql(db.statement('votes_club', clubid), handlekey='system')
             club = data[0][0]
 
             # Create an EventConfig instance and initialize from the global config, with session data and the chosen event ID.
@@ -185,11 +279,7 @@ def addVote(user, voterid=None, event=None, external=False):
             eventlogger.debug("Adding a vote: voter ID '%s'" % voterid)
 
             # Find the vote ID in the voter table for this event.
-            outsql = '''SELECT *
-                        FROM voters
-                        WHERE clubid='%d' AND eventid='%d' AND voteid='%s';
-                        ''' % (event.clubid, event.eventid, voterid)
-            _, data, _ = db.sql(outsql, handlekey=handlekey)
+            _, data, _ = db.sql(db.statement('votes_voter', event.clubid, event.eventid, voterid), handlekey=handlekey)
 
             if data is None or len(data[0]) == 0:
                 return return_err("Voter ID '%s' was not found." % voterid, 'main_bp.addvote')
@@ -203,54 +293,10 @@ def addVote(user, voterid=None, event=None, external=False):
 
             eventlogger.debug("Adding a vote: Fetching ballot items and candidates")
 
-            # Fetch all the ballots and candidates for contests.
-            outsql = ['''SELECT *
-                         FROM ballotitems
-                         WHERE clubid='%d' AND eventid='%d'
-                         ORDER BY itemid ASC;
-                      ''' % (event.clubid, event.eventid)]
-
-            # Only fetch the preconfigured candidates.
-            # The voter must be free to write in their own candidates without influence.
-            outsql.append('''SELECT *
-                             FROM candidates
-                             WHERE clubid='%d' AND eventid='%d' AND writein=False
-                             ORDER by itemid ASC, lastname ASC;
-                          ''' % (event.clubid, event.eventid))
-
-            _, data, _ = db.sql(outsql, handlekey=handlekey)
-            ballotitems = data[0]
-            candidates = {}
-            for c in data[1]:
-                # Indicate the item is not newly added by a voter as a write-in candidate.
-                c['new'] = False
-                itemid = c['itemid']
-                if itemid not in candidates:
-                    candidates[itemid] = [c]
-                else:
-                    candidates[itemid].append(c)
-
-            eventlogger.debug("Adding a vote: Parsing ballot items")
-
-            # Append N write-in candidates (N = number of ballot item positions).
-            for b in ballotitems:
-                if ITEM_TYPES.CONTEST.value == b['type']:
-                    itemid = b['itemid']
-
-                    for r in range(0, b['positions']):
-                        writein = {'id': 'writein_%d' % (r + 1),
-                                   'itemid': itemid,
-                                   'firstname': '',
-                                   'lastname': '',
-                                   'fullname': '',
-                                   'writein': True,
-                                   'new': True
-                                  }
-
-                        if itemid not in candidates:
-                            candidates[itemid] = [writein]
-                        else:
-                            candidates[itemid].append(writein)
+            # The ballot definition (items, candidates and write-in slots) comes from the ballot cache.
+            ballotitems, candidates, err = get_ballot(handlekey, event.clubid, event.eventid)
+            if err is not None:
+                return return_err(err, 'main_bp.addvote')
 
             # If saving the information, set this for later.
             saving = False
@@ -270,16 +316,17 @@ def addVote(user, voterid=None, event=None, external=False):
                             for c in candidates[itemid]:
                                 candidateid = str(c['id'])
 
-                                answer = request.values.get('contest_%d_%s' % (itemid, candidateid), None)
-                                if answer is not None:
+                                rank = contest_choice(b, candidateid)
+                                if rank is not None:
                                     # The candidate was selected.
                                     c['selected'] = True
+                                    c['rank'] = rank
 
                                     # Fetch the name for write-in candidates.
                                     if c['new'] is True:
-                                        name = request.values.get('writein_%d_%s' % (itemid, candidateid), None)
-                                        if name is not None and len(name) > 0:
-                                            c['firstname'], c['lastname'] = name.split(' ', 1)
+                                        name = ' '.join(request.values.get('writein_%d_%s' % (itemid, candidateid), '').split())
+                                        if len(name) > 0:
+                                            c['firstname'], c['lastname'] = (name.split(' ', 1) + [''])[0:2]
                                             c['fullname'] = name
 
                                             vote = { 'type': b['type'],
@@ -288,6 +335,8 @@ def addVote(user, voterid=None, event=None, external=False):
                                                     'writein': c['new'],
                                                     'answer': candidateid,
                                                 }
+                                            if is_ranked(b):
+                                                vote['rank'] = rank
 
                                             if itemid not in answers:
                                                 answers[itemid] = [vote]
@@ -321,15 +370,16 @@ def addVote(user, voterid=None, event=None, external=False):
                         for c in candidates[itemid]:
                             candidateid = str(c['id'])
 
-                            answer = request.values.get('contest_%d_%s' % (itemid, candidateid), None)
-                            if answer is not None:
+                            rank = contest_choice(b, candidateid)
+                            if rank is not None:
                                 # The candidate was selected.
                                 c['selected'] = True
+                                c['rank'] = rank
 
                                 if c['new'] is True:
                                     # Fetch the name.
-                                    name = request.values.get('writein_%d_%s' % (itemid, candidateid), None)
-                                    if name is None or len(name) == 0:
+                                    name = ' '.join(request.values.get('writein_%d_%s' % (itemid, candidateid), '').split())
+                                    if len(name) == 0:
                                         if error is False:
                                             eventlogger.flashlog("Add vote failure", "Error in Contest '%s':" % b['name'], large=True)
                                             error = True
@@ -337,7 +387,7 @@ def addVote(user, voterid=None, event=None, external=False):
                                         eventlogger.flashlog("Add vote failure", "A selected write-in candidate name cannot be empty.", indent=True)
                                         failed = True
                                     else:
-                                        c['firstname'], c['lastname'] = name.split(' ', 1)
+                                        c['firstname'], c['lastname'] = (name.split(' ', 1) + [''])[0:2]
                                         c['fullname'] = name
 
                                 if failed is False:
@@ -348,13 +398,37 @@ def addVote(user, voterid=None, event=None, external=False):
                                              'writein': c['new'],
                                              'answer': candidateid,
                                            }
+                                    if is_ranked(b):
+                                        vote['rank'] = rank
+
                                     if itemid not in answers:
                                         answers[itemid] = [vote]
                                     else:
                                         answers[itemid].append(vote)
 
+                        # A write-in may not name a candidate already selected.
+                        err = check_duplicates(answers.get(itemid, []))
+                        if err is not None:
+                            if error is False:
+                                eventlogger.flashlog("Add vote failure", "Error in Contest '%s':" % b['name'], large=True)
+                                error = True
+
+                            eventlogger.flashlog("Add vote failure", err, indent=True)
+                            failed = True
+
+                        # Ranked contests may rank every candidate, each at a different rank.
+                        if is_ranked(b):
+                            err = order_ranks(answers.get(itemid, []))
+                            if err is not None:
+                                if error is False:
+                                    eventlogger.flashlog("Add vote failure", "Error in Contest '%s':" % b['name'], large=True)
+                                    error = True
+
+                                eventlogger.flashlog("Add vote failure", err, indent=True)
+                                failed = True
+
                         # If the voter has selected more than the allotted number of posistions for this contest, it is not accepted.
-                        if votecount > b['positions']:
+                        elif votecount > b['positions']:
                             if error is False:
                                 eventlogger.flashlog("Add vote failure", "Error in Contest '%s':" % b['name'], large=True)
                                 error = True
@@ -382,81 +456,25 @@ def addVote(user, voterid=None, event=None, external=False):
                         failed = True
 
                 # If all the answers were retrieved successfully, add them to the database.
-                ballotid = 0
                 if failed is False:
-                    # Add any new write-in candidates.
-                    # The ID used was temporary and the database will generate the new ID.
+                    # New write-in candidates are added with the ballot; the ID used on the page was
+                    # temporary and the database generates the new ID.
                     eventlogger.info("Adding a vote: Saving votes")
 
-                    ballotid, err = event.get_vote_ballotid(user)
-                    if err is not None:
-                        failed = True
+                    outsql = add_ballot_sql(event.clubid, event.eventid, voterid, answers, candidates, ballotitems)
+
+                    # The database refuses a vote for a candidate merged away since the ballot was shown.
+                    try:
+                        _, data, err = db.sql(outsql, handlekey=handlekey)
+
+                        # The voter may have voted from another session since their record was read.
+                        if err is None and data[0][0]['ballotid'] is None:
+                            err = "Vote ID '%s' has already voted." % voterid
+
+                    except (db.UniqueValueException, db.PoolExhaustedException, psycopg2.Error) as e:
+                        eventlogger.error("Adding a vote: Voter ID '%s': %s" % (voterid, str(e)))
+                        err = "The ballot could not be recorded: %s" % str(e)
 
-                if failed is False:
-                    # Make all write-in candidates that are not selected 'not-new' so we don't
-                    # try to add them to the database.
-                    for itemid in candidates:
-                        for candidate in candidates[itemid]:
-                            if candidate['writein'] is True:
-                                # If the candidate ID is not in the answers for this item,
-                                # set its 'new' flag to False;
-                                present = list(filter(lambda x: str(x['answer']) == candidate['id'], answers[itemid]))
-                                if len(present) == 0:
-                                    candidate['new'] = False
-
-                    # Candidates is keyed by itemid.
-                    for itemid in candidates:
-                        for candidate in candidates[itemid]:
-                            if candidate['new'] is True:
-                                # See if this candidate already exists.
-                                outsql = '''SELECT id, fullname
-                                            FROM candidates
-                                            WHERE clubid='%d' AND eventid='%d' AND itemid='%d' AND fullname='%s';
-                                         ''' % (event.clubid, event.eventid, itemid, candidate['fullname'])
-                                _, data, _ = db.sql(outsql, handlekey=handlekey)
-
-                                # The candidate already exists; grab its ID.
-                                if len(data) > 0 and len(data[0]) > 0:
-                                    newid = data[0][0]['id']
-                                    eventlogger.info("Adding a vote: Write-in candidate '%s' already exists as ID %d" % (candidate['fullname'], newid))
-                                else:
-                                    outsql = '''INSERT INTO candidates(clubid, eventid, itemid, firstname, lastname, fullname, writein)
-                                                    VALUES('%d', '%d', '%d', '%s', '%s', '%s', %s)
-                                                    RETURNING id;
-                                            ''' % (event.clubid, event.eventid, itemid,
-                                                    candidate['firstname'], candidate['lastname'], candidate['fullname'],
-                                                    candidate['writein'])
-                                    _, result, err = db.sql(outsql, handlekey=handlekey)
-                                    if err is not None:
-                                        eventlogger.flashlog("Add vote failure", "Failed to add write-in candidate '%s': %s" % (candidate['fullname'], err))
-                                        return redirect(url_for('main_bp.index'))
-
-                                    newid = result[0][0]['id']
-                                    eventlogger.info("Adding a vote: Added write-in candidate '%s' as ID %d" % (candidate['fullname'], newid))
-
-                                # Update the answer for this candidate.
-                                for answer in answers[itemid]:
-                                    if answer['answer'] == candidate['id']:
-                                        answer['answer'] = str(newid)
-                                        break
-
-                                # Save the new ID for this candidate.
-                                candidate['id'] = str(newid)
-
-                    outsql = []
-                    for a in answers:
-                        for answer in answers[a]:
-                            outsql.append('''INSERT INTO votes (clubid, eventid, itemid, ballotid, answer)
-                                            VALUES('%d', '%d', '%d', '%d', '%s');
-                                          ''' % (event.clubid, event.eventid, a, ballotid, answer['answer']))
-
-                    # Mark that this voter has voted.
-                    outsql.append('''UPDATE voters
-                                     SET voted=True
-                                     WHERE clubid='%d' AND eventid='%d' AND voteid='%s';
-                                  ''' % (event.clubid, event.eventid, voterid))
-
-                    _, _, err = db.sql(outsql, handlekey=handlekey)
                     if err is not None:
                         eventlogger.flashlog("Add vote failure", err)
                         if external is True:
@@ -465,6 +483,9 @@ def addVote(user, voterid=None, event=None, external=False):
                         else:
                             return redirect(url_for('main_bp.index'))
 
+                    # Let anyone watching the results know.
+                    results.results_changed(event.clubid, event.eventid, bump=False)
+
                     eventlogger.flashlog(None, "Vote Recorded for Voter ID %s:" % voterid, 'info', propagate=True, large=True)
                     eventlogger.flashlog(None, "Voter Name: %s" % voter['fullname'], 'info', propagate=True, indent=True)
                     eventlogger.info("(Vote choices are not logged)", propagate=True, indent=True)
@@ -474,8 +495,9 @@ def addVote(user, voterid=None, event=None, external=False):
                         # These get displayed to the page but are not logged to keep the vote anonymous.
                         for answer in answers[itemid]:
                             if ITEM_TYPES.CONTEST.value == answer['type']:
-                                eventlogger.flashlog(None, "Contest %d (%s): %s%s" %
-                                                             (itemid, answer['item'], answer['candidate'], ' (write-in)' if answer['writein'] is True else ""),
+                                eventlogger.flashlog(None, "Contest %d (%s): %s%s%s" %
+                                                             (itemid, answer['item'], answer['candidate'], ' (write-in)' if answer['writein'] is True else "",
+                                                              ' (choice %d)' % answer['rank'] if 'rank' in answer else ""),
                                                              'info', propagate=True, log=False, indent=True)
 
                             elif ITEM_TYPES.QUESTION.value == answer['type']:
@@ -507,6 +529,556 @@ def addVote(user, voterid=None, event=None, external=False):
             # Redirect to the main page to display the exception and prevent recursive loops.
             return redirect(url_for('main_bp.index'))
 
+# Build the answers for a ballot submitted to the ballot API, checked by the same rules as the voting page.
+# A ballot looks like:
+#   {"voterid": "1234",
+#    "contests": {"1": {"candidates": [3, 5], "writeins": ["Jane Smith"]}},
+#    "questions": {"2": "Yes"}}
+# Contest selections may also be given as just the list of candidate IDs.  Write-ins fill the
+# contest's write-in slots in candidates, as they would on the page.
+# A ranked contest takes its choices in order, as {"ranking": [5, "Jane Smith", 3]} or just the list;
+# each is a candidate ID or name, and names not on the ballot are write-ins.
+# Returns the answers (as add_ballot_sql() takes them) and a list of errors.
+def parse_ballot(ballotitems, candidates, ballot):
+    answers = {}
+    errors = []
+
+    items = {b['itemid']: b for b in ballotitems}
+
+    contests = ballot.get('contests') or {}
+    questions = ballot.get('questions') or {}
+
+    if type(contests) is not dict or type(questions) is not dict:
+        return answers, ["Contests and questions must be keyed by ballot item ID."]
+
+    for key in contests:
+        selection = contests[key]
+
+        try:
+            itemid = int(key)
+        except:
+            errors.append("Ballot item ID '%s' must be numeric." % key)
+            continue
+
+        b = items.get(itemid, None)
+        if b is None or ITEM_TYPES.CONTEST.value != b['type']:
+            errors.append("There is no Contest with ID %d." % itemid)
+            continue
+
+        known = {str(c['id']): c for c in candidates.get(itemid, []) if c['new'] is False}
+        slots = [c for c in candidates.get(itemid, []) if c['new'] is True]
+
+        # Each choice is a candidate ID or (for write-ins) a name, in the order they are ranked.
+        if is_ranked(b):
+            if type(selection) is dict:
+                selection = selection.get('ranking', None)
+
+            if type(selection) is not list:
+                errors.append("Contest '%s': the ranking must be a list." % b['name'])
+                continue
+
+            names = {name_key(c['fullname']): c['id'] for c in known.values()}
+
+            choices = []
+            for choice in selection:
+                name = str(choice).strip() if choice is not None else ''
+                if type(choice) is int or name.isdigit():
+                    choices.append((choice, None))
+                elif name_key(name) in names:
+                    choices.append((names[name_key(name)], None))
+                else:
+                    choices.append((None, name))
+
+            if len([c for c in choices if c[0] is None]) > len(slots):
+                errors.append("Contest '%s': only %d write-in candidates may be ranked." % (b['name'], len(slots)))
+                continue
+
+        else:
+            if type(selection) is list:
+                selection = {'candidates': selection}
+
+            if type(selection) is not dict:
+                selection = {'candidates': None, 'writeins': None}
+
+            chosen = selection.get('candidates', [])
+            writeins = selection.get('writeins', [])
+
+            if type(chosen) is not list or type(writeins) is not list:
+                errors.append("Contest '%s': candidates and write-ins must be lists." % b['name'])
+                continue
+
+            # If the voter has selected more than the allotted number of positions for this contest, it is not accepted.
+            if len(chosen) + len(writeins) > b['positions']:
+                errors.append("Contest '%s': only %d positions may be selected." % (b['name'], b['positions']))
+                continue
+
+            choices = [(candidateid, None) for candidateid in chosen] + [(None, name) for name in writeins]
+
+        slots = iter(slots)
+        for candidateid, name in choices:
+            if candidateid is not None:
+                c = known.get(str(candidateid), None)
+                if c is None:
+                    errors.append("Contest '%s': there is no Candidate with ID %s." % (b['name'], candidateid))
+                    continue
+
+                if c.get('selected', False) is True:
+                    errors.append("Contest '%s': Candidate %s is selected more than once." % (b['name'], candidateid))
+                    continue
+
+            else:
+                name = ' '.join(str(name).split()) if name is not None else ''
+                if len(name) == 0:
+                    errors.append("Contest '%s': a write-in candidate name cannot be empty." % b['name'])
+                    continue
+
+                # Names match ignoring case and spacing, as they do in the database.
+                if name_key(name) in [name_key(v['candidate']) for v in answers.get(itemid, [])]:
+                    errors.append("Contest '%s': Candidate %s is selected more than once." % (b['name'], name))
+                    continue
+
+                c = next(slots)
+                c['firstname'], c['lastname'] = (name.split(' ', 1) + [''])[0:2]
+                c['fullname'] = name
+
+            c['selected'] = True
+            vote = {'type': b['type'],
+                    'item': b['name'],
+                    'candidate': c['fullname'],
+                    'writein': c['new'],
+                    'answer': str(c['id']) if c['new'] is False else c['id']
+                   }
+            if is_ranked(b):
+                vote['rank'] = len(answers.get(itemid, [])) + 1
+
+            answers.setdefault(itemid, []).append(vote)
+
+    for key in questions:
+        answer = questions[key]
+
+        try:
+            itemid = int(key)
+        except:
+            errors.append("Ballot item ID '%s' must be numeric." % key)
+            continue
+
+        b = items.get(itemid, None)
+        if b is None or ITEM_TYPES.QUESTION.value != b['type']:
+            errors.append("There is no Question with ID %d." % itemid)
+            continue
+
+        # The answer may be empty (no vote).
+        if answer is None:
+            continue
+
+        # 1 and 0 compare equal to True and False, so booleans are told apart by type.
+        if type(answer) is not bool and answer not in ['Yes', 'No']:
+            errors.append("Question '%s': the answer must be Yes or No." % b['name'])
+            continue
+
+        answers[itemid] = [{'type': b['type'],
+                            'item': b['name'],
+                            'answer': '1' if answer is True or answer == 'Yes' else '0'
+                          }]
+
+    # Empty ballots are not accepted.
+    if len(errors) == 0 and len(answers) == 0:
+        errors.append("The ballot is empty.")
+
+    return answers, errors
+
+
+# Record ballots submitted as JSON, for kiosks and scanners.
+# The request holds one ballot (see parse_ballot()) or {"ballots": [...]} with several.  Each ballot
+# is checked and recorded on its own, so one bad ballot does not hold up the rest; the reply has a
+# receipt per ballot (in order) with its ballot ID or the reasons it was rejected.
+def submitBallots(user):
+    eventlogger = current_user.logger
+
+    try:
+        event = current_user.event
+        handlekey = current_user.get_userid()
+
+        data = request.get_json(silent=True)
+        if type(data) is not dict:
+            return jsonify({'error': "The request must be a JSON ballot or a list of ballots."}), 400
+
+        ballots = data.get('ballots', [data])
+        if type(ballots) is not list or any(type(b) is not dict for b in ballots):
+            return jsonify({'error': "Ballots must be a list of JSON ballots."}), 400
+
+        maxballots = app.config.get('VOTE_BATCH_MAX_BALLOTS')
+        if len(ballots) > maxballots:
+            return jsonify({'error': "No more than %d ballots may be submitted at once." % maxballots}), 400
+
+        # Check if the event is locked.
+        if event.locked is True:
+            return jsonify({'error': "This Event is locked and cannot add Votes."}), 403
+
+        eventlogger.info("Submitting ballots: %d ballots" % len(ballots))
+
+        ballotitems, _, err = get_ballot(handlekey, event.clubid, event.eventid)
+        if err is not None:
+            eventlogger.error("Submitting ballots: %s" % err)
+            return jsonify({'error': err}), 500
+
+        # Look up all the voters at once.
+        voterids = [str(b.get('voterid') if b.get('voterid') is not None else '').strip() for b in ballots]
+        _, data, err = db.sql(db.statement('votes_voters', event.clubid, event.eventid, voterids), handlekey=handlekey)
+        if err is not None:
+            eventlogger.error("Submitting ballots: %s" % err)
+            return jsonify({'error': err}), 500
+
+        voters = {v['voteid']: v for v in data[0]}
+
+        receipts = []
+        recorded = 0
+
+        for voterid, ballot in zip(voterids, ballots):
+            receipt = {'voterid': voterid}
+            errors = []
+
+            try:
+                int(voterid)
+            except:
+                errors.append("Voter ID must be numeric." if len(voterid) > 0 else "Please enter a Voter ID.")
+
+            if len(errors) == 0:
+                if voterid not in voters:
+                    errors.append("Voter ID '%s' was not found." % voterid)
+                elif voters[voterid]['voted'] is True:
+                    errors.append("Vote ID '%s' has already voted." % voterid)
+
+            if len(errors) == 0:
+                _, candidates, err = get_ballot(handlekey, event.clubid, event.eventid)
+                answers, errors = parse_ballot(ballotitems, candidates, ballot)
+
+            if len(errors) == 0:
+                outsql = add_ballot_sql(event.clubid, event.eventid, voterid, answers, candidates, ballotitems)
+
+                # A database failure rejects this ballot only; the ballots before it are already recorded.
+                try:
+                    _, data, err = db.sql(outsql, handlekey=handlekey)
+
+                    # The voter may have voted elsewhere (or earlier in this batch) since they were looked up.
+                    if err is None and data[0][0]['ballotid'] is None:
+                        err = "Vote ID '%s' has already voted." % voterid
+
+                except (db.UniqueValueException, db.PoolExhaustedException, psycopg2.Error) as e:
+                    eventlogger.error("Submitting ballots: Voter ID '%s': %s" % (voterid, str(e)))
+                    err = "The ballot could not be recorded: %s" % str(e)
+
+                if err is not None:
+                    errors.append(err)
+                else:
+                    receipt['ballotid'] = data[0][0]['ballotid']
+
+            if len(errors) == 0:
+                receipt['status'] = 'recorded'
+                recorded += 1
+            else:
+                receipt['status'] = 'rejected'
+                receipt['errors'] = errors
+
+            receipts.append(receipt)
+
+        # Vote choices are not logged.
+        eventlogger.info("Submitting ballots: %d recorded, %d rejected" % (recorded, len(ballots) - recorded), propagate=True)
+
+        if recorded > 0:
+            results.results_changed(event.clubid, event.eventid, bump=False)
+
+        return jsonify({'recorded': recorded,
+                        'rejected': len(ballots) - recorded,
+                        'receipts': receipts
+                       })
+
+    except Exception as e:
+        eventlogger.error("Submitting ballots: Unexpected exception: %s" % str(e), propagate=True)
+        eventlogger.error(traceback.format_exc())
+
+        return jsonify({'error': "Exception: %s" % str(e)}), 500
+
+
+# Turn a row of a paper ballot sheet (see configdata.readBallotData()) into a ballot for parse_ballot().
+# A contest's cell lists the selections separated by ';', each a candidate ID or full name; a name that
+# is not on the ballot is a write-in.  A ranked contest's selections are in order of preference.  A question's cell is Yes or No (or any true/false value the
+# import accepts); an empty cell is no vote.
+def sheet_ballot(ballotitems, candidates, row):
+    ballot = {'voterid': row['voterid'], 'contests': {}, 'questions': {}}
+
+    for b in ballotitems:
+        itemid = b['itemid']
+        value = row.get(str(itemid), None)
+        if value is None or len(value) == 0:
+            continue
+
+        if ITEM_TYPES.CONTEST.value == b['type']:
+            known = {}
+            for c in candidates.get(itemid, []):
+                if c['new'] is False:
+                    known[str(c['id'])] = c['id']
+                    known[name_key(c['fullname'])] = c['id']
+
+            selection = {'candidates': [], 'writeins': [], 'ranking': []}
+            for choice in [v.strip() for v in value.split(';') if len(v.strip()) > 0]:
+                key = choice.lower() if choice.isdigit() else name_key(choice)
+                if key in known:
+                    selection['candidates'].append(known[key])
+                else:
+                    selection['writeins'].append(choice)
+
+                selection['ranking'].append(known.get(key, choice))
+
+            ballot['contests'][itemid] = selection
+
+        elif ITEM_TYPES.QUESTION.value == b['type']:
+            if value.lower() in ['yes', 'no']:
+                value = value.lower() == 'yes'
+            elif configdata.valid_true_false_value(value) is True:
+                value = configdata.value_is_true(value)
+
+            ballot['questions'][itemid] = value
+
+    return ballot
+
+
+# Read and check a file of paper ballots against the event's ballot.
+# Returns a report entry per ballot row, or None and a list of errors for the file as a whole.
+# Entries hold the row, voter ID, status ('valid' or 'rejected'), messages and a summary of the
+# selections; valid entries also carry the answers, candidates and ballot items to record.
+def check_ballots(handlekey, event, filepath):
+    try:
+        rows = configdata.readBallotData(filepath)
+
+    except configdata.ImportParseError as e:
+        return None, e.args[0]
+
+    except IOError as e:
+        return None, [str(e)]
+
+    ballotitems, _, err = get_ballot(handlekey, event.clubid, event.eventid)
+    if err is not None:
+        return None, [err]
+
+    # Every column other than the voter ID must be a ballot item.
+    itemids = [str(b['itemid']) for b in ballotitems]
+    columns = [k for k in (rows[0] if len(rows) > 0 else {}) if k not in configdata.BALLOT_SHEET_KEYS + ['row']]
+    unknown = [c for c in columns if c not in itemids]
+    if len(unknown) > 0:
+        return None, ["Column '%s' is not a Ballot Item ID." % c for c in unknown]
+
+    # Look up all the voters at once.
+    voterids = [row['voterid'] if row['voterid'] is not None else '' for row in rows]
+    _, data, err = db.sql(db.statement('votes_voters', event.clubid, event.eventid, voterids), handlekey=handlekey)
+    if err is not None:
+        return None, [err]
+
+    voters = {v['voteid']: v for v in data[0]}
+
+    report = []
+    seen = set()
+
+    for voterid, row in zip(voterids, rows):
+        entry = {'row': row['row'], 'voterid': voterid, 'messages': [], 'selections': []}
+        errors = entry['messages']
+
+        try:
+            int(voterid)
+        except:
+            errors.append("Voter ID must be numeric." if len(voterid) > 0 else "Please enter a Voter ID.")
+
+        if len(errors) == 0:
+            if voterid not in voters:
+                errors.append("Voter ID '%s' was not found." % voterid)
+            elif voters[voterid]['voted'] is True:
+                errors.append("Vote ID '%s' has already voted." % voterid)
+            elif voterid in seen:
+                errors.append("Vote ID '%s' has a ballot in an earlier row." % voterid)
+
+        if len(errors) == 0:
+            seen.add(voterid)
+
+            _, candidates, _ = get_ballot(handlekey, event.clubid, event.eventid)
+            answers, errors = parse_ballot(ballotitems, candidates, sheet_ballot(ballotitems, candidates, row))
+            entry['messages'] = errors
+
+            if len(errors) == 0:
+                entry['answers'] = answers
+                entry['candidates'] = candidates
+                entry['ballotitems'] = ballotitems
+
+                for itemid in answers:
+                    for answer in answers[itemid]:
+                        if ITEM_TYPES.CONTEST.value == answer['type']:
+                            entry['selections'].append("%s: %s%s%s" % (answer['item'], answer['candidate'], ' (write-in)' if answer['writein'] is True else "",
+                                                                       ' (choice %d)' % answer['rank'] if 'rank' in answer else ""))
+                        else:
+                            entry['selections'].append("%s: %s" % (answer['item'], 'Yes' if answer['answer'] == '1' else 'No'))
+
+        entry['status'] = 'valid' if len(entry['messages']) == 0 else 'rejected'
+        report.append(entry)
+
+    return report, None
+
+
+# Record the valid ballots of a checked report, in transactions of BALLOT_ENTRY_BATCH_SIZE ballots.
+# Each ballot is one add_ballot() call; a batch that fails is rolled back and all of its ballots are
+# rejected with the error.  Report entries are updated with their ballot ID or the error.
+def record_ballots(handlekey, event, report):
+    valid = [entry for entry in report if entry['status'] == 'valid']
+    batchsize = max(1, app.config.get('BALLOT_ENTRY_BATCH_SIZE'))
+
+    for start in range(0, len(valid), batchsize):
+        batch = valid[start:start + batchsize]
+
+        outsql = [add_ballot_sql(event.clubid, event.eventid, entry['voterid'], entry['answers'], entry['candidates'], entry['ballotitems']) for entry in batch]
+
+        # Database failures are raised (after the batch is rolled back) rather than returned.
+        try:
+            _, data, err = db.sql(outsql, handlekey=handlekey)
+
+        except (db.UniqueValueException, db.PoolExhaustedException, psycopg2.Error) as e:
+            current_user.logger.error("Enter ballots: Batch of %d ballots failed: %s" % (len(batch), str(e)))
+            err = "The ballot could not be recorded: %s" % str(e)
+
+        for i, entry in enumerate(batch):
+            if err is None and data[i][0]['ballotid'] is None:
+                entry['messages'].append("Vote ID '%s' has already voted." % entry['voterid'])
+            elif err is not None:
+                entry['messages'].append(err)
+            else:
+                entry['ballotid'] = data[i][0]['ballotid']
+
+            entry['status'] = 'recorded' if len(entry['messages']) == 0 else 'rejected'
+
+        if any(entry['status'] == 'recorded' for entry in batch):
+            results.results_changed(event.clubid, event.eventid, bump=False)
+
+
+# Enter paper ballots in bulk from an uploaded CSV/XLSX file or rows pasted from a spreadsheet.
+# 'Validate' checks every row and shows the report; 'Record Ballots' checks the same data again and
+# records the valid ballots.  Rejected rows can be fixed and submitted again, since recorded voters
+# are then reported as having voted.
+def enterBallots(user):
+    try:
+        event = current_user.event
+        handlekey = current_user.get_userid()
+
+        current_user.logger.info("Displaying: Enter paper ballots")
+
+        # The checked data is kept in a file in the upload folder until it is recorded or dropped.
+        def clear_ballot_file():
+            filepath = session.pop('ballotfile', None)
+            session.pop('ballotfilename', None)
+            if filepath is not None and os.path.exists(filepath):
+                current_user.logger.debug("Enter ballots: Removing ballot file '%s'" % filepath.split(os.sep)[-1], indent=1)
+                os.remove(filepath)
+
+        if request.values.get('cancelbutton'):
+            current_user.logger.flashlog(None, "Enter ballots operation canceled.", 'info')
+            clear_ballot_file()
+
+            return redirect(url_for('main_bp.enterballots'))
+
+        report = None
+        validated = False
+        filename = None
+
+        def render():
+            summary = None
+            if report is not None:
+                summary = {s: len([e for e in report if e['status'] == s]) for s in ['valid', 'recorded', 'rejected']}
+
+            return render_template('votes/enterballots.html', user=user, admins=ADMINS[event.clubid],
+                                   report=report, summary=summary, validated=validated, filename=filename,
+                                   configdata=current_user.get_render_data())
+
+        # Check if the event is locked.
+        if event.locked is True:
+            current_user.logger.flashlog("Enter ballots failure", "This Event is locked and cannot add Votes.")
+            return render()
+
+        savebutton = request.values.get('savebutton', None)
+        if savebutton == 'validate':
+            clear_ballot_file()
+
+            basepath = os.path.join(os.getcwd(), app.config.get('IMPORT_UPLOAD_FOLDER'))
+            if not os.path.exists(basepath):
+                os.makedirs(basepath)
+
+            ballotfile = request.files.get('file', None)
+            pasted = request.values.get('ballotdata', '').strip()
+
+            # Uploaded files and pasted rows are saved per user, so admins entering at once don't collide.
+            if ballotfile is not None and ballotfile.filename != '':
+                if not configdata.allowed_file(ballotfile.filename, configdata.BALLOT_EXTENSIONS):
+                    current_user.logger.flashlog("Enter ballots failure", "Unsupported file type (Valid types: %s)." % ', '.join(configdata.BALLOT_EXTENSIONS))
+                    return render()
+
+                filename = secure_filename(ballotfile.filename)
+                filepath = os.path.join(basepath, 'ballots_%s_%s' % (handlekey, filename))
+                ballotfile.save(filepath)
+
+            elif len(pasted) > 0:
+                filename = 'pasted rows'
+                filepath = os.path.join(basepath, 'ballots_%s.csv' % handlekey)
+                with open(filepath, 'w', encoding='utf-8') as f:
+                    f.write(pasted)
+
+            else:
+                current_user.logger.flashlog("Enter ballots failure", "Please choose a file or paste the ballot rows.")
+                return render()
+
+            session['ballotfile'] = filepath
+            session['ballotfilename'] = filename
+
+            current_user.logger.info("Enter ballots: Validating '%s'" % filename, indent=1, propagate=True)
+
+            report, errors = check_ballots(handlekey, event, filepath)
+            if errors is not None:
+                for error in errors:
+                    current_user.logger.flashlog("Enter ballots failure", error)
+
+                clear_ballot_file()
+                return render()
+
+            validated = True
+
+        elif savebutton == 'save' and 'ballotfile' in session:
+            filepath = session['ballotfile']
+            filename = session.get('ballotfilename', None)
+
+            report, errors = check_ballots(handlekey, event, filepath)
+            clear_ballot_file()
+
+            if errors is not None:
+                for error in errors:
+                    current_user.logger.flashlog("Enter ballots failure", error)
+                return render()
+
+            current_user.logger.info("Enter ballots: Recording ballots from '%s'" % filename, indent=1, propagate=True)
+            record_ballots(handlekey, event, report)
+
+            # Vote choices are not logged.
+            recorded = len([e for e in report if e['status'] == 'recorded'])
+            current_user.logger.flashlog(None, "Recorded %d of %d ballots." % (recorded, len(report)), 'info', large=True, highlight=True, propagate=True)
+
+        else:
+            # Fresh page load.
+            clear_ballot_file()
+
+        return render()
+
+    except Exception as e:
+        current_user.logger.flashlog("Enter ballots failure", "Exception: %s" % str(e), propagate=True)
+        current_user.logger.error("Unexpected exception:")
+        current_user.logger.error(traceback.format_exc())
+
+        # Redirect to the main page to display the exception and prevent recursive loops.
+        return redirect(url_for('main_bp.index'))
+
+
 def showResults(user):
     try:
         # Since these buttons are in the form area on this page, we have to handle in code.
@@ -516,71 +1088,83 @@ def showResults(user):
 
         current_user.logger.info("Displaying: Show vote results")
 
-        current_user.logger.debug("Show vote results: Fetching ballots and votes")
-        # Fetch all ballot items and votes.
-        outsql = ['''SELECT *
-                        FROM ballotitems
-                        WHERE clubid='%d' AND eventid='%d'
-                        ORDER BY itemid ASC;
-                    ''' % (current_user.event.clubid, current_user.event.eventid)]
-        outsql.append('''SELECT votes.itemid, votes.answer, candidates.fullname, COUNT(*)
-                         FROM votes
-                         LEFT JOIN candidates ON candidates.eventid=votes.eventid AND candidates.itemid=votes.itemid AND candidates.id=votes.answer
-                         WHERE votes.clubid='%d' AND votes.eventid='%d'
-                         GROUP BY votes.itemid, votes.answer, candidates.fullname
-                         ORDER BY itemid ASC, count DESC;
-                      ''' % (current_user.event.clubid, current_user.event.eventid))
-        _, data, _ = db.sql(outsql, handlekey=user)
-
-        ballotdata = data[0]
-        votedata = data[1]
-
-        current_user.logger.debug("Show vote results: Counting votes")
-
-        ballotitems = {}
-        for b in ballotdata:
-            itemid = b['itemid']
-            ballotitems[itemid] = b
-
-        votes = {}
-        placed = {}
-
-        for v in votedata:
-            itemid = v['itemid']
-            ballottype = ballotitems[v['itemid']]['type']
-            positions = ballotitems[v['itemid']]['positions']
-
-            if itemid not in placed.keys():
-                placed[itemid] = 0
-            else:
-                placed[itemid] += 1
+        event = current_user.event
+        configdata = current_user.get_render_data()
 
-            if ITEM_TYPES.CONTEST.value == ballottype:
-                if placed[itemid] < positions:
-                    v['placed'] = True
-                else:
-                    v['placed'] = False
-            elif ITEM_TYPES.QUESTION.value == ballottype:
-                if 0 == placed[itemid]:
-                    v['placed'] = True
-                else:
-                    v['placed'] = False
+        # The results are rendered once per results version and shared by all viewers (see results.py).
+        snapshot, version, err = results.get_snapshot(user, event.clubid, event.eventid, event.locked)
+        if err is not None:
+            current_user.logger.flashlog("Show vote results failure", "Failed to fetch results: %s" % err)
+            return redirect(url_for('main_bp.index'))
 
-            if itemid not in votes:
-                votes[itemid] = [v]
-            else:
-                votes[itemid].append(v)
+        if snapshot is None:
+            current_user.logger.debug("Show vote results: Fetching ballots and votes")
+            # Fetch all ballot items and votes.
+            outsql = ['''SELECT *
+                            FROM ballotitems
+                            WHERE clubid='%d' AND eventid='%d'
+                            ORDER BY itemid ASC;
+                        ''' % (event.clubid, event.eventid)]
+            # Vote counts come from the running tallies rather than counting the votes.
+            outsql.append(db.statement('tallies_results', event.clubid, event.eventid))
+            _, data, err = db.sql(outsql, handlekey=user)
+
+            if err is None:
+                ballotdata = data[0]
+                votedata = data[1]
+
+                current_user.logger.debug("Show vote results: Counting votes")
+
+                ballotitems = {}
+                for b in ballotdata:
+                    itemid = b['itemid']
+                    ballotitems[itemid] = b
+
+                # Ranked contests are counted round by round from their votes.
+                ranked, err = results.count_ranked(user, event.clubid, event.eventid, ballotitems)
+
+            if err is not None:
+                current_user.logger.flashlog("Show vote results failure", "Failed to fetch results: %s" % err)
+                return redirect(url_for('main_bp.index'))
+
+            votes = results.group_results(ballotitems, votedata, {itemid: ranked[itemid]['elected'] for itemid in ranked})
+
+            # Add the votes (and the rounds of ranked contests) to the ballot item.
+            for b in ballotitems:
+                if b in list(votes.keys()):
+                    ballotitems[b]['votes'] = votes[b]
+
+                if b in ranked:
+                    ballotitems[b]['count'] = ranked[b]
+
+            body = render_template('votes/resultitems.html', ballotitems=ballotitems)
+            snapshot = results.save_snapshot(event.clubid, event.eventid, version, event.locked, len(ballotitems), body)
+
+        # The page also shows the user and the event's settings.  A page carrying the user's messages
+        # is not cached, as the messages are only shown once.
+        etag = '%s-%s' % (snapshot['etag'], hashlib.md5(repr((user, configdata)).encode()).hexdigest()[0:12])
+        cacheable = len(session.get('_flashes', [])) == 0
 
-        # Add the votes to the ballot item.
-        for b in ballotitems:
-            if b in list(votes.keys()):
-                ballotitems[b]['votes'] = votes[b]
+        if cacheable is True and request.if_none_match.contains(etag):
+            current_user.logger.info("Show vote results: Not modified")
+
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
 
         current_user.logger.info("Show vote results: Operation completed")
 
-        return render_template('votes/showresults.html', user=user, admins=ADMINS[current_user.event.clubid],
-                                ballotitems=ballotitems,
-                                configdata=current_user.get_render_data())
+        response = make_response(render_template('votes/showresults.html', user=user, admins=ADMINS[event.clubid],
+                                                 itemcount=snapshot['itemcount'], resultitems=snapshot['body'],
+                                                 reloadtime=app.config.get('RESULTS_STREAM_FALLBACK_RELOAD'),
+                                                 configdata=configdata))
+
+        # Browsers revalidate the page every time, which is free while the results haven't changed.
+        response.headers['Cache-Control'] = 'private, no-cache'
+        if cacheable is True:
+            response.set_etag(etag)
+
+        return response
 
     except Exception as e:
         current_user.logger.flashlog("Show vote results failure", "Exception: %s" % str(e), propagate=True)
@@ -589,3 +1173,25 @@ def showResults(user):
 
         # Redirect to the main page to display the exception and prevent recursive loops.
         return redirect(url_for('main_bp.index'))
+
+
+# Stream the event's results as they change, as Server-Sent Events (see results.py).
+def streamResults(user):
+    event = current_user.event
+
+    current_user.logger.info("Streaming vote results")
+
+    # Too many open streams would hold every server thread; the page reloads itself instead.
+    feed = results.watch(event.clubid, event.eventid)
+    if feed is None:
+        current_user.logger.warning("Streaming vote results: %d streams already open" % app.config.get('RESULTS_STREAM_MAX'))
+        return Response("Too many live results streams are open.", status=503, mimetype='text/plain',
+                        headers={'Retry-After': str(app.config.get('RESULTS_STREAM_FALLBACK_RELOAD'))})
+
+    # The viewer is released when the response is closed, whether or not the stream was started.
+    # A reconnecting browser sends the ID of the last message it had, to carry on from there.
+    response = Response(feed.stream(request.headers.get('Last-Event-ID')), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(feed.release)
+
+    return response
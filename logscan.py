@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+#   Copyright 2021-2022 Steve Strublic
+#
+#   This work is the personal property of Steve Strublic, and as such may not be
+#   used, distributed, or modified without my express consent.
+
+# Log file scanning for the archive search worker processes (see loghelpers.search_archives()).
+# The workers load only this module, so it must not import anything from the application.
+
+import collections
+import re
+import zipfile
+
+# Where the level sits in a log line (see LOGFORMAT): after the date and time ('mm-dd-yyyy hh:mm:ss.mmm;'),
+# padded to 8 characters.
+LEVEL_START = 24
+LEVEL_END = 32
+
+
+# The sortable time of a log line ('yyyymmddhh:mm:ss.mmm' from 'mm-dd-yyyy hh:mm:ss.mmm;'),
+# or None for lines not in the log format (such as traceback lines).
+def line_time(line):
+    if len(line) > LEVEL_START and line[2:3] == b'-' and line[5:6] == b'-' and line[23:24] == b';':
+        return (line[6:10] + line[0:2] + line[3:5] + line[11:23]).decode('ascii', 'replace')
+
+    return None
+
+
+# The club ID, event ID, user and IP address of a log line (see LOGFORMAT) with its message, or no fields
+# for lines not in the log format (they take the fields of the line before, as in log.parse_logline()).
+def line_fields(line):
+    fields = line.split(b';', 4)
+    if len(fields) == 5:
+        ids = fields[2].split(b'/', 2)
+        if len(ids) == 3:
+            return {'clubid': ids[0], 'eventid': ids[1], 'user': ids[2].lower(), 'ipaddr': fields[3]}, fields[4]
+
+    return None, line
+
+
+# Message words, matched as the log search index matches them: ignoring case and punctuation, each search
+# word's words all in the message, with a trailing '*' matching the beginning of a word.
+WORD = re.compile(r'\w+')
+
+def search_words(words):
+    terms = []
+    for w in words.split():
+        found = WORD.findall(w.rstrip('*').lower())
+        terms.extend([(t, w.endswith('*') and n == len(found) - 1) for n, t in enumerate(found)])
+
+    return terms
+
+
+def words_match(terms, message):
+    if len(terms) == 0:
+        return True
+
+    words = set(WORD.findall(message.decode('utf-8', 'replace').lower()))
+    return all((any(w.startswith(t) for w in words) if prefix is True else t in words) for t, prefix in terms)
+
+
+# Search one log file or archive (run in a worker process).  The lines are read as a stream, in order, with
+# each line keyed by (time, source, line number); lines without a time take the time of the line before.
+# The search holds any of the club ID, event ID, user and IP address to match and the message 'words'
+# (as for the log search index, see log.LogIndex.search()).
+# Going forward, returns the first 'limit' matching lines after the cursor key (or from the start if None);
+# otherwise, the last 'limit' matching lines before the cursor key (or up to the end if None).
+def scan_archive(path, source, levels, needle, search, cursor, forward, limit):
+    fields = {f: search[f].encode('utf-8') for f in ['clubid', 'eventid', 'user', 'ipaddr'] if len(search.get(f, '')) > 0}
+    if 'user' in fields:
+        fields['user'] = fields['user'].lower()
+
+    terms = search_words(search.get('words', ''))
+
+    matches = collections.deque(maxlen=(None if forward is True else limit))
+
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        lf = archive.open(archive.namelist()[0])
+    else:
+        archive = None
+        lf = open(path, 'rb')
+
+    try:
+        linetime = ''
+        linefields = {}
+        for number, line in enumerate(lf, start=1):
+            linetime = line_time(line) or linetime
+            parsed, message = line_fields(line)
+            linefields = parsed or linefields
+            key = (linetime, source, number)
+
+            # The lines are in time order, so stop once past the cursor going backward.
+            if forward is False and cursor is not None and key >= cursor:
+                break
+
+            if len(levels) > 0 and line[LEVEL_START:LEVEL_END] not in levels:
+                continue
+
+            if len(needle) > 0 and needle not in line:
+                continue
+
+            if any(linefields.get(f) != fields[f] for f in fields) or words_match(terms, message) is False:
+                continue
+
+            if forward is True and cursor is not None and key <= cursor:
+                continue
+
+            matches.append((key, line.decode('utf-8', 'replace')))
+
+            # Going forward, stop once there are enough.
+            if forward is True and len(matches) == limit:
+                break
+
+    finally:
+        lf.close()
+        if archive is not None:
+            archive.close()
+
+    return list(matches)
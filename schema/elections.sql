@@ -6,7 +6,7 @@ CREATE TABLE dbversion (
 GRANT ALL PRIVILEGES ON TABLE dbversion to elections;
 
 --. Set the default database version value.
-INSERT INTO dbversion(dbversion) VALUES(1);
+INSERT INTO dbversion(dbversion) VALUES(8);
 
 --. Club configuration.
 DROP TABLE IF EXISTS clubs;
@@ -74,6 +74,11 @@ CREATE TABLE vote_ballotid (
 INSERT INTO vote_ballotid (clubid, eventid, ballotid) VALUES(1, 1, 1);
 GRANT ALL PRIVILEGES ON TABLE vote_ballotid TO elections;
 
+--. Ballot IDs are handed out from a sequence per event, set from vote_ballotid.
+DROP SEQUENCE IF EXISTS vote_ballotid_1;
+CREATE SEQUENCE vote_ballotid_1 MINVALUE 0;
+SELECT setval('vote_ballotid_1', 1);
+
 --. All users (of the application).
 DROP TABLE IF EXISTS users;
 CREATE TABLE users (
@@ -120,6 +125,7 @@ CREATE TABLE ballotitems (
     name VARCHAR NOT NULL,
     description VARCHAR NOT NULL,
     positions INTEGER NOT NULL DEFAULT 1,
+    method INTEGER NOT NULL DEFAULT 1,
     writeins BOOLEAN NOT NULL DEFAULT false,
     UNIQUE(clubid, eventid, itemid),
     UNIQUE(clubid, eventid, name)
@@ -127,6 +133,16 @@ CREATE TABLE ballotitems (
 
 GRANT ALL PRIVILEGES ON TABLE ballotitems TO elections;
 
+--. Trigram similarity, for matching close spellings of write-in names.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+--. The key candidate names are matched on: lower case, with runs of spaces as one and no spaces at the ends.
+CREATE OR REPLACE FUNCTION candidate_namekey(name TEXT) RETURNS TEXT AS $$
+    SELECT lower(regexp_replace(btrim(name), '\s+', ' ', 'g'));
+$$ LANGUAGE SQL IMMUTABLE;
+
+GRANT EXECUTE ON FUNCTION candidate_namekey TO elections;
+
 --. A candidate for a given race.
 DROP TABLE IF EXISTS candidates;
 CREATE TABLE candidates (
@@ -138,12 +154,21 @@ CREATE TABLE candidates (
     lastname VARCHAR NOT NULL,
     fullname VARCHAR NOT NULL,
     writein BOOLEAN NOT NULL DEFAULT false,
-    UNIQUE(clubid, eventid, itemid, fullname)
+    namekey VARCHAR GENERATED ALWAYS AS (candidate_namekey(fullname)) STORED,
+    UNIQUE(clubid, eventid, itemid, namekey)
 );
 
+--. Results join candidates to votes by item and candidate ID.
+CREATE INDEX candidates_item_idx ON candidates (eventid, itemid, id);
+
+--. Close spellings of names are found by trigram similarity.
+CREATE INDEX candidates_namekey_trgm_idx ON candidates USING gin (namekey gin_trgm_ops);
+
 GRANT ALL PRIVILEGES ON TABLE candidates TO elections;
 
 --. A voter for a given event.
+--. Voters and votes are partitioned by event ID, one partition per event (created with the event).
+--. Rows for an event without a partition go to the default partition.
 DROP TABLE IF EXISTS voters;
 CREATE TABLE voters (
     id SERIAL,
@@ -157,7 +182,13 @@ CREATE TABLE voters (
     voted BOOLEAN NOT NULL DEFAULT false,
     UNIQUE(clubid, eventid, fullname),
     UNIQUE(clubid, eventid, voteid)
-);
+) PARTITION BY LIST (eventid);
+
+CREATE TABLE voters_default PARTITION OF voters DEFAULT;
+CREATE TABLE voters_1 PARTITION OF voters FOR VALUES IN (1);
+
+--. Public voting looks voters up by vote ID alone.
+CREATE INDEX voters_voteid_idx ON voters (voteid);
 
 GRANT ALL PRIVILEGES ON TABLE voters TO elections;
 
@@ -170,11 +201,123 @@ CREATE TABLE votes (
     itemid INTEGER NOT NULL,
     ballotid INTEGER NOT NULL,
     answer INTEGER NOT NULL,
-    commentary VARCHAR
-);
+    rank INTEGER NOT NULL DEFAULT 1,
+    commentary VARCHAR,
+    PRIMARY KEY(id, eventid)
+) PARTITION BY LIST (eventid);
+
+CREATE TABLE votes_default PARTITION OF votes DEFAULT;
+CREATE TABLE votes_1 PARTITION OF votes FOR VALUES IN (1);
+
+--. Results group, count and clear votes by event, item and answer.
+CREATE INDEX votes_results_idx ON votes (clubid, eventid, itemid, answer);
 
 GRANT ALL PRIVILEGES ON TABLE votes TO elections;
 
+--. Running vote counts per answer, kept up to date as ballots are recorded.
+DROP TABLE IF EXISTS vote_tallies;
+CREATE TABLE vote_tallies (
+    clubid INTEGER NOT NULL DEFAULT 0,
+    eventid INTEGER NOT NULL DEFAULT 0,
+    itemid INTEGER NOT NULL,
+    answer INTEGER NOT NULL,
+    votecount INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(clubid, eventid, itemid, answer)
+);
+
+GRANT ALL PRIVILEGES ON TABLE vote_tallies TO elections;
+
+--. A version per event that goes up on admin changes to its ballot items, candidates or votes (edits,
+--. imports, resets and merges), so every process can tell when what it has cached is stale.  Recorded
+--. ballots don't touch it; the results version adds the event's ballot ID sequence (see results.py).
+DROP TABLE IF EXISTS event_versions;
+CREATE TABLE event_versions (
+    clubid INTEGER NOT NULL DEFAULT 0,
+    eventid INTEGER NOT NULL DEFAULT 0,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY(clubid, eventid)
+);
+
+GRANT ALL PRIVILEGES ON TABLE event_versions TO elections;
+
+--. Record a ballot in one transaction: take the event's shared lock (write-in merges take it exclusively),
+--. lock the voter, check each contest vote is for a current candidate, add any write-in candidates (a
+--. write-in that names an existing candidate, ignoring case and spacing, votes for that candidate), take
+--. the next ballot ID from the event's sequence, insert the votes, count them in the tallies and mark the
+--. voter as voted.
+--. Returns the ballot ID, or NULL if the voter was not found or has already voted.  A vote for a candidate
+--. that is gone (merged away since the ballot was read) raises an error.
+CREATE OR REPLACE FUNCTION add_ballot(in_clubid INTEGER, in_eventid INTEGER, in_voteid TEXT,
+                                      in_itemids INTEGER[], in_answers INTEGER[], in_ranks INTEGER[],
+                                      in_writein_itemids INTEGER[], in_writein_firstnames TEXT[],
+                                      in_writein_lastnames TEXT[], in_writein_fullnames TEXT[],
+                                      in_writein_ranks INTEGER[])
+RETURNS INTEGER AS $$
+DECLARE
+    voter_voted BOOLEAN;
+    new_ballotid INTEGER;
+BEGIN
+    PERFORM pg_advisory_xact_lock_shared(in_clubid, in_eventid);
+
+    SELECT voted INTO voter_voted FROM voters
+    WHERE clubid=in_clubid AND eventid=in_eventid AND voteid=in_voteid
+    FOR UPDATE;
+
+    IF NOT FOUND OR voter_voted THEN
+        RETURN NULL;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM unnest(in_itemids, in_answers) AS a(itemid, answer)
+               JOIN ballotitems AS b ON b.clubid=in_clubid AND b.eventid=in_eventid AND b.itemid=a.itemid AND b.type=1
+               WHERE NOT EXISTS (SELECT 1 FROM candidates AS c
+                                 WHERE c.clubid=in_clubid AND c.eventid=in_eventid AND c.itemid=a.itemid AND c.id=a.answer)) THEN
+        RAISE EXCEPTION 'A candidate voted for is no longer on the ballot.';
+    END IF;
+
+    new_ballotid := nextval(format('vote_ballotid_%s', in_eventid)::regclass);
+
+    -- Rows are written in (item, answer) order so concurrent ballots lock candidates and tallies
+    -- in the same order and cannot deadlock.
+    WITH writeins AS (
+        SELECT DISTINCT ON (itemid, candidate_namekey(fullname)) itemid, firstname, lastname, fullname
+        FROM unnest(in_writein_itemids, in_writein_firstnames, in_writein_lastnames, in_writein_fullnames)
+             AS w(itemid, firstname, lastname, fullname)
+        ORDER BY itemid, candidate_namekey(fullname)
+    ),
+    added AS (
+        INSERT INTO candidates (clubid, eventid, itemid, firstname, lastname, fullname, writein)
+        SELECT in_clubid, in_eventid, itemid, firstname, lastname, fullname, True FROM writeins
+        ON CONFLICT (clubid, eventid, itemid, namekey) DO UPDATE SET fullname=candidates.fullname
+        RETURNING itemid, id, namekey
+    ),
+    ballot AS (
+        SELECT itemid, answer, rank FROM unnest(in_itemids, in_answers, in_ranks) AS a(itemid, answer, rank)
+        UNION ALL
+        SELECT added.itemid, added.id, w.rank FROM added
+        JOIN unnest(in_writein_itemids, in_writein_fullnames, in_writein_ranks) AS w(itemid, fullname, rank)
+             ON w.itemid=added.itemid AND candidate_namekey(w.fullname)=added.namekey
+    ),
+    recorded AS (
+        INSERT INTO votes (clubid, eventid, itemid, ballotid, answer, rank)
+        SELECT in_clubid, in_eventid, itemid, new_ballotid, answer, rank FROM ballot
+    )
+    -- Tallies count first choices; ranked contests are counted round by round from the votes.
+    INSERT INTO vote_tallies (clubid, eventid, itemid, answer, votecount)
+    SELECT in_clubid, in_eventid, itemid, answer, COUNT(*) FROM ballot
+    WHERE rank=1
+    GROUP BY itemid, answer
+    ORDER BY itemid, answer
+    ON CONFLICT (clubid, eventid, itemid, answer) DO UPDATE SET votecount = vote_tallies.votecount + EXCLUDED.votecount;
+
+    UPDATE voters SET voted=True
+    WHERE clubid=in_clubid AND eventid=in_eventid AND voteid=in_voteid;
+
+    RETURN new_ballotid;
+END;
+$$ LANGUAGE plpgsql;
+
+GRANT EXECUTE ON FUNCTION add_ballot TO elections;
+
 --. Grant ability to update all sequence start values.
 GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA public TO elections;
 
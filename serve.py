@@ -8,11 +8,18 @@
 # The shell that lets us serve our app using Waitress.
 
 import waitress
-from elections import app
 
-# When running with HTTP, this is the port on which we listen (such as 1965).
-# When running with HTTPS, the port is the one the application listens on (1966)
-# with nginx acting as a proxy, listening on a different port (such as 1965).
-# The url_scheme is also required.
-waitress.serve(app, host='0.0.0.0', port=1986)
-# waitress.serve(app, host='0.0.0.0', port=1987, url_scheme='https')
+# Worker processes (such as the log archive search's) run this file again to set up, so the app is only
+# loaded and served when it is run as the program.  Running with 'flask run' uses wsgi.py instead.
+if __name__ == '__main__':
+    from elections import app
+
+    # When running with HTTP, this is the port on which we listen (such as 1965).
+    # When running with HTTPS, the port is the one the application listens on (1966)
+    # with nginx acting as a proxy, listening on a different port (such as 1965).
+    # The url_scheme is also required.
+    # Each open results stream holds a thread, so there is a thread for each as well as those for other requests.
+    threads = app.config.get('SERVE_THREADS') + app.config.get('RESULTS_STREAM_MAX')
+
+    waitress.serve(app, host='0.0.0.0', port=1986, threads=threads)
+    # waitress.serve(app, host='0.0.0.0', port=1987, url_scheme='https', threads=threads)
@@ -0,0 +1,72 @@
+#!/bin/python3
+
+# This script times the vote counting engine (elections/counting.py) on generated ranked ballots.
+# The engine is loaded from its file, so the application (and its database) is not needed.
+
+import argparse, os, sys
+import importlib.util
+import time
+
+import numpy as np
+
+
+# Load the counting engine without importing the elections package.
+def load_counting():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'elections', 'counting.py')
+    spec = importlib.util.spec_from_file_location('counting', path)
+    counting = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(counting)
+
+    return counting
+
+
+# Generate ranked ballots as the votes table holds them: one (ballot ID, rank, candidate ID) row per
+# choice.  Candidates are given a spread of popularity so the count takes several rounds.
+def generate_votes(ballots, candidates, ranks, seed):
+    rng = np.random.default_rng(seed)
+
+    preferences = np.argsort(rng.random((ballots, candidates)) + np.linspace(0, 0.5, candidates), axis=1)[:, 0:ranks]
+
+    ballotids = np.repeat(np.arange(1, ballots + 1), ranks)
+    voteranks = np.tile(np.arange(1, ranks + 1), ballots)
+    answers = preferences.ravel() + 1
+
+    return ballotids, voteranks, answers, np.arange(1, candidates + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the vote counting engine on generated ranked ballots.')
+    parser.add_argument('--ballots', type=int, default=100000, help='Number of ballots (default 100000).')
+    parser.add_argument('--candidates', type=int, default=10, help='Number of candidates (default 10).')
+    parser.add_argument('--ranks', type=int, default=5, help='Choices ranked on each ballot (default 5).')
+    parser.add_argument('--seats', type=int, default=1, help='Seats to fill: 1 counts by IRV, more by STV (default 1).')
+    parser.add_argument('--repeat', type=int, default=5, help='Times to run the count (default 5).')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default 1).')
+    args = parser.parse_args()
+
+    if args.ranks > args.candidates:
+        print("Ranks (%d) cannot be more than the number of candidates (%d)." % (args.ranks, args.candidates))
+        sys.exit(1)
+
+    counting = load_counting()
+
+    print("Generating %d ballots ranking %d of %d candidates..." % (args.ballots, args.ranks, args.candidates))
+    ballotids, ranks, answers, candidateids = generate_votes(args.ballots, args.candidates, args.ranks, args.seed)
+
+    method = 'IRV' if args.seats == 1 else 'STV (%d seats)' % args.seats
+
+    for run in range(0, args.repeat):
+        started = time.perf_counter()
+        ballots = counting.build_ballots(ballotids, ranks, answers, candidateids)
+        built = time.perf_counter()
+        rounds = counting.ranked(ballots, len(candidateids), args.seats)
+        counted = time.perf_counter()
+
+        print("  Run %d: load %.3f sec, %s count %.3f sec (%d rounds), total %.3f sec" %
+              (run + 1, built - started, method, counted - built, len(rounds), counted - started))
+
+    print("Elected: %s" % ', '.join(['%d' % candidateids[c] for c in counting.elected(rounds)]))
+
+
+if __name__ == '__main__':
+    main()
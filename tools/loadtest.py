@@ -0,0 +1,417 @@
+#!/bin/python3
+
+# This script load tests a running instance (waitress and Postgres, started locally) with simulated
+# public voters.
+# It seeds an event with ballot items, candidates and voters by importing an event data file as an
+# admin would (so the event's current data is replaced), then has concurrent voters open /vote, enter
+# their voter ID and submit the add-vote form.  Some voters try to vote a second time, which must be
+# refused.  It reports throughput, latency percentiles and errors per endpoint, and then checks the
+# database: one ballot per voter marked voted, no ballot without a voter, no answer counted twice on
+# a ballot and tallies that agree with the votes.
+# Ballots are anonymous (votes are not linked to voters), so ballots are matched to voters by count
+# and by the receipts the voters were shown.
+# Only the standard library, openpyxl (to write the import file) and psycopg2 (for the checks) are used.
+
+import argparse, os, sys
+import datetime
+import http.cookiejar
+import math
+import random, secrets
+import re
+import tempfile
+import threading
+import time
+import urllib.error, urllib.parse, urllib.request
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+import openpyxl
+import psycopg2, psycopg2.extras
+
+
+# Event data file version written (see configdata.EXPORT_VERSION); the sheet columns must match
+# configdata.SHEET_KEYS for this version.
+IMPORT_VERSION = 2
+
+ITEM_CONTEST = 1
+ITEM_QUESTION = 2
+METHOD_PLURALITY = 1
+METHOD_RANKED = 2
+
+# Write-ins are drawn from a few names (in varied case and spacing) so concurrent ballots write in the
+# same candidates.
+WRITEIN_NAMES = ['Pat Writein', 'pat  writein', 'Sam Otherone', 'SAM OTHERONE', 'Lee Thirdname']
+
+
+# A browser-like client: its own cookies (session) and timed requests.
+class Client:
+    def __init__(self, baseurl, timeout):
+        self.baseurl = baseurl.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    # Send a request, returning (status, body, elapsed seconds).  Network errors give status 0.
+    def request(self, path, fields=None, files=None):
+        url = self.baseurl + path
+        data = None
+        headers = {}
+
+        if files is not None:
+            data, contenttype = encode_multipart(fields or {}, files)
+            headers['Content-Type'] = contenttype
+        elif fields is not None:
+            data = urllib.parse.urlencode(fields).encode('utf-8')
+
+        started = time.perf_counter()
+        try:
+            with self.opener.open(urllib.request.Request(url, data=data, headers=headers), timeout=self.timeout) as response:
+                body = response.read().decode('utf-8', errors='replace')
+                status = response.status
+
+        except urllib.error.HTTPError as e:
+            body = e.read().decode('utf-8', errors='replace')
+            status = e.code
+
+        except Exception as e:
+            body = str(e)
+            status = 0
+
+        return status, body, time.perf_counter() - started
+
+
+# Encode form fields and files ({name: (filename, bytes)}) as multipart/form-data.
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+
+    for name, value in fields.items():
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)).encode('utf-8'))
+
+    for name, (filename, content) in files.items():
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: application/octet-stream\r\n\r\n' % (boundary, name, filename)).encode('utf-8'))
+        parts.append(content)
+        parts.append(b'\r\n')
+
+    parts.append(('--%s--\r\n' % boundary).encode('utf-8'))
+
+    return b''.join(parts), 'multipart/form-data; boundary=%s' % boundary
+
+
+# Per-endpoint request statistics.
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, elapsed, ok):
+        with self.lock:
+            e = self.endpoints.setdefault(endpoint, {'times': [], 'errors': 0})
+            e['times'].append(elapsed)
+            if ok is False:
+                e['errors'] += 1
+
+
+# The value at a percentile (nearest rank) of a sorted list.
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+
+    index = max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[index]
+
+
+# Build the event: ballot items, candidates and voters, in the import's own sheets.
+def build_event(args):
+    ballotitems = []
+    candidates = []
+    itemid = 0
+    candidateid = 0
+
+    for n in range(0, args.contests):
+        itemid += 1
+        method = METHOD_RANKED if n < args.ranked else METHOD_PLURALITY
+        positions = 1 if method == METHOD_RANKED else min(args.positions, args.candidates)
+
+        ballotitems.append({'itemid': itemid, 'type': ITEM_CONTEST, 'name': 'Contest %d' % itemid,
+                            'description': 'Load test contest %d' % itemid, 'positions': positions,
+                            'method': method, 'writeins': 'True'})
+
+        for c in range(0, args.candidates):
+            candidateid += 1
+            candidates.append({'id': candidateid, 'itemid': itemid, 'firstname': 'Candidate',
+                               'lastname': '%d-%d' % (itemid, c + 1), 'fullname': 'Candidate %d-%d' % (itemid, c + 1),
+                               'writein': 'False'})
+
+    for n in range(0, args.questions):
+        itemid += 1
+        ballotitems.append({'itemid': itemid, 'type': ITEM_QUESTION, 'name': 'Question %d' % itemid,
+                            'description': 'Load test question %d' % itemid, 'positions': 1,
+                            'method': METHOD_PLURALITY, 'writeins': 'False'})
+
+    voteids = set()
+    voters = []
+    for n in range(0, args.voters):
+        voteid = '%010d' % secrets.randbelow(10 ** 10)
+        while voteid in voteids:
+            voteid = '%010d' % secrets.randbelow(10 ** 10)
+
+        voteids.add(voteid)
+        voters.append({'firstname': 'Voter', 'lastname': '%d' % (n + 1), 'fullname': 'Voter %d' % (n + 1),
+                       'email': 'voter%d@example.com' % (n + 1), 'voteid': voteid, 'voted': 'False'})
+
+    return ballotitems, candidates, voters
+
+
+# Write the event data file for import.
+def write_import_file(path, title, ballotitems, candidates, voters):
+    sheets = {'ballotitems': ['itemid', 'type', 'name', 'description', 'positions', 'method', 'writeins'],
+              'candidates': ['id', 'itemid', 'firstname', 'lastname', 'fullname', 'writein'],
+              'voters': ['firstname', 'lastname', 'fullname', 'email', 'voteid', 'voted']}
+    data = {'ballotitems': ballotitems, 'candidates': candidates, 'voters': voters}
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'events'
+    ws.append(['property', 'value'])
+    ws.append(['version', str(IMPORT_VERSION)])
+    ws.append(['title', title])
+    ws.append(['eventdatetime', datetime.datetime.now().strftime('%Y-%m-%dT%H:%M')])
+    ws.append(['locked', 'False'])
+
+    for sheet, keys in sheets.items():
+        ws = wb.create_sheet(title=sheet)
+        ws.append(keys)
+        for row in data[sheet]:
+            ws.append([str(row[k]) for k in keys])
+
+    wb.save(path)
+
+
+# Log in as an event admin and import the event data file, going through the import page's steps.
+def seed_event(args, path):
+    client = Client(args.url, args.timeout)
+
+    status, body, _ = client.request('/login', {'clubid': args.eventid, 'username': args.username,
+                                                'passwd': args.password, 'savebutton': 'login'})
+    if status != 200 or 'name="passwd"' in body:
+        return "Login failed (HTTP %d): %s" % (status, page_messages(body))
+
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    steps = [({'savebutton': 'load'}, {'file': (os.path.basename(path), content)}),
+             ({'savebutton': 'validate'}, None),
+             ({'savebutton': 'confirm'}, None),
+             ({'savebutton': 'save'}, None)]
+
+    for fields, files in steps:
+        status, body, _ = client.request('/config/importdata', fields, files)
+        if status != 200:
+            return "Import step '%s' failed (HTTP %d)" % (fields['savebutton'], status)
+
+        if fields['savebutton'] == 'validate' and 'Validation Successful' not in body:
+            return "Import validation failed: %s" % page_messages(body)
+
+    if 'Import Successful' not in body:
+        return "Import did not complete: %s" % page_messages(body)
+
+    return None
+
+
+# The flashed messages on a page, for error reports.
+def page_messages(body):
+    messages = [re.sub(r'<[^>]+>', '', m).strip() for m in re.findall(r'<li[^>]*>(.*?)</li>', body, re.S)]
+    return '; '.join([m for m in messages if len(m) > 0][0:5]) or '(no messages)'
+
+
+# Fill in the add-vote form from the ballot page: fields are named contest_<item>_<candidate> (a
+# checkbox, or a rank select in ranked contests), writein_<item>_<slot> and question_<item>.
+def fill_ballot(body, voterid, ballotitems, rng, writeinrate):
+    fields = {'voterid': voterid, 'savebutton': 'save'}
+
+    for b in ballotitems:
+        itemid = b['itemid']
+
+        if b['type'] == ITEM_QUESTION:
+            if rng.random() < 0.9:
+                fields['question_%d' % itemid] = rng.choice(['Yes', 'No'])
+            continue
+
+        names = re.findall(r'name="contest_%d_([^"]+)"' % itemid, body)
+        known = [n for n in names if not n.startswith('writein_')]
+        slots = [n for n in names if n.startswith('writein_')]
+
+        if b['method'] == METHOD_RANKED:
+            chosen = rng.sample(known, rng.randint(1, len(known))) if len(known) > 0 else []
+        else:
+            chosen = rng.sample(known, rng.randint(1, min(b['positions'], len(known)))) if len(known) > 0 else []
+
+        if len(slots) > 0 and rng.random() < writeinrate:
+            if b['method'] == METHOD_PLURALITY and len(chosen) >= b['positions'] and len(chosen) > 0:
+                chosen.pop()
+
+            fields['writein_%d_%s' % (itemid, slots[0])] = rng.choice(WRITEIN_NAMES)
+            chosen.append(slots[0])
+
+        for rank, c in enumerate(chosen, 1):
+            fields['contest_%d_%s' % (itemid, c)] = str(rank) if b['method'] == METHOD_RANKED else 'True'
+
+    return fields
+
+
+# One simulated voter: open the public vote page, enter the voter ID, submit the ballot and maybe try
+# to vote again.  Returns 'voted', 'rejected' or 'failed', and whether a second vote was accepted.
+def run_voter(args, voter, ballotitems, stats, seed):
+    rng = random.Random(seed)
+    client = Client(args.url, args.timeout)
+    voterid = voter['voteid']
+
+    status, body, elapsed = client.request('/vote')
+    stats.record('GET /vote', elapsed, status == 200)
+
+    status, body, elapsed = client.request('/vote', {'voterid': voterid})
+    ok = status == 200 and 'name="savebutton"' in body and 'contest_' in body
+    stats.record('POST /vote (ballot)', elapsed, ok)
+    if ok is False:
+        return 'failed', False
+
+    fields = fill_ballot(body, voterid, ballotitems, rng, args.writein_rate)
+
+    status, body, elapsed = client.request('/vote', fields)
+    voted = status == 200 and 'Vote Received' in body
+    stats.record('POST /vote (submit)', elapsed, voted)
+    if voted is False:
+        return ('rejected' if status == 200 else 'failed'), False
+
+    # A second ballot for the same voter must be refused.
+    doubled = False
+    if rng.random() < args.repeat_rate:
+        status, body, elapsed = client.request('/vote', fields)
+        doubled = status == 200 and 'Vote Received' in body
+        stats.record('POST /vote (repeat)', elapsed, doubled is False and status == 200)
+
+    return 'voted', doubled
+
+
+# Check the event's tables after the run.  Returns a list of (check, passed, detail).
+def check_database(args, receipts, ballotitems):
+    conn = psycopg2.connect(args.dsn)
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    def fetch(query):
+        cursor.execute(query, {'eventid': int(args.eventid)})
+        return cursor.fetchall()
+
+    checks = []
+
+    voted = set(r['voteid'] for r in fetch('''SELECT voteid FROM voters WHERE eventid=%(eventid)s AND voted=True'''))
+    ballots = fetch('''SELECT COUNT(DISTINCT ballotid) AS count FROM votes WHERE eventid=%(eventid)s''')[0]['count']
+
+    checks.append(("Voters marked voted match ballots", len(voted) == ballots,
+                   "%d voters voted, %d ballots" % (len(voted), ballots)))
+
+    unreceipted = voted - receipts
+    unrecorded = receipts - voted
+    checks.append(("Voters marked voted match receipts", len(unreceipted) == 0 and len(unrecorded) == 0,
+                   "%d voted without a receipt, %d receipts without a vote" % (len(unreceipted), len(unrecorded))))
+
+    duplicates = fetch('''SELECT ballotid, itemid, answer FROM votes WHERE eventid=%(eventid)s
+                          GROUP BY ballotid, itemid, answer HAVING COUNT(*) > 1''')
+    checks.append(("No answer counted twice on a ballot", len(duplicates) == 0, "%d duplicated answers" % len(duplicates)))
+
+    plurality = dict((b['itemid'], b['positions']) for b in ballotitems if b['type'] == ITEM_CONTEST and b['method'] == METHOD_PLURALITY)
+    overvotes = [r for r in fetch('''SELECT ballotid, itemid, COUNT(*) AS count FROM votes WHERE eventid=%(eventid)s
+                                     GROUP BY ballotid, itemid''')
+                 if r['itemid'] in plurality and r['count'] > plurality[r['itemid']]]
+    checks.append(("No ballot over a contest's positions", len(overvotes) == 0, "%d over-voted contests" % len(overvotes)))
+
+    mismatches = fetch('''SELECT COALESCE(counted.itemid, t.itemid) AS itemid
+                          FROM (SELECT itemid, answer, COUNT(*) AS votecount FROM votes
+                                WHERE eventid=%(eventid)s AND rank=1 GROUP BY itemid, answer) AS counted
+                          FULL OUTER JOIN (SELECT * FROM vote_tallies WHERE eventid=%(eventid)s) AS t
+                               ON t.itemid=counted.itemid AND t.answer=counted.answer
+                          WHERE COALESCE(counted.votecount, 0) != COALESCE(t.votecount, 0)''')
+    checks.append(("Tallies agree with votes", len(mismatches) == 0, "%d answers differ" % len(mismatches)))
+
+    cursor.close()
+    conn.close()
+
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a local instance with simulated public voters.  '
+                                                 'The event\'s data is replaced by the generated event.')
+    parser.add_argument('--url', default='http://localhost:1986', help='Base URL of the instance (default http://localhost:1986).')
+    parser.add_argument('--eventid', required=True, help='Event ID to load (its data is replaced).')
+    parser.add_argument('--username', required=True, help='Event admin user name.')
+    parser.add_argument('--password', required=True, help='Event admin password.')
+    parser.add_argument('--dsn', default='dbname=elections user=elections host=localhost', help='Database connection for the checks.')
+    parser.add_argument('--voters', type=int, default=1000, help='Number of voters (default 1000).')
+    parser.add_argument('--concurrency', type=int, default=50, help='Voters voting at once (default 50).')
+    parser.add_argument('--contests', type=int, default=3, help='Number of contests (default 3).')
+    parser.add_argument('--ranked', type=int, default=1, help='How many of the contests are ranked (default 1).')
+    parser.add_argument('--candidates', type=int, default=5, help='Candidates per contest (default 5).')
+    parser.add_argument('--positions', type=int, default=2, help='Positions per plurality contest (default 2).')
+    parser.add_argument('--questions', type=int, default=2, help='Number of questions (default 2).')
+    parser.add_argument('--writein-rate', type=float, default=0.1, help='Fraction of contests given a write-in (default 0.1).')
+    parser.add_argument('--repeat-rate', type=float, default=0.05, help='Fraction of voters who try to vote twice (default 0.05).')
+    parser.add_argument('--timeout', type=float, default=30, help='Request timeout in seconds (default 30).')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the ballots (default 1).')
+    parser.add_argument('--yes', action='store_true', help='Confirm the event\'s data may be replaced.')
+    args = parser.parse_args()
+
+    if args.yes is False:
+        print("This replaces all data of event %s; run again with --yes to confirm." % args.eventid)
+        sys.exit(1)
+
+    rng = random.Random(args.seed)
+    ballotitems, candidates, voters = build_event(args)
+
+    print("Seeding event %s: %d ballot items, %d candidates, %d voters..." % (args.eventid, len(ballotitems), len(candidates), len(voters)))
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, 'loadtest_%s.xlsx' % args.eventid)
+        write_import_file(path, 'Load Test %s' % datetime.datetime.now().strftime('%Y-%m-%d %H:%M'), ballotitems, candidates, voters)
+
+        err = seed_event(args, path)
+        if err is not None:
+            print("Seeding failed: %s" % err)
+            sys.exit(1)
+
+    print("Voting with %d concurrent voters..." % args.concurrency)
+    stats = Stats()
+    seeds = [rng.randrange(1 << 30) for v in voters]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(lambda vs: run_voter(args, vs[0], ballotitems, stats, vs[1]), zip(voters, seeds)))
+    wall = time.perf_counter() - started
+
+    receipts = set(v['voteid'] for v, (outcome, _) in zip(voters, outcomes) if outcome == 'voted')
+    doubled = len([d for _, d in outcomes if d is True])
+
+    print("\n%-22s %8s %7s %9s %9s %9s %9s" % ('Endpoint', 'Requests', 'Errors', 'Req/sec', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for endpoint, e in stats.endpoints.items():
+        times = sorted(e['times'])
+        print("%-22s %8d %7d %9.1f %9.1f %9.1f %9.1f" %
+              (endpoint, len(times), e['errors'], len(times) / wall if wall > 0 else 0,
+               percentile(times, 50) * 1000, percentile(times, 95) * 1000, percentile(times, 99) * 1000))
+
+    print("\n%d ballots recorded in %.1f sec (%.1f ballots/sec); %d rejected, %d failed, %d second votes accepted" %
+          (len(receipts), wall, len(receipts) / wall if wall > 0 else 0,
+           len([o for o, _ in outcomes if o == 'rejected']), len([o for o, _ in outcomes if o == 'failed']), doubled))
+
+    print("\nChecking the database...")
+    failed = doubled > 0
+    for check, passed, detail in check_database(args, receipts, ballotitems):
+        print("  %-40s %s (%s)" % (check, 'OK' if passed else 'FAILED', detail))
+        failed = failed or passed is False
+
+    errors = sum([e['errors'] for e in stats.endpoints.values()])
+    sys.exit(1 if failed or errors > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -122,9 +122,329 @@ def dummy(cursor):
     return 0
 
 
+# Version 2: indexes.
+# votes had no primary key or indexes, so results, vote counts and event data removal all scanned
+# every vote ever cast; public voting looks voters up by voteid alone, which the (clubid, eventid, voteid)
+# constraint can't serve; and results join candidates by (eventid, itemid, id).
+# candidates.id is not guaranteed unique (imports carry ids over), so it gets a plain index.
+# Each index is built CONCURRENTLY so a running server is not locked out of the tables.
+VERSION_2_INDEXES = [('votes_pkey', '''CREATE UNIQUE INDEX CONCURRENTLY votes_pkey ON votes (id);'''),
+                     ('votes_results_idx', '''CREATE INDEX CONCURRENTLY votes_results_idx ON votes (clubid, eventid, itemid, answer);'''),
+                     ('voters_voteid_idx', '''CREATE INDEX CONCURRENTLY voters_voteid_idx ON voters (voteid);'''),
+                     ('candidates_item_idx', '''CREATE INDEX CONCURRENTLY candidates_item_idx ON candidates (eventid, itemid, id);'''),
+                    ]
+
+def upgrade_v2(configdata):
+    conn = connect_to_database()
+
+    # Concurrent index builds can't run inside a transaction.
+    conn.autocommit = True
+    cursor = get_cursor(conn)
+
+    for name, query in VERSION_2_INDEXES:
+        # A failed concurrent build leaves an invalid index behind; drop it and build again.
+        cursor.execute('''SELECT pg_index.indisvalid
+                          FROM pg_class JOIN pg_index ON pg_index.indexrelid = pg_class.oid
+                          WHERE pg_class.relname = %s;''', (name,))
+        result = cursor.fetchone()
+        if result is not None:
+            if result['indisvalid'] is True:
+                print("  Index '%s' already exists." % name)
+                continue
+
+            print("  Dropping invalid index '%s'..." % name)
+            cursor.execute('''DROP INDEX CONCURRENTLY %s;''' % name)
+
+        print("  Creating index '%s'..." % name)
+        cursor.execute(query)
+
+    # Promote the unique index on votes to its primary key (only a brief lock to attach it).
+    cursor.execute('''SELECT EXISTS (SELECT FROM pg_constraint WHERE conname = 'votes_pkey');''')
+    if cursor.fetchone()['exists'] is False:
+        print("  Adding votes primary key...")
+        cursor.execute('''ALTER TABLE votes ADD CONSTRAINT votes_pkey PRIMARY KEY USING INDEX votes_pkey;''')
+
+    cursor.close()
+    close_database(conn)
+
+
+# Version 3: running vote counts per answer, filled in from the votes already cast.
+def upgrade_v3(configdata):
+    conn = connect_to_database()
+    cursor = get_cursor(conn)
+
+    print("  Creating vote tallies table...")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS vote_tallies (
+                          clubid INTEGER NOT NULL DEFAULT 0,
+                          eventid INTEGER NOT NULL DEFAULT 0,
+                          itemid INTEGER NOT NULL,
+                          answer INTEGER NOT NULL,
+                          votecount INTEGER NOT NULL DEFAULT 0,
+                          PRIMARY KEY(clubid, eventid, itemid, answer)
+                      );''')
+
+    print("  Counting existing votes...")
+    cursor.execute('''DELETE FROM vote_tallies;''')
+    cursor.execute('''INSERT INTO vote_tallies (clubid, eventid, itemid, answer, votecount)
+                      SELECT clubid, eventid, itemid, answer, COUNT(*)
+                      FROM votes
+                      GROUP BY clubid, eventid, itemid, answer;''')
+
+    conn.commit()
+    cursor.close()
+    close_database(conn)
+
+
+# Version 4: partition votes and voters by event ID.
+# Each table is renamed aside, recreated as a partitioned table (keeping its ID sequence) with a default
+# partition and one partition per event, refilled from the old table, and the old table dropped.
+# This runs in one transaction and locks both tables while it copies; run it with the server stopped.
+VERSION_4_TABLES = {'voters': {'columns': ['id', 'clubid', 'eventid', 'firstname', 'lastname', 'fullname', 'email', 'voteid', 'voted'],
+                               'create': '''CREATE TABLE voters (
+                                                id INTEGER NOT NULL DEFAULT nextval('voters_id_seq'),
+                                                clubid INTEGER NOT NULL DEFAULT 0,
+                                                eventid INTEGER NOT NULL DEFAULT 0,
+                                                firstname VARCHAR NOT NULL,
+                                                lastname VARCHAR NOT NULL,
+                                                fullname VARCHAR NOT NULL,
+                                                email VARCHAR NOT NULL,
+                                                voteid VARCHAR NOT NULL,
+                                                voted BOOLEAN NOT NULL DEFAULT false,
+                                                UNIQUE(clubid, eventid, fullname),
+                                                UNIQUE(clubid, eventid, voteid)
+                                            ) PARTITION BY LIST (eventid);''',
+                               'indexes': ['''CREATE INDEX voters_voteid_idx ON voters (voteid);''']
+                              },
+                    'votes':  {'columns': ['id', 'clubid', 'eventid', 'itemid', 'ballotid', 'answer', 'commentary'],
+                               'create': '''CREATE TABLE votes (
+                                                id INTEGER NOT NULL DEFAULT nextval('votes_id_seq'),
+                                                clubid INTEGER NOT NULL DEFAULT 0,
+                                                eventid INTEGER NOT NULL DEFAULT 0,
+                                                itemid INTEGER NOT NULL,
+                                                ballotid INTEGER NOT NULL,
+                                                answer INTEGER NOT NULL,
+                                                commentary VARCHAR,
+                                                PRIMARY KEY(id, eventid)
+                                            ) PARTITION BY LIST (eventid);''',
+                               'indexes': ['''CREATE INDEX votes_results_idx ON votes (clubid, eventid, itemid, answer);''']
+                              },
+                   }
+
+def upgrade_v4(configdata):
+    conn = connect_to_database()
+    cursor = get_cursor(conn)
+
+    # Partitions are made for every event except the system default (event 0).
+    cursor.execute('''SELECT eventid FROM events WHERE eventid != 0 ORDER BY eventid;''')
+    eventids = [e['eventid'] for e in cursor.fetchall()]
+
+    for table in VERSION_4_TABLES:
+        tabledata = VERSION_4_TABLES[table]
+
+        cursor.execute('''SELECT relkind FROM pg_class WHERE relname = %s;''', (table,))
+        if cursor.fetchone()['relkind'] == 'p':
+            print("  Table '%s' is already partitioned." % table)
+            continue
+
+        print("  Partitioning table '%s' for %d events..." % (table, len(eventids)))
+
+        # Move the old table aside, freeing its constraint and index names and keeping its sequence.
+        cursor.execute('''ALTER TABLE %s RENAME TO %s_old;''' % (table, table))
+        cursor.execute('''ALTER SEQUENCE %s_id_seq OWNED BY NONE;''' % table)
+
+        cursor.execute('''SELECT conname FROM pg_constraint WHERE conrelid = '%s_old'::regclass;''' % table)
+        for c in cursor.fetchall():
+            cursor.execute('''ALTER TABLE %s_old DROP CONSTRAINT %s;''' % (table, c['conname']))
+
+        cursor.execute('''SELECT indexname FROM pg_indexes WHERE tablename = '%s_old';''' % table)
+        for i in cursor.fetchall():
+            cursor.execute('''DROP INDEX %s;''' % i['indexname'])
+
+        # Build the partitioned table.
+        cursor.execute(tabledata['create'])
+        cursor.execute('''ALTER SEQUENCE %s_id_seq OWNED BY %s.id;''' % (table, table))
+        cursor.execute('''CREATE TABLE %s_default PARTITION OF %s DEFAULT;''' % (table, table))
+
+        for eventid in eventids:
+            cursor.execute('''CREATE TABLE %s_%d PARTITION OF %s FOR VALUES IN (%d);''' % (table, eventid, table, eventid))
+
+        for index in tabledata['indexes']:
+            cursor.execute(index)
+
+        # Copy the data across and drop the old table.
+        columns = ', '.join(tabledata['columns'])
+        cursor.execute('''INSERT INTO %s (%s) SELECT %s FROM %s_old;''' % (table, columns, columns, table))
+        print("  Copied %d rows." % cursor.rowcount)
+
+        cursor.execute('''DROP TABLE %s_old;''' % table)
+
+    conn.commit()
+    cursor.close()
+    close_database(conn)
+
+
+# Version 5: a ballot ID sequence per event, starting after the highest ballot ID already used.
+def upgrade_v5(configdata):
+    conn = connect_to_database()
+    cursor = get_cursor(conn)
+
+    cursor.execute('''SELECT events.eventid,
+                             GREATEST(COALESCE(vote_ballotid.ballotid, 0),
+                                      (SELECT COALESCE(MAX(ballotid), 0) FROM votes WHERE votes.eventid=events.eventid)) AS ballotid
+                      FROM events
+                      LEFT JOIN vote_ballotid ON vote_ballotid.eventid=events.eventid;''')
+
+    for e in cursor.fetchall():
+        print("  Creating ballot ID sequence for event %d at %d..." % (e['eventid'], e['ballotid']))
+        cursor.execute('''CREATE SEQUENCE IF NOT EXISTS vote_ballotid_%d MINVALUE 0;''' % e['eventid'])
+        cursor.execute('''SELECT setval('vote_ballotid_%d', %d);''' % (e['eventid'], e['ballotid']))
+
+    conn.commit()
+    cursor.close()
+    close_database(conn)
+
+
+# The definition of a function as schema/elections.sql creates it for new installs, so upgrades install the
+# same one rather than keeping copies of it here.
+def schema_function(configdata, name):
+    with open(os.path.join(configdata['INSTALLDIR'], 'schema', 'elections.sql'), 'r') as f:
+        schema = f.read()
+
+    start = schema.index('CREATE OR REPLACE FUNCTION %s(' % name)
+    end = schema.index(';', schema.index('$$ LANGUAGE', start)) + 1
+    return schema[start:end]
+
+
+# Version 6: the add_ballot() function, which records a whole ballot in one transaction, and the event
+# versions, moved on by admin changes to an event's ballot, candidates or votes so every process can tell
+# when what it has cached is stale.
+# add_ballot() is installed as it is now; the tables and functions it uses that later versions add need
+# only exist by the time it is first called.
+VERSION_6_TABLE = '''CREATE TABLE IF NOT EXISTS event_versions (
+                         clubid INTEGER NOT NULL DEFAULT 0,
+                         eventid INTEGER NOT NULL DEFAULT 0,
+                         version BIGINT NOT NULL DEFAULT 0,
+                         PRIMARY KEY(clubid, eventid)
+                     );'''
+
+def upgrade_v6(configdata):
+    conn = connect_to_database()
+    cursor = get_cursor(conn)
+
+    print("  Creating event versions table...")
+    cursor.execute(VERSION_6_TABLE)
+    cursor.execute('''GRANT ALL PRIVILEGES ON TABLE event_versions TO elections;''')
+
+    print("  Creating function add_ballot()...")
+    cursor.execute(schema_function(configdata, 'add_ballot'))
+    cursor.execute('''GRANT EXECUTE ON FUNCTION add_ballot TO elections;''')
+
+    conn.commit()
+    cursor.close()
+    close_database(conn)
+
+
+# Version 7: ranked contests.  Ballot items get a counting method and votes a rank (1 for plurality
+# votes).
+def upgrade_v7(configdata):
+    conn = connect_to_database()
+    cursor = get_cursor(conn)
+
+    print("  Adding counting methods to ballot items...")
+    cursor.execute('''ALTER TABLE ballotitems ADD COLUMN IF NOT EXISTS method INTEGER NOT NULL DEFAULT 1;''')
+
+    print("  Adding ranks to votes...")
+    cursor.execute('''ALTER TABLE votes ADD COLUMN IF NOT EXISTS rank INTEGER NOT NULL DEFAULT 1;''')
+
+    conn.commit()
+    cursor.close()
+    close_database(conn)
+
+
+# Version 8: write-in names are matched ignoring case and spacing.  Candidates get a name key column
+# (unique per contest in place of the full name), which add_ballot() matches write-ins on, with a trigram
+# index for finding close spellings.  Candidates whose names already share a key are merged.
+def upgrade_v8(configdata):
+    conn = connect_to_database()
+    cursor = get_cursor(conn)
+
+    print("  Creating function candidate_namekey()...")
+    cursor.execute('''CREATE EXTENSION IF NOT EXISTS pg_trgm;''')
+    cursor.execute(schema_function(configdata, 'candidate_namekey'))
+    cursor.execute('''GRANT EXECUTE ON FUNCTION candidate_namekey TO elections;''')
+
+    print("  Adding name keys to candidates...")
+    cursor.execute('''ALTER TABLE candidates ADD COLUMN IF NOT EXISTS namekey VARCHAR
+                      GENERATED ALWAYS AS (candidate_namekey(fullname)) STORED;''')
+
+    # Candidates whose names differ only in case or spacing become one: the configured candidate (or the
+    # first added) keeps the votes of the others.
+    cursor.execute('''SELECT clubid, eventid, itemid, namekey, array_agg(id ORDER BY writein ASC, id ASC) AS ids
+                      FROM candidates
+                      GROUP BY clubid, eventid, itemid, namekey
+                      HAVING COUNT(*) > 1;''')
+    duplicates = cursor.fetchall()
+
+    events = set()
+    for d in duplicates:
+        clubid, eventid, itemid = d['clubid'], d['eventid'], d['itemid']
+        target = d['ids'][0]
+        sources = ', '.join(['%d' % s for s in d['ids'][1:]])
+
+        print("  Merging %d candidates named '%s' (club %d, event %d, item %d)..." %
+              (len(d['ids']), d['namekey'], clubid, eventid, itemid))
+        cursor.execute('''UPDATE votes SET answer=%d
+                          WHERE clubid=%d AND eventid=%d AND itemid=%d AND answer IN (%s);''' %
+                       (target, clubid, eventid, itemid, sources))
+        cursor.execute('''DELETE FROM votes AS v
+                          USING votes AS w
+                          WHERE v.clubid=%d AND v.eventid=%d AND v.itemid=%d AND v.answer=%d
+                                AND w.clubid=v.clubid AND w.eventid=v.eventid AND w.itemid=v.itemid
+                                AND w.ballotid=v.ballotid AND w.answer=v.answer
+                                AND (w.rank < v.rank OR (w.rank = v.rank AND w.id < v.id));''' %
+                       (clubid, eventid, itemid, target))
+        cursor.execute('''DELETE FROM candidates
+                          WHERE clubid=%d AND eventid=%d AND itemid=%d AND id IN (%s);''' %
+                       (clubid, eventid, itemid, sources))
+
+        events.add((clubid, eventid))
+
+    for clubid, eventid in sorted(events):
+        print("  Recounting vote tallies (club %d, event %d)..." % (clubid, eventid))
+        cursor.execute('''DELETE FROM vote_tallies WHERE clubid=%d AND eventid=%d;''' % (clubid, eventid))
+        cursor.execute('''INSERT INTO vote_tallies (clubid, eventid, itemid, answer, votecount)
+                          SELECT clubid, eventid, itemid, answer, COUNT(*)
+                          FROM votes
+                          WHERE clubid=%d AND eventid=%d AND rank=1
+                          GROUP BY clubid, eventid, itemid, answer;''' % (clubid, eventid))
+
+    print("  Replacing candidate name constraint...")
+    cursor.execute('''SELECT conname FROM pg_constraint
+                      WHERE conrelid='candidates'::regclass AND contype='u';''')
+    for c in cursor.fetchall():
+        cursor.execute('''ALTER TABLE candidates DROP CONSTRAINT %s;''' % c['conname'])
+
+    cursor.execute('''ALTER TABLE candidates ADD CONSTRAINT candidates_clubid_eventid_itemid_namekey_key
+                      UNIQUE (clubid, eventid, itemid, namekey);''')
+
+    print("  Creating candidate name similarity index...")
+    cursor.execute('''CREATE INDEX IF NOT EXISTS candidates_namekey_trgm_idx ON candidates USING gin (namekey gin_trgm_ops);''')
+
+    conn.commit()
+    cursor.close()
+    close_database(conn)
+
+
 # List of upgrade functions, indexed by version.
 UPGRADE_VERSION_FUNCS = [dummy,
                          dummy,
+                         upgrade_v2,
+                         upgrade_v3,
+                         upgrade_v4,
+                         upgrade_v5,
+                         upgrade_v6,
+                         upgrade_v7,
+                         upgrade_v8,
                         ]
 
 # Execute an update from the previous to the new version.